@@ -1,6 +1,17 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import IntegrityError, connections, transaction
+from django.db.models import QuerySet
+from django.http import Http404, HttpResponseNotAllowed
+from django.shortcuts import redirect
+from django.urls import path, reverse
+from django.utils.functional import cached_property
+from django.utils import timezone
 from django.utils.html import format_html
-from .models import City, NKOCategory, NKO, UserProfile
+from django.utils.http import url_has_allowed_host_and_scheme
+from .models import City, GeocodeCache, NKOCategory, NKO, Task, UserProfile
+from .moderation import MODERATION_ACTIONS, moderate
 
 
 @admin.register(City)
@@ -16,59 +27,121 @@ class NKOCategoryAdmin(admin.ModelAdmin):
     search_fields = ['name']
 
 
+class EstimatedCountPaginator(Paginator):
+    """Paginator, который не считает строки большой таблицы без фильтров.
+
+    COUNT(*) по всей таблице — полный проход; для списка без фильтров и
+    поиска число строк берётся из статистики БД. Отфильтрованные списки
+    и небольшие таблицы считаются точно, как и таблица, для которой
+    оценка завышена настолько, что последняя страница оказалась бы пустой.
+    """
+    exact_count_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if isinstance(queryset, QuerySet) and not queryset.query.where:
+            estimate = estimate_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > self.exact_count_limit and self._has_rows_at(estimate):
+                return estimate
+        return super().count
+
+    def _has_rows_at(self, count):
+        """Есть ли строки на последней странице, если строк ``count``."""
+        start = (count - 1) // self.per_page * self.per_page
+        return self.object_list[start:start + 1].exists()
+
+
+def estimate_count(model, using='default'):
+    """Приблизительное число строк таблицы или None, если оценить нельзя."""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # reltuples обновляют ANALYZE и autovacuum; -1 — таблицу ещё не анализировали
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+        elif connection.vendor == 'sqlite':
+            # Наибольший rowid — по индексу первичного ключа; после удалений это оценка сверху.
+            cursor.execute(f'SELECT MAX(rowid) FROM {connection.ops.quote_name(table)}')
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
 @admin.register(NKO)
 class NKOAdmin(admin.ModelAdmin):
-    list_display = ['name', 'category', 'city', 'created_by', 'is_approved', 'created_at', 'actions']
+    list_display = ['name', 'category', 'city', 'created_by', 'is_approved', 'created_at', 'moderation_buttons']
     list_filter = ['is_approved', 'category', 'city', 'created_at']
-    search_fields = ['name', 'description']
+    list_select_related = ['category', 'city', 'created_by']
+    search_fields = ['name', 'description', '=external_id']
     readonly_fields = ['created_at', 'created_by']
     list_per_page = 20
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
 
-    def actions(self, obj):
+    def moderation_buttons(self, obj):
+        # Кнопки отправляют форму списка (в ней уже есть csrf-токен) на moderate_view.
         if obj.is_approved:
             return format_html(
                 '<span style="color: green;">✓ Одобрено</span> | '
-                '<a href="?action=reject&id={}">Отклонить</a>',
-                obj.id
+                '<button type="submit" class="button" formaction="{}">Отклонить</button>',
+                reverse('admin:map_app_nko_moderate', args=[obj.id, 'reject']),
             )
         else:
             return format_html(
-                '<a href="?action=approve&id={}">Одобрить</a> | '
+                '<button type="submit" class="button" formaction="{}">Одобрить</button> | '
                 '<span style="color: red;">✗ На модерации</span>',
-                obj.id
+                reverse('admin:map_app_nko_moderate', args=[obj.id, 'approve']),
             )
 
-    actions.short_description = 'Действия'
-
-    def get_queryset(self, request):
-        qs = super().get_queryset(request)
-
-        # Быстрые действия через GET параметры
-        action = request.GET.get('action')
-        nko_id = request.GET.get('id')
-
-        if action and nko_id:
-            nko = NKO.objects.get(id=nko_id)
-            if action == 'approve':
-                nko.is_approved = True
-                nko.save()
-                self.message_user(request, f'НКО "{nko.name}" одобрена')
-            elif action == 'reject':
-                nko.is_approved = False
-                nko.save()
-                self.message_user(request, f'НКО "{nko.name}" отклонена')
-
-        return qs
+    moderation_buttons.short_description = 'Действия'
+
+    def get_urls(self):
+        urls = [
+            path(
+                '<int:nko_id>/moderate/<str:action>/',
+                self.admin_site.admin_view(self.moderate_view),
+                name='map_app_nko_moderate',
+            ),
+        ]
+        return urls + super().get_urls()
+
+    def moderate_view(self, request, nko_id, action):
+        """Одобрение или отклонение одной НКО кнопкой из списка (только POST)."""
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        if action not in MODERATION_ACTIONS:
+            raise Http404
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+
+        summary = moderate(**{action: [nko_id]})
+        if summary['not_found']:
+            self.message_user(request, f'НКО #{nko_id} не найдена', messages.WARNING)
+        elif summary['approved']:
+            self.message_user(request, f'НКО #{nko_id} одобрена')
+        elif summary['rejected']:
+            self.message_user(request, f'НКО #{nko_id} отклонена')
+
+        referer = request.META.get('HTTP_REFERER')
+        if referer and url_has_allowed_host_and_scheme(
+            referer, allowed_hosts={request.get_host()}, require_https=request.is_secure(),
+        ):
+            return redirect(referer)
+        return redirect('admin:map_app_nko_changelist')
 
     def approve_nko(self, request, queryset):
-        updated = queryset.update(is_approved=True)
-        self.message_user(request, f'{updated} НКО одобрено')
+        summary = moderate(approve=queryset.values_list('id', flat=True))
+        self.message_user(request, f'{len(summary["approved"])} НКО одобрено')
 
     approve_nko.short_description = "Одобрить выбранные НКО"
 
     def reject_nko(self, request, queryset):
-        updated = queryset.update(is_approved=False)
-        self.message_user(request, f'{updated} НКО отклонено')
+        summary = moderate(reject=queryset.values_list('id', flat=True))
+        self.message_user(request, f'{len(summary["rejected"])} НКО отклонено')
 
     reject_nko.short_description = "Отклонить выбранные НКО"
 
@@ -78,5 +151,41 @@ class NKOAdmin(admin.ModelAdmin):
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ['user', 'phone', 'city', 'created_at']
+    list_select_related = ['user', 'city']
     search_fields = ['user__username', 'phone']
-    list_filter = ['city', 'created_at']
\ No newline at end of file
+    list_filter = ['city', 'created_at']
+
+
+@admin.register(GeocodeCache)
+class GeocodeCacheAdmin(admin.ModelAdmin):
+    list_display = ['address', 'latitude', 'longitude', 'resolved_at']
+    search_fields = ['address']
+    # удалённая запись будет запрошена у геокодера заново
+    readonly_fields = ['resolved_at']
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ['name', 'status', 'attempts', 'max_attempts', 'run_after', 'created_at']
+    list_filter = ['status', 'name']
+    search_fields = ['key']
+    readonly_fields = ['created_at']
+
+    def retry_tasks(self, request, queryset):
+        retried = 0
+        for task in queryset.filter(status=Task.FAILED):
+            try:
+                with transaction.atomic():
+                    Task.objects.filter(id=task.id).update(
+                        status=Task.PENDING, attempts=0, run_after=timezone.now(), locked_until=None,
+                    )
+            except IntegrityError:
+                # такая же задача уже ждёт в очереди
+                task.delete()
+                continue
+            retried += 1
+        self.message_user(request, f'{retried} задач снова в очереди')
+
+    retry_tasks.short_description = "Повторить упавшие задачи"
+
+    actions = [retry_tasks]
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MapAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'map_app'
+
+    def ready(self):
+        # модули с обработчиками сигналов и фоновыми задачами (@task)
+        from . import avatars, cache, events, geocoding, metrics, moderation, signals, snapshot, sync, tiles  # noqa: F401
@@ -0,0 +1,34 @@
+"""Уменьшение загруженных аватаров в фоне (задача очереди, см. tasks.py)."""
+import io
+
+from django.core.files.base import ContentFile
+from PIL import Image
+
+from .models import UserProfile
+from .tasks import task
+
+AVATAR_SIZE = 256
+
+
+@task()
+def shrink_avatar(profile_id):
+    """Уменьшает аватар до AVATAR_SIZE пикселей по большей стороне."""
+    profile = UserProfile.objects.filter(id=profile_id).first()
+    if profile is None or not profile.avatar:
+        return
+    with profile.avatar.open('rb') as file:
+        image = Image.open(file)
+        image.load()
+    if max(image.size) <= AVATAR_SIZE:
+        return
+
+    image_format = image.format
+    image.thumbnail((AVATAR_SIZE, AVATAR_SIZE))
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format)
+    # исходный файл удаляется последним: при сбое у пользователя остаётся аватар
+    storage, name = profile.avatar.storage, profile.avatar.name
+    saved = storage.save(name, ContentFile(buffer.getvalue()))
+    replaced = UserProfile.objects.filter(id=profile_id, avatar=name).update(avatar=saved)
+    # пока шла задача, пользователь мог загрузить другой аватар
+    storage.delete(name if replaced else saved)
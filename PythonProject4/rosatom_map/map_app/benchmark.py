@@ -0,0 +1,143 @@
+"""Замеры публичных эндпоинтов карты на синтетических данных (команда benchmark).
+
+Синтетические НКО раскладываются по городам и категориям из
+load_initial_data и вставляются bulk_create пачками — без save() и
+сигналов, поэтому сотня тысяч записей создаётся за секунды.
+
+Каждый эндпоинт замеряется через тестовый клиент Django:
+- первый запрос на холодном кеше — время, запросы к БД и пик памяти
+  (tracemalloc; под ним запрос выполняется отдельно, чтобы не искажать время);
+- серия запросов на прогретом кеше — p50 и p99 задержки, запросы к БД
+  и размер ответа (из RequestMetricsMiddleware, см. metrics.py).
+"""
+import math
+import random
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import Client
+
+from .cache import local_cache
+from .clustering import cluster_index
+from .geo import geo_cell
+from .models import City, NKOCategory, NKO
+from .nearby import nearby_index
+from .search import search_index
+
+ENDPOINTS = (
+    ('map', '/'),
+    ('api_nkos', '/api/nkos/'),
+    ('api_nkos_markers', '/api/nkos/markers/?format=bin'),
+    ('nko_by_city', '/city/{city_id}/nkos/'),
+    ('nko_by_category', '/category/{category_id}/nkos/'),
+)
+# как у браузера: снимки и маркеры отдаются сжатыми
+ACCEPT_ENCODING = 'gzip, deflate, br'
+BATCH_SIZE = 2000
+APPROVED_SHARE = 0.9
+# разброс точек вокруг центра города, градусы
+SPREAD = 0.15
+
+
+def generate_nkos(count, seed=0):
+    """Добавляет ``count`` синтетических НКО в города и категории из БД."""
+    cities = list(City.objects.all())
+    categories = list(NKOCategory.objects.all())
+    if not cities or not categories:
+        raise ValueError('Нет городов или категорий: сначала выполните load_initial_data')
+    author, _ = User.objects.get_or_create(username='benchmark', defaults={'email': 'benchmark@example.com'})
+
+    rnd = random.Random(seed)
+    first = NKO.objects.count()
+    for offset in range(0, count, BATCH_SIZE):
+        batch = []
+        for number in range(first + offset, first + min(offset + BATCH_SIZE, count)):
+            city = rnd.choice(cities)
+            latitude = city.latitude + rnd.uniform(-SPREAD, SPREAD)
+            longitude = city.longitude + rnd.uniform(-SPREAD, SPREAD)
+            batch.append(NKO(
+                name=f'НКО {number}',
+                description=f'Синтетическая организация {number}: помощь жителям города {city.name}',
+                address=f'{city.name}, ул. Тестовая, {number % 200 + 1}',
+                phone=f'+7 900 {number % 10_000_000:07d}',
+                category=rnd.choice(categories),
+                city=city,
+                created_by=author,
+                latitude=latitude,
+                longitude=longitude,
+                geo_cell=geo_cell(latitude, longitude),
+                is_approved=rnd.random() < APPROVED_SHARE,
+            ))
+        NKO.objects.bulk_create(batch)
+
+
+def reset_caches():
+    """Холодный старт: пустые кеши, новая версия набора данных, пустые индексы в памяти."""
+    cache.clear()
+    local_cache.clear()
+    for index in (cluster_index, nearby_index, search_index):
+        index.reset()
+
+
+def percentile(values, p):
+    """Процентиль по ближайшему рангу."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def _get(client, url):
+    start = time.perf_counter()
+    response = client.get(url, HTTP_ACCEPT_ENCODING=ACCEPT_ENCODING)
+    elapsed = (time.perf_counter() - start) * 1000
+    if response.status_code != 200:
+        raise RuntimeError(f'{url}: HTTP {response.status_code}')
+    return response, elapsed
+
+
+def measure(client, url, requests):
+    """Замеры одного эндпоинта: холодный запрос и ``requests`` прогретых."""
+    reset_caches()
+    tracemalloc.start()
+    try:
+        _get(client, url)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    reset_caches()
+    cold, cold_ms = _get(client, url)
+    latencies, queries = [], []
+    for _ in range(requests):
+        response, elapsed = _get(client, url)
+        latencies.append(elapsed)
+        queries.append(response.metrics.queries)
+    return {
+        'cold_ms': round(cold_ms, 2),
+        'cold_queries': cold.metrics.queries,
+        'peak_memory_kb': peak // 1024,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'queries': max(queries),
+        'response_bytes': response.metrics.response_bytes,
+    }
+
+
+def run_benchmark(sizes, requests=50, progress=None):
+    """Замеры ENDPOINTS на наборах из ``sizes`` НКО; данные дополняются от меньшего к большему."""
+    client = Client()
+    results = []
+    for size in sorted(sizes):
+        generate_nkos(size - NKO.objects.count(), seed=size)
+        ids = {
+            'city_id': City.objects.order_by('id').values_list('id', flat=True).first(),
+            'category_id': NKOCategory.objects.order_by('id').values_list('id', flat=True).first(),
+        }
+        for name, url in ENDPOINTS:
+            url = url.format(**ids)
+            result = {'size': size, 'endpoint': name, 'url': url, **measure(client, url, requests)}
+            results.append(result)
+            if progress:
+                progress(result)
+    return results
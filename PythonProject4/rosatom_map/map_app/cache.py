@@ -0,0 +1,266 @@
+"""Кеш публичного набора данных НКО.
+
+Всё, что строится из одобренных НКО, городов и категорий, кешируется
+под номером версии набора данных. Версия хранится в общем кеше Django
+(файловом или Redis, см. CACHES в settings) и увеличивается при любой
+записи в NKO, City и NKOCategory, поэтому старые записи просто перестают
+читаться. Готовые значения лежат в локальном LRU процесса и в общем кеше:
+повторный запрос стоит одного чтения версии и ни одного запроса к БД.
+
+Для асинхронных представлений есть те же функции с префиксом ``a``.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.base import BaseCache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+
+from .metrics import serialization
+from .models import City, NKOCategory
+from .signals import nkos_changed
+
+VERSION_KEY = 'map_app:dataset_version'
+REFERENCE_VERSION_KEY = 'map_app:reference_version'
+PAYLOAD_TIMEOUT = 24 * 60 * 60
+LOCAL_CACHE_SIZE = 128
+VERSION_SLOTS = 100  # см. bump_version
+
+
+class LocalLRU:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+local_cache = LocalLRU(LOCAL_CACHE_SIZE)
+_bump_lock = threading.Lock()
+
+
+def _now_ms():
+    return time.time_ns() // 1_000_000
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        version = _now_ms()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+async def _aget_version(key):
+    version = await cache.aget(key)
+    if version is None:
+        version = _now_ms()
+        if not await cache.aadd(key, version, None):
+            version = await cache.aget(key, version)
+    return version
+
+
+def get_version():
+    """Текущая версия набора данных.
+
+    Версия — монотонная отметка времени в миллисекундах, поэтому после
+    очистки общего кеша номера не повторяются.
+    """
+    return _get_version(VERSION_KEY)
+
+
+async def aget_version():
+    return await _aget_version(VERSION_KEY)
+
+
+def get_reference_version():
+    """Версия, на которой последний раз менялись города или категории."""
+    return _get_version(REFERENCE_VERSION_KEY)
+
+
+async def aget_reference_version():
+    return await _aget_version(REFERENCE_VERSION_KEY)
+
+
+def _atomic_incr():
+    return type(caches['default']).incr is not BaseCache.incr
+
+
+def bump_version():
+    """Новая версия набора данных, своя у каждого вызова.
+
+    В Redis и в памяти процесса incr атомарен: два изменения в одну
+    миллисекунду в разных процессах получат разные версии. До часов версию
+    догоняет один процесс в секунду — иначе одновременные догоняющие
+    incr унесли бы её в будущее.
+
+    В файловом кеше (настройка по умолчанию, без REDIS_URL) incr — это
+    чтение и запись, и два процесса могут прочитать одну версию. Там
+    версия округляется вверх до числа, которое даёт остаток pid процесса
+    по модулю VERSION_SLOTS: у воркеров остатки разные, поэтому
+    проигравший гонку всё равно пишет новую версию, а не ту же, что
+    победитель, и кеш не отдаст данные до его изменения. Версия при этом
+    опережает часы не больше чем на VERSION_SLOTS мс за изменение.
+    """
+    now = _now_ms()
+    if not _atomic_incr():
+        with _bump_lock:
+            version = max(now, (cache.get(VERSION_KEY) or 0) + 1)
+            version += (os.getpid() - version) % VERSION_SLOTS
+            cache.set(VERSION_KEY, version, None)
+        return version
+    if cache.add(VERSION_KEY, now, None):
+        return now
+    try:
+        version = cache.incr(VERSION_KEY)
+    except ValueError:
+        # версию вытеснили из кеша между add и incr
+        return bump_version()
+    if version < now and cache.add(f'{VERSION_KEY}:catch_up', True, 1):
+        version = cache.incr(VERSION_KEY, now - version)
+    return version
+
+
+def bump_reference_version():
+    cache.set(REFERENCE_VERSION_KEY, bump_version(), None)
+
+
+def get_or_build(name, build, version=None):
+    """Значение ``build()`` для текущей версии набора данных.
+
+    Связанные значения (например, данные и их сжатая копия) собираются под
+    одной заранее прочитанной ``version``: если версия сменится между
+    вызовами, старые данные не окажутся под новым ключом.
+    """
+    if version is None:
+        version = get_version()
+    key = f'map_app:{name}:{version}'
+    value = local_cache.get(key)
+    if value is None:
+        value = cache.get(key)
+        if value is None:
+            value = build()
+            cache.set(key, value, PAYLOAD_TIMEOUT)
+        local_cache.set(key, value)
+    return value
+
+
+async def aget_or_build(name, build):
+    """Асинхронный get_or_build; ``build`` — асинхронная функция без аргументов."""
+    key = f'map_app:{name}:{await aget_version()}'
+    value = local_cache.get(key)
+    if value is None:
+        value = await cache.aget(key)
+        if value is None:
+            value = await build()
+            await cache.aset(key, value, PAYLOAD_TIMEOUT)
+        local_cache.set(key, value)
+    return value
+
+
+@serialization()
+def dump_json(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def cached_json(name, build):
+    """Готовые байты JSON для ``build()`` в текущей версии набора данных."""
+    return get_or_build(name, lambda: dump_json(build()))
+
+
+async def acached_json(name, build):
+    async def build_json():
+        return dump_json(await build())
+    return await aget_or_build(name, build_json)
+
+
+def _etag(request, version):
+    # Слабый ETag: снимки и маркеры отдаются в gzip, br и без сжатия, а
+    # сильный валидатор обязан различать представления (RFC 9110, 8.8.3).
+    path = hashlib.md5(request.get_full_path().encode(), usedforsecurity=False).hexdigest()[:12]
+    return f'W/"{version}-{path}"'
+
+
+def dataset_etag(request, *args, **kwargs):
+    return _etag(request, get_version())
+
+
+def dataset_last_modified(request, *args, **kwargs):
+    return datetime.fromtimestamp(get_version() / 1000, tz=timezone.utc)
+
+
+def dataset_conditional(view):
+    """ETag и Last-Modified по версии набора данных, 304 для неизменившихся ответов."""
+    if iscoroutinefunction(view):
+        return _async_dataset_conditional(view)
+    view = condition(etag_func=dataset_etag, last_modified_func=dataset_last_modified)(view)
+    return cache_control(no_cache=True)(view)
+
+
+def _async_dataset_conditional(view):
+    # То же, что condition(): его etag_func синхронная и читала бы версию
+    # блокирующим вызовом кеша внутри event loop.
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        version = await aget_version()
+        etag = quote_etag(_etag(request, version))
+        last_modified = http_date(version // 1000)
+
+        response = None
+        if request.method in ('GET', 'HEAD'):
+            response = get_conditional_response(
+                request, etag=etag, last_modified=version // 1000,
+            )
+        if response is None:
+            response = await view(request, *args, **kwargs)
+        if request.method in ('GET', 'HEAD'):
+            response.headers.setdefault('ETag', etag)
+            response.headers.setdefault('Last-Modified', last_modified)
+        patch_cache_control(response, no_cache=True)
+        return response
+    return wrapper
+
+
+@receiver(nkos_changed)
+def nkos_changed_bump_version(sender, **kwargs):
+    bump_version()
+
+
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+@receiver(post_save, sender=NKOCategory)
+@receiver(post_delete, sender=NKOCategory)
+def reference_data_changed(sender, **kwargs):
+    transaction.on_commit(bump_reference_version)
@@ -0,0 +1,179 @@
+"""Серверная кластеризация меток НКО по уровням зума.
+
+Индекс — иерархическая сетка в проекции Меркатора: на зуме ``z`` мир
+делится на 2^(z + CELL_SHIFT) ячеек по каждой оси (ячейка ~64 px),
+и каждая ячейка вложена в ячейку предыдущего уровня. Для каждой ячейки
+хранятся число точек, суммы координат и разбивка по категориям, поэтому
+добавление или удаление НКО обновляет по одной ячейке на уровень,
+без перестроения всего индекса.
+
+Индекс живёт в памяти процесса и при смене версии набора данных
+подтягивает только изменённые НКО (см. sync.py), так что процессы
+не расходятся между собой.
+"""
+import math
+from itertools import product
+
+from .models import NKO
+from .sync import SyncedIndex
+
+MIN_ZOOM = 0
+MAX_ZOOM = 16
+CELL_SHIFT = 2
+MAX_LATITUDE = 85.05112878
+
+
+def project(lat, lon):
+    """Широта/долгота -> координаты Меркатора в квадрате [0, 1]."""
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    sin = math.sin(math.radians(lat))
+    x = (lon + 180.0) / 360.0
+    y = 0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)
+    return min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+
+
+def _cell_key(x, y, zoom):
+    n = 1 << (zoom + CELL_SHIFT)
+    return min(int(x * n), n - 1), min(int(y * n), n - 1)
+
+
+class _Cell:
+    __slots__ = ('ids', 'stats')
+
+    def __init__(self):
+        self.ids = {}    # id НКО -> id категории
+        self.stats = {}  # id категории -> [количество, сумма широт, сумма долгот]
+
+
+class ClusterIndex(SyncedIndex):
+    def __init__(self):
+        super().__init__()
+        self._points = {}
+        self._levels = []
+
+    def _rebuild(self):
+        self._points = {}
+        self._levels = [{} for _ in range(MAX_ZOOM + 1)]
+        rows = NKO.objects.filter(is_approved=True).values_list(
+            'id', 'latitude', 'longitude', 'category_id'
+        )
+        for row in rows.iterator(chunk_size=2000):
+            self._add(*row)
+
+    def _add(self, nko_id, lat, lon, category_id):
+        x, y = project(lat, lon)
+        for zoom, cells in enumerate(self._levels):
+            key = _cell_key(x, y, zoom)
+            cell = cells.get(key)
+            if cell is None:
+                cell = cells[key] = _Cell()
+            cell.ids[nko_id] = category_id
+            stat = cell.stats.setdefault(category_id, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += lat
+            stat[2] += lon
+        self._points[nko_id] = (lat, lon, category_id)
+
+    def _remove(self, nko_id):
+        point = self._points.pop(nko_id, None)
+        if point is None:
+            return
+        lat, lon, category_id = point
+        x, y = project(lat, lon)
+        for zoom, cells in enumerate(self._levels):
+            key = _cell_key(x, y, zoom)
+            cell = cells[key]
+            del cell.ids[nko_id]
+            stat = cell.stats[category_id]
+            stat[0] -= 1
+            stat[1] -= lat
+            stat[2] -= lon
+            if not stat[0]:
+                del cell.stats[category_id]
+            if not cell.ids:
+                del cells[key]
+
+    def _refresh(self, ids):
+        rows = NKO.objects.filter(id__in=ids, is_approved=True).values_list(
+            'id', 'latitude', 'longitude', 'category_id'
+        )
+        for nko_id in ids:
+            self._remove(nko_id)
+        for row in rows:
+            self._add(*row)
+
+    def _cluster(self, cell, category_id):
+        if category_id is None:
+            stats = list(cell.stats.values())
+        elif category_id in cell.stats:
+            stats = [cell.stats[category_id]]
+        else:
+            return None
+
+        count = sum(stat[0] for stat in stats)
+        if count == 1:
+            nko_id = next(
+                i for i, c in cell.ids.items()
+                if category_id is None or c == category_id
+            )
+            lat, lon, point_category = self._points[nko_id]
+            return {
+                'id': nko_id,
+                'category_id': point_category,
+                'count': 1,
+                'latitude': lat,
+                'longitude': lon,
+            }
+
+        if category_id is None:
+            categories = {c: stat[0] for c, stat in cell.stats.items()}
+        else:
+            categories = {category_id: count}
+        return {
+            'count': count,
+            'latitude': sum(stat[1] for stat in stats) / count,
+            'longitude': sum(stat[2] for stat in stats) / count,
+            'categories': categories,
+        }
+
+    def _collect(self, result, zoom, x0, y0, x1, y1, category_id):
+        cells = self._levels[zoom]
+        if (x1 - x0 + 1) * (y1 - y0 + 1) < len(cells):
+            keys = product(range(x0, x1 + 1), range(y0, y1 + 1))
+            found = (cells.get(key) for key in keys)
+        else:
+            found = (
+                cell for key, cell in cells.items()
+                if x0 <= key[0] <= x1 and y0 <= key[1] <= y1
+            )
+
+        for cell in found:
+            if cell is None:
+                continue
+            cluster = self._cluster(cell, category_id)
+            if cluster is not None:
+                result.append(cluster)
+
+    def clusters(self, boxes, zoom, category_id=None):
+        """Кластеры и одиночные точки в прямоугольниках ``boxes`` на зуме ``zoom``."""
+        zoom = max(MIN_ZOOM, min(zoom, MAX_ZOOM))
+        result = []
+        with self._lock:
+            self.sync()
+            for south, west, north, east in boxes:
+                x0, y0 = _cell_key(*project(north, west), zoom)
+                x1, y1 = _cell_key(*project(south, east), zoom)
+                self._collect(result, zoom, x0, y0, x1, y1, category_id)
+        return result
+
+    def tile_clusters(self, zoom, x, y):
+        """Кластеры тайла ``zoom/x/y``: сетка тайлов совпадает с сеткой ячеек."""
+        side = 1 << CELL_SHIFT
+        result = []
+        with self._lock:
+            self.sync()
+            self._collect(result, zoom, x * side, y * side, x * side + side - 1, y * side + side - 1, None)
+        return result
+
+
+cluster_index = ClusterIndex()
@@ -0,0 +1,157 @@
+"""Поток событий об изменениях на карте (Server-Sent Events).
+
+Когда НКО появляется на карте, меняется или пропадает с неё, после
+фиксации транзакции публикуется событие ``approved``, ``edited`` или
+``unapproved`` с id и полями маркера. Брокер живёт в памяти процесса:
+кадр SSE кодируется один раз и раскладывается по очередям всех
+подключённых браузеров, медленный клиент не задерживает остальных —
+при переполнении его очереди он получает событие ``sync``.
+
+Событие ``sync`` означает «догоните изменения через /api/nkos/?since=».
+Его поток шлёт после переподключения (события за время разрыва не
+хранятся) и когда версия набора данных изменилась без события в этом
+процессе — например, если модерация прошла в другом воркере.
+
+Под WSGI поток недоступен (эндпоинт отвечает 204), и карта сама раз
+в POLL_INTERVAL_MS (map.html) запрашивает дельту по версии.
+"""
+import asyncio
+import threading
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .cache import aget_version, dump_json, get_version
+from .models import NKO
+from .serializers import NKO_MARKER_FIELDS, serialize_nkos
+
+QUEUE_SIZE = 64
+HEARTBEAT_SECONDS = 15
+RETRY_MS = 5000
+
+
+def _frame(event_id, event_type, data):
+    return b'id: %d\nevent: %s\ndata: %s\n\n' % (event_id, event_type.encode(), dump_json(data))
+
+
+class _Subscription:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        self.overflowed = False
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def push(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # event loop подписчика уже закрыт
+            pass
+
+
+class EventBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._last_id = 0
+
+    def publish(self, event_type, data):
+        with self._lock:
+            self._last_id += 1
+            event = (data['version'], _frame(self._last_id, event_type, data))
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.push(event)
+
+    async def stream(self, reconnected=False):
+        """Кадры SSE для одного клиента."""
+        subscription = _Subscription()
+        with self._lock:
+            self._subscribers.add(subscription)
+        try:
+            version = await aget_version()
+            # id нужен, чтобы браузер прислал Last-Event-ID при переподключении.
+            yield b'id: %d\nretry: %d\n\n' % (self._last_id, RETRY_MS)
+            if reconnected:
+                yield _frame(self._last_id, 'sync', {'version': version})
+
+            while True:
+                try:
+                    event_version, frame = await asyncio.wait_for(
+                        subscription.queue.get(), HEARTBEAT_SECONDS,
+                    )
+                except asyncio.TimeoutError:
+                    current = await aget_version()
+                    if current != version:
+                        version = current
+                        yield _frame(self._last_id, 'sync', {'version': version})
+                    else:
+                        yield b': ping\n\n'
+                    continue
+
+                if subscription.overflowed:
+                    subscription.overflowed = False
+                    while not subscription.queue.empty():
+                        subscription.queue.get_nowait()
+                    version = await aget_version()
+                    yield _frame(self._last_id, 'sync', {'version': version})
+                    continue
+                version = event_version
+                yield frame
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscription)
+
+
+broker = EventBroker()
+
+
+def _publish(event_type, ids):
+    version = get_version()
+    if event_type == 'unapproved':
+        for nko_id in ids:
+            broker.publish(event_type, {'id': nko_id, 'version': version})
+        return
+
+    nkos = NKO.objects.filter(id__in=ids, is_approved=True)
+    for nko in serialize_nkos(nkos, NKO_MARKER_FIELDS):
+        broker.publish(event_type, {'id': nko['id'], 'version': version, 'nko': nko})
+
+
+def send_nko_events(event_type, ids):
+    """Публикует события по НКО ``ids`` после фиксации транзакции.
+
+    Для массовых операций (queryset.update) — сохранение через save()
+    публикует события само.
+    """
+    ids = list(ids)
+    if ids:
+        transaction.on_commit(lambda: _publish(event_type, ids))
+
+
+@receiver(pre_save, sender=NKO)
+def classify_change(sender, instance, **kwargs):
+    was_approved = getattr(instance, '_loaded_approved', False)
+    if instance.is_approved:
+        instance._event_type = 'edited' if was_approved else 'approved'
+    else:
+        instance._event_type = 'unapproved' if was_approved else None
+
+
+@receiver(post_save, sender=NKO)
+def publish_saved(sender, instance, **kwargs):
+    event_type = instance.__dict__.pop('_event_type', None)
+    if event_type:
+        send_nko_events(event_type, [instance.pk])
+
+
+@receiver(post_delete, sender=NKO)
+def publish_deleted(sender, instance, **kwargs):
+    if instance.is_approved:
+        send_nko_events('unapproved', [instance.pk])
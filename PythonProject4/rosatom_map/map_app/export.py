@@ -0,0 +1,146 @@
+"""Потоковая выгрузка реестра НКО: CSV, GeoJSON и NDJSON.
+
+НКО читаются из той же проекции с JOIN на категорию и город, что и
+публичные эндпоинты (см. serializers.py), но через ``iterator()``
+пачками по EXPORT_CHUNK_SIZE строк, а ответ отдаётся кусками примерно
+по BUFFER_SIZE байт. Память не зависит от размера реестра, а начало
+файла (заголовок CSV, начало FeatureCollection) уходит клиенту ещё до
+запроса к БД.
+
+Для каждого формата есть синхронный и асинхронный поток: Django целиком
+буферизует StreamingHttpResponse, если тип итератора не совпадает с
+сервером (WSGI или ASGI), поэтому представление выбирает поток по запросу.
+"""
+import csv
+import io
+import json
+
+from .models import NKO
+from .serializers import NKO_FIELDS, aiter_nkos, iter_nkos
+
+EXPORT_CHUNK_SIZE = 2000
+BUFFER_SIZE = 64 * 1024
+EXPORT_FIELDS = NKO_FIELDS + ('city_id', 'external_id')
+# Excel и LibreOffice выполняют ячейку, начинающуюся с этих символов, как формулу
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _json(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def _cell(value):
+    # названия, адреса и описания присылают пользователи: «=HYPERLINK(...)»
+    # в ячейке не должно стать формулой (CSV injection)
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+class CSVFormat:
+    content_type = 'text/csv; charset=utf-8'
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def _line(self, values):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.writer.writerow(values)
+        return self.buffer.getvalue().encode('utf-8')
+
+    def header(self):
+        # BOM: иначе Excel открывает UTF-8 как cp1251
+        return b'\xef\xbb\xbf' + self._line(self.fields)
+
+    def item(self, item):
+        return self._line([_cell(item[field]) for field in self.fields])
+
+    def footer(self):
+        return b''
+
+
+class GeoJSONFormat:
+    content_type = 'application/geo+json'
+
+    def __init__(self, fields):
+        self.properties = [field for field in fields if field not in ('id', 'latitude', 'longitude')]
+        self.separator = ''
+
+    def header(self):
+        return b'{"type":"FeatureCollection","features":['
+
+    def item(self, item):
+        feature = _json({
+            'type': 'Feature',
+            'id': item['id'],
+            'geometry': {'type': 'Point', 'coordinates': [item['longitude'], item['latitude']]},
+            'properties': {field: item[field] for field in self.properties},
+        })
+        line, self.separator = self.separator + feature, ',\n'
+        return line.encode('utf-8')
+
+    def footer(self):
+        return b']}\n'
+
+
+class NDJSONFormat:
+    content_type = 'application/x-ndjson'
+
+    def __init__(self, fields):
+        pass
+
+    def header(self):
+        return b''
+
+    def item(self, item):
+        return (_json(item) + '\n').encode('utf-8')
+
+    def footer(self):
+        return b''
+
+
+# формат -> (класс, расширение файла)
+EXPORT_FORMATS = {
+    'csv': (CSVFormat, 'csv'),
+    'geojson': (GeoJSONFormat, 'geojson'),
+    'ndjson': (NDJSONFormat, 'ndjson'),
+}
+
+
+def export_queryset(include_unapproved=False):
+    """НКО и поля выгрузки: публичная — только одобренные, для персонала — все."""
+    if include_unapproved:
+        return NKO.objects.all(), EXPORT_FIELDS + ('is_approved',)
+    return NKO.objects.filter(is_approved=True), EXPORT_FIELDS
+
+
+def stream_nkos(queryset, export_format, fields=EXPORT_FIELDS):
+    """Куски файла выгрузки (bytes) в порядке id."""
+    encoder = EXPORT_FORMATS[export_format][0](fields)
+    buffer = bytearray(encoder.header())
+    if buffer:
+        yield bytes(buffer)
+        buffer.clear()
+    for item in iter_nkos(queryset.order_by('id'), fields, EXPORT_CHUNK_SIZE):
+        buffer += encoder.item(item)
+        if len(buffer) >= BUFFER_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    yield bytes(buffer + encoder.footer())
+
+
+async def astream_nkos(queryset, export_format, fields=EXPORT_FIELDS):
+    encoder = EXPORT_FORMATS[export_format][0](fields)
+    buffer = bytearray(encoder.header())
+    if buffer:
+        yield bytes(buffer)
+        buffer.clear()
+    async for item in aiter_nkos(queryset.order_by('id'), fields, EXPORT_CHUNK_SIZE):
+        buffer += encoder.item(item)
+        if len(buffer) >= BUFFER_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    yield bytes(buffer + encoder.footer())
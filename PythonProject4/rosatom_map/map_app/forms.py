@@ -1,7 +1,8 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
-from .models import UserProfile, City
+from .models import UserProfile, City, NKOCategory
+from .moderation import decode_cursor
 
 
 class CustomUserCreationForm(UserCreationForm):
@@ -30,4 +31,28 @@ class UserProfileForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['city'].queryset = City.objects.all()
\ No newline at end of file
+        self.fields['city'].queryset = City.objects.all()
+
+
+class ModerationFilterForm(forms.Form):
+    status = forms.ChoiceField(
+        choices=[('pending', 'На модерации'), ('approved', 'Одобренные')],
+        required=False,
+    )
+    city = forms.ModelChoiceField(queryset=City.objects.order_by('name'), required=False, empty_label='Все города')
+    category = forms.ModelChoiceField(
+        queryset=NKOCategory.objects.order_by('name'), required=False, empty_label='Все категории',
+    )
+    author = forms.CharField(required=False, widget=forms.TextInput(attrs={'placeholder': 'Логин автора'}))
+    date_from = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    date_to = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    cursor = forms.CharField(required=False)
+
+    def clean_cursor(self):
+        value = self.cleaned_data['cursor']
+        if not value:
+            return None
+        try:
+            return decode_cursor(value)
+        except ValueError:
+            raise forms.ValidationError('Некорректный курсор')
@@ -0,0 +1,101 @@
+"""Пространственный индекс НКО: ячейки квадродерева по координатам.
+
+Каждой НКО присваивается номер ячейки ``geo_cell`` — Z-код (Morton)
+на сетке 2^GEO_CELL_LEVEL x 2^GEO_CELL_LEVEL в координатах широта/долгота.
+Ячейки с общим префиксом лежат в непрерывном диапазоне номеров, поэтому
+видимую область карты можно покрыть небольшим числом диапазонов
+и искать по обычному индексу БД вместо полного сканирования таблицы.
+"""
+import math
+
+GEO_CELL_LEVEL = 16
+MAX_COVER_CELLS = 16
+
+
+class BBoxError(ValueError):
+    pass
+
+
+def _to_grid(lat, lon, level):
+    if not (math.isfinite(lat) and math.isfinite(lon)):
+        raise ValueError('координаты должны быть конечными числами')
+    n = 1 << level
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((lat + 90.0) / 180.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _interleave(x, y, level):
+    key = 0
+    for bit in range(level):
+        key |= ((x >> bit) & 1) << (2 * bit)
+        key |= ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+def geo_cell(lat, lon):
+    """Номер ячейки самого мелкого уровня для точки."""
+    x, y = _to_grid(lat, lon, GEO_CELL_LEVEL)
+    return _interleave(x, y, GEO_CELL_LEVEL)
+
+
+def normalize_lon(lon):
+    return (lon + 180.0) % 360.0 - 180.0
+
+
+def parse_bbox(value):
+    """Разбирает ``south,west,north,east`` и возвращает список прямоугольников.
+
+    Область, пересекающая 180-й меридиан, делится на две части.
+    """
+    try:
+        south, west, north, east = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        raise BBoxError('bbox должен иметь вид south,west,north,east')
+    # nan проходит все сравнения ниже, а inf не разложить на ячейки
+    if not all(map(math.isfinite, (south, west, north, east))):
+        raise BBoxError('bbox должен состоять из конечных чисел')
+
+    if south > north:
+        south, north = north, south
+    south, north = max(south, -90.0), min(north, 90.0)
+
+    if east - west >= 360.0:
+        return [(south, -180.0, north, 180.0)]
+
+    west, east = normalize_lon(west), normalize_lon(east)
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def cover_level(zoom=None):
+    """Самый мелкий уровень ячеек, который имеет смысл при данном зуме."""
+    if zoom is None:
+        return GEO_CELL_LEVEL
+    return max(0, min(GEO_CELL_LEVEL, zoom + 2))
+
+
+def cell_ranges(south, west, north, east, zoom=None):
+    """Покрывает прямоугольник диапазонами ``[start, end)`` номеров ячеек."""
+    for level in range(cover_level(zoom), -1, -1):
+        x0, y0 = _to_grid(south, west, level)
+        x1, y1 = _to_grid(north, east, level)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= MAX_COVER_CELLS:
+            break
+
+    shift = 2 * (GEO_CELL_LEVEL - level)
+    prefixes = sorted(
+        _interleave(x, y, level)
+        for x in range(x0, x1 + 1)
+        for y in range(y0, y1 + 1)
+    )
+
+    ranges = []
+    for prefix in prefixes:
+        start, end = prefix << shift, (prefix + 1) << shift
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return [tuple(r) for r in ranges]
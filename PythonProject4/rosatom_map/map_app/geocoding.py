@@ -0,0 +1,255 @@
+"""Геокодирование адресов НКО в фоне.
+
+Если при добавлении или правке НКО координаты не указаны, точка берётся
+из кеша адресов, а если адреса там нет — ставится в центр города, и НКО
+помечается ``geocode_pending``. Форма никогда не ждёт геокодер: адреса
+пачками разрешает фоновая задача geocode_pending_nkos (или команда
+geocode_nko) и переносит точки на карте. Задача обрабатывает одну пачку
+и ставит в очередь следующую: проход по тысячам адресов при RATE=1 идёт
+часами, а каждая пачка укладывается в аренду задачи (см. tasks.py).
+Ключ задачи не даёт двум воркерам геокодировать одновременно.
+
+Результаты хранятся в таблице GeocodeCache по нормализованному адресу
+(регион, город и адрес без регистра, пунктуации и сокращений), в том
+числе «не найдено» — такие адреса повторно не запрашиваются.
+
+Геокодер подключается настройкой GEOCODER, как кеш в CACHES: BACKEND —
+путь к классу, остальные ключи — параметры конструктора. По умолчанию
+это Nominatim (OpenStreetMap) не чаще RATE запросов в секунду.
+"""
+import json
+import logging
+import re
+import time
+from abc import ABC, abstractmethod
+from urllib.error import URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .events import send_nko_events
+from .geo import geo_cell
+from .models import GeocodeCache, NKO
+from .signals import send_nkos_changed
+from .tasks import enqueue, task
+from .tiles import invalidate_points
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 500
+# пачка фоновой задачи: при RATE=1 около минуты запросов
+GEOCODE_BATCH_SIZE = 50
+# адреса, на которых геокодер ошибся, — ещё GEOCODE_PASSES проходов с растущей паузой
+GEOCODE_PASSES = 5
+GEOCODE_RETRY_DELAY = 10 * 60
+STATS = ('moved', 'not_found', 'failed', 'requests')
+_WORD_RE = re.compile(r'[\w/-]+')
+_ABBREVIATIONS = {
+    'ул': 'улица', 'пр': 'проспект', 'пр-т': 'проспект', 'просп': 'проспект', 'пер': 'переулок',
+    'пл': 'площадь', 'наб': 'набережная', 'ш': 'шоссе', 'б-р': 'бульвар', 'бул': 'бульвар',
+    'мкр': 'микрорайон', 'мкрн': 'микрорайон', 'корп': 'корпус', 'к': 'корпус', 'стр': 'строение',
+}
+# не различают адреса: «г. Обнинск, д. 5» и «Обнинск, 5» — один адрес
+_NOISE = {'г', 'город', 'д', 'дом', 'россия', 'рф'}
+
+
+class GeocodingError(Exception):
+    """Геокодер недоступен или ответил ошибкой; адрес нужно запросить позже."""
+
+
+class Geocoder(ABC):
+    def __init__(self, rate=1.0, **options):
+        self.rate = rate
+
+    @abstractmethod
+    def geocode(self, query):
+        """(широта, долгота) или None, если адрес не найден."""
+
+
+class NominatimGeocoder(Geocoder):
+    def __init__(self, url='https://nominatim.openstreetmap.org/search', user_agent='rosatom-map',
+                 timeout=10, **options):
+        super().__init__(**options)
+        self.url = url
+        self.user_agent = user_agent
+        self.timeout = timeout
+
+    def geocode(self, query):
+        params = urlencode({'q': query, 'format': 'jsonv2', 'limit': 1, 'countrycodes': 'ru'})
+        request = Request(f'{self.url}?{params}', headers={
+            'User-Agent': self.user_agent,
+            'Accept-Language': 'ru',
+        })
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                results = json.load(response)
+            if not results:
+                return None
+            return float(results[0]['lat']), float(results[0]['lon'])
+        except (URLError, OSError, ValueError, KeyError, IndexError, TypeError) as error:
+            raise GeocodingError(f'{query}: {error}') from error
+
+
+def get_geocoder():
+    options = dict(settings.GEOCODER)
+    backend = import_string(options.pop('BACKEND'))
+    return backend(**{key.lower(): value for key, value in options.items()})
+
+
+class RateLimiter:
+    """Не больше ``rate`` вызовов wait() в секунду."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = 0.0
+
+    def wait(self):
+        now = time.monotonic()
+        if now < self.next_at:
+            time.sleep(self.next_at - now)
+            now = self.next_at
+        self.next_at = now + self.interval
+
+
+def _words(text):
+    return [_ABBREVIATIONS.get(word, word) for word in _WORD_RE.findall(text.casefold().replace('ё', 'е'))]
+
+
+def normalize_address(address, city_name, region):
+    """Ключ кеша адресов; None, если адреса нет или он слишком длинный."""
+    place = _words(f'{region} {city_name}')
+    words = [word for word in _words(address) if word not in _NOISE and word not in place]
+    if not words:
+        return None
+    key = ' '.join(place + words)
+    return key if len(key) <= MAX_KEY_LENGTH else None
+
+
+def initial_point(city, address):
+    """Точка НКО без координат в форме: (широта, долгота, ждёт ли геокодирования).
+
+    Один запрос к кешу адресов; при промахе — центр города до geocode_nko.
+    """
+    key = normalize_address(address, city.name, city.region)
+    if key is None:
+        return city.latitude, city.longitude, False
+    entry = GeocodeCache.objects.filter(address=key).first()
+    if entry is None:
+        return city.latitude, city.longitude, True
+    if entry.latitude is None:
+        return city.latitude, city.longitude, False
+    return entry.latitude, entry.longitude, False
+
+
+def resolve_batch(geocoder, limiter, after_id=0, batch_size=100):
+    """Разрешает до ``batch_size`` ждущих НКО с id больше ``after_id``.
+
+    Возвращает счётчики и id последней просмотренной НКО (None — очередь
+    пуста). НКО, адрес которых геокодер не смог обработать, остаются в
+    очереди до следующего прохода.
+    """
+    rows = list(
+        NKO.objects.filter(geocode_pending=True, id__gt=after_id).order_by('id').values_list(
+            'id', 'address', 'city_id', 'city__name', 'city__region', 'latitude', 'longitude',
+        )[:batch_size]
+    )
+    stats = dict.fromkeys(STATS, 0)
+    if not rows:
+        return stats, None
+
+    keys = {row[0]: normalize_address(row[1], row[3], row[4]) for row in rows}
+    points = {}
+    for address, latitude, longitude in GeocodeCache.objects.filter(
+        address__in={key for key in keys.values() if key},
+    ).values_list('address', 'latitude', 'longitude'):
+        points[address] = None if latitude is None else (latitude, longitude)
+
+    # промахи кеша: один запрос к геокодеру на адрес
+    failed = set()
+    resolved = []
+    for nko_id, address, _, city_name, region, _, _ in rows:
+        key = keys[nko_id]
+        if key is None or key in points or key in failed:
+            continue
+        limiter.wait()
+        stats['requests'] += 1
+        try:
+            points[key] = geocoder.geocode(', '.join(filter(None, (address, city_name, region))))
+        except GeocodingError as error:
+            logger.warning('Геокодирование не удалось: %s', error)
+            failed.add(key)
+            continue
+        point = points[key]
+        resolved.append(GeocodeCache(
+            address=key, latitude=point and point[0], longitude=point and point[1],
+        ))
+    GeocodeCache.objects.bulk_create(
+        resolved, update_conflicts=True, unique_fields=['address'],
+        update_fields=['latitude', 'longitude', 'resolved_at'],
+    )
+
+    now = timezone.now()
+    moved_from = {}
+    with transaction.atomic():
+        for nko_id, address, city_id, _, _, latitude, longitude in rows:
+            key = keys[nko_id]
+            if key in failed:
+                stats['failed'] += 1
+                continue
+            point = points.get(key)
+            fields = {'geocode_pending': False}
+            if point is not None and point != (latitude, longitude):
+                fields.update(latitude=point[0], longitude=point[1], geo_cell=geo_cell(*point), updated_at=now)
+            # НКО могли поправить, пока шёл запрос к геокодеру: тогда её адрес уже другой
+            if not NKO.objects.filter(id=nko_id, geocode_pending=True, address=address, city_id=city_id).update(**fields):
+                continue
+            if 'latitude' in fields:
+                moved_from[nko_id] = (latitude, longitude)
+            elif point is None:
+                stats['not_found'] += 1
+
+        stats['moved'] = len(moved_from)
+        send_nkos_changed(moved_from)
+        send_nko_events('edited', moved_from)
+        points_before = list(moved_from.values())
+        transaction.on_commit(lambda: invalidate_points(points_before))
+    return stats, rows[-1][0]
+
+
+def resolve_pending(geocoder=None, batch_size=100, on_batch=None):
+    """Один проход по всей очереди геокодирования; суммарные счётчики."""
+    geocoder = geocoder or get_geocoder()
+    limiter = RateLimiter(geocoder.rate)
+    totals = dict.fromkeys(STATS, 0)
+    after_id = 0
+    while after_id is not None:
+        stats, after_id = resolve_batch(geocoder, limiter, after_id, batch_size)
+        for key, value in stats.items():
+            totals[key] += value
+        if on_batch and any(stats.values()):
+            on_batch(stats)
+    return totals
+
+
+@task()
+def geocode_pending_nkos(after_id=0, failed=0, passes=1):
+    """Одна пачка очереди геокодирования; продолжение ставит в очередь сама."""
+    geocoder = get_geocoder()
+    limiter = RateLimiter(geocoder.rate)
+    stats, last_id = resolve_batch(geocoder, limiter, after_id, GEOCODE_BATCH_SIZE)
+    if stats['requests']:
+        # следующая пачка может начаться сразу и в другом процессе
+        limiter.wait()
+    failed += stats['failed']
+    if last_id is not None:
+        schedule_geocoding(after_id=last_id, failed=failed, passes=passes)
+    elif failed and passes < GEOCODE_PASSES:
+        schedule_geocoding(delay=GEOCODE_RETRY_DELAY * passes, passes=passes + 1)
+
+
+def schedule_geocoding(delay=0, **kwargs):
+    enqueue(geocode_pending_nkos, key='geocode', delay=delay, **kwargs)
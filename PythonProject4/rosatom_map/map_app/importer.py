@@ -0,0 +1,287 @@
+"""Массовая загрузка реестров НКО (команда import_nko).
+
+Файл читается потоково (CSV, JSON-массив или JSON Lines, XLSX) пачками
+по ``batch_size`` записей, поэтому память не зависит от размера реестра.
+Пачка проверяется (при ``workers`` > 1 — в отдельных процессах), города
+и категории находятся по заранее загруженным словарям, а НКО пишутся
+одним bulk_create с ``update_conflicts`` по external_id в своей
+транзакции: повторная загрузка того же реестра обновляет записи, а не
+дублирует их. save() и сигналы на каждую строку не вызываются — кеш,
+снимки и тайлы обновляются один раз после загрузки.
+
+Колонки: external_id, name, category, city, region (если название города
+неоднозначно), description, address, phone, website, vk_link, latitude,
+longitude. Без координат НКО ставится в центр города, а адреса
+разрешает фоновая задача геокодирования.
+"""
+import csv
+import json
+import multiprocessing
+import re
+import time
+from collections import deque
+from itertools import islice
+
+import django
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import transaction
+
+from .geo import geo_cell
+from .models import City, NKOCategory, NKO
+from .geocoding import schedule_geocoding
+from .signals import send_all_nkos_changed
+from .tiles import TileSet
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+FORMATS = ('csv', 'json', 'xlsx')
+BATCH_SIZE = 1000
+# обновляются у существующих НКО; created_by и created_at остаются прежними
+UPDATE_FIELDS = [
+    'name', 'category', 'city', 'description', 'address', 'phone', 'website', 'vk_link',
+    'latitude', 'longitude', 'geo_cell', 'geocode_pending', 'updated_at',
+]
+TEXT_FIELDS = {
+    'external_id': 64, 'name': 200, 'category': 100, 'city': 100, 'region': 100,
+    'description': None, 'address': None, 'phone': 20, 'website': 200, 'vk_link': 200,
+}
+REQUIRED_FIELDS = ('external_id', 'name', 'category', 'city')
+
+_SEPARATORS = re.compile(r'[\s,]*')
+_validate_url = URLValidator()
+
+
+def read_csv(file, delimiter=','):
+    yield from csv.DictReader(file, delimiter=delimiter)
+
+
+def read_json(file, chunk_size=64 * 1024):
+    """Объекты JSON-массива или JSON Lines по одному, без чтения файла целиком."""
+    decoder = json.JSONDecoder()
+    buffer, pos, eof, array = '', 0, False, None
+    while True:
+        pos = _SEPARATORS.match(buffer, pos).end()
+        if array is None and pos < len(buffer):
+            array = buffer[pos] == '['
+            pos += array
+            continue
+        if array and buffer.startswith(']', pos):
+            return
+        try:
+            record, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if not eof:
+                chunk = file.read(chunk_size)
+                buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+                continue
+            if pos == len(buffer) and not array:
+                return
+            raise
+        yield record
+
+
+def read_xlsx(path):
+    """Строки первого листа как словари по заголовкам из первой строки."""
+    if openpyxl is None:
+        raise ImportError('Для загрузки XLSX установите openpyxl')
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = ['' if cell is None else str(cell).strip() for cell in next(rows, ())]
+        for row in rows:
+            if any(cell is not None for cell in row):
+                yield dict(zip(header, row))
+    finally:
+        workbook.close()
+
+
+def _key(name):
+    return ' '.join(str(name).split()).casefold()
+
+
+def clean_record(record):
+    """Проверенные поля записи; ValueError с описанием ошибки."""
+    if not isinstance(record, dict):
+        raise ValueError('запись должна быть объектом')
+    cleaned = {}
+    for field, max_length in TEXT_FIELDS.items():
+        value = record.get(field)
+        value = '' if value is None else str(value).strip()
+        if max_length and len(value) > max_length:
+            raise ValueError(f'{field}: длиннее {max_length} символов')
+        cleaned[field] = value
+    missing = [field for field in REQUIRED_FIELDS if not cleaned[field]]
+    if missing:
+        raise ValueError(f'не заполнено: {", ".join(missing)}')
+    for field in ('website', 'vk_link'):
+        if cleaned[field]:
+            try:
+                _validate_url(cleaned[field])
+            except ValidationError:
+                raise ValueError(f'{field}: некорректный адрес')
+
+    point = [record.get(field) for field in ('latitude', 'longitude')]
+    if all(value in (None, '') for value in point):
+        cleaned['latitude'] = cleaned['longitude'] = None
+        return cleaned
+    try:
+        latitude, longitude = (float(str(value).replace(',', '.')) for value in point)
+    except ValueError:
+        raise ValueError('latitude и longitude должны быть числами')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('координаты вне допустимого диапазона')
+    cleaned['latitude'], cleaned['longitude'] = latitude, longitude
+    return cleaned
+
+
+def clean_chunk(chunk):
+    """[(номер, запись)] -> [(номер, поля или None, ошибка или None)]."""
+    results = []
+    for number, record in chunk:
+        try:
+            results.append((number, clean_record(record), None))
+        except ValueError as error:
+            results.append((number, None, str(error)))
+    return results
+
+
+def _cleaned_chunks(chunks, workers):
+    if workers <= 1:
+        for chunk in chunks:
+            yield clean_chunk(chunk)
+        return
+    # Не больше двух пачек на процесс в очереди: чтение файла не убегает
+    # вперёд записи в БД, и память остаётся постоянной.
+    with multiprocessing.Pool(workers, initializer=django.setup) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(clean_chunk, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+class Resolver:
+    """Города и категории по названиям (без учёта регистра и лишних пробелов)."""
+
+    def __init__(self):
+        self.categories = {_key(category.name): category for category in NKOCategory.objects.all()}
+        self.cities = {}
+        self.cities_by_region = {}
+        for city in City.objects.all():
+            # одинаковые названия в разных регионах различаются только по region
+            name = _key(city.name)
+            self.cities[name] = None if name in self.cities else city
+            self.cities_by_region[name, _key(city.region)] = city
+
+    def category(self, name):
+        try:
+            return self.categories[_key(name)]
+        except KeyError:
+            raise ValueError(f'неизвестная категория: {name}')
+
+    def city(self, name, region=''):
+        if region:
+            city = self.cities_by_region.get((_key(name), _key(region)))
+        else:
+            city = self.cities.get(_key(name), False)
+            if city is None:
+                raise ValueError(f'город {name} есть в нескольких регионах, укажите region')
+        if not city:
+            raise ValueError(f'неизвестный город: {name}')
+        return city
+
+
+def _write_batch(nkos, approve, tiles):
+    """Пишет пачку одной транзакцией; (создано, обновлено).
+
+    Старые и новые точки НКО добавляются в ``tiles`` — эти тайлы устареют.
+    """
+    update_fields = UPDATE_FIELDS + ['is_approved'] if approve else UPDATE_FIELDS
+    with transaction.atomic():
+        old_points = list(
+            NKO.objects.filter(external_id__in=[nko.external_id for nko in nkos]).values_list('latitude', 'longitude')
+        )
+        NKO.objects.bulk_create(
+            nkos, update_conflicts=True, unique_fields=['external_id'], update_fields=update_fields,
+        )
+    tiles.add_points(old_points)
+    tiles.add_points((nko.latitude, nko.longitude) for nko in nkos)
+    return len(nkos) - len(old_points), len(old_points)
+
+
+def import_nkos(records, author, approve=False, batch_size=BATCH_SIZE, workers=1,
+                on_progress=None, on_error=None):
+    """Загружает записи реестра; возвращает счётчики processed/created/updated/skipped.
+
+    Новые НКО создаются от имени ``author`` и попадают на модерацию, если
+    не задан ``approve`` (тогда одобряются и новые, и обновлённые).
+    """
+    resolver = Resolver()
+    stats = dict.fromkeys(('processed', 'created', 'updated', 'skipped'), 0)
+    started = time.perf_counter()
+    geocode = False
+    tiles = TileSet()
+    numbered = enumerate(records, start=1)
+    chunks = iter(lambda: list(islice(numbered, batch_size)), [])
+    try:
+        for chunk in _cleaned_chunks(chunks, workers):
+            # повтор external_id в пачке: побеждает последняя запись
+            nkos = {}
+            for number, cleaned, error in chunk:
+                if cleaned is not None:
+                    try:
+                        nkos[cleaned['external_id']] = _build(cleaned, resolver, author, approve)
+                    except ValueError as problem:
+                        error = str(problem)
+                if error is not None:
+                    stats['skipped'] += 1
+                    if on_error:
+                        on_error(number, error)
+            if nkos:
+                geocode = geocode or any(nko.geocode_pending for nko in nkos.values())
+                created, updated = _write_batch(list(nkos.values()), approve, tiles)
+                stats['created'] += created
+                stats['updated'] += updated
+            stats['processed'] += len(chunk)
+            stats['seconds'] = time.perf_counter() - started
+            if on_progress:
+                on_progress(stats)
+    finally:
+        if stats['created'] or stats['updated']:
+            send_all_nkos_changed(tiles)
+        if geocode:
+            schedule_geocoding()
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+def _build(cleaned, resolver, author, approve):
+    city = resolver.city(cleaned['city'], cleaned['region'])
+    latitude, longitude = cleaned['latitude'], cleaned['longitude']
+    geocode_pending = latitude is None and bool(cleaned['address'])
+    if latitude is None:
+        latitude, longitude = city.latitude, city.longitude
+    # bulk_create не вызывает NKO.save(), geo_cell считаем сами
+    return NKO(
+        external_id=cleaned['external_id'],
+        name=cleaned['name'],
+        category=resolver.category(cleaned['category']),
+        city=city,
+        description=cleaned['description'],
+        address=cleaned['address'],
+        phone=cleaned['phone'],
+        website=cleaned['website'],
+        vk_link=cleaned['vk_link'],
+        latitude=latitude,
+        longitude=longitude,
+        geo_cell=geo_cell(latitude, longitude),
+        geocode_pending=geocode_pending,
+        created_by=author,
+        is_approved=approve,
+    )
@@ -0,0 +1,104 @@
+import io
+import json
+import platform
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from map_app.benchmark import run_benchmark
+
+COMPARED = ('p50_ms', 'p99_ms', 'queries', 'response_bytes', 'peak_memory_kb')
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the public map endpoints on synthetic datasets in a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000', help='NKO counts, comma-separated')
+        parser.add_argument('--requests', type=int, default=50, help='Warm requests per endpoint')
+        parser.add_argument('--output', help='Results JSON (default: benchmarks/benchmark-<time>.json)')
+        parser.add_argument('--compare', help='Previous results JSON to compare with')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = sorted({int(size) for size in options['sizes'].split(',')})
+        except ValueError:
+            raise CommandError('--sizes: ожидаются целые числа через запятую')
+        if sizes[0] < 1 or options['requests'] < 1:
+            raise CommandError('Размеры наборов и число запросов должны быть положительными')
+        previous = self.load(options['compare']) if options['compare'] else None
+
+        started = datetime.now()
+        results = self.run(sizes, options['requests'])
+        report = {
+            'created_at': started.isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'requests': options['requests'],
+            'results': results,
+        }
+
+        output = Path(options['output'] or settings.BASE_DIR / 'benchmarks' / f'benchmark-{started:%Y%m%d-%H%M%S}.json')
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+        if previous:
+            self.compare(previous, results)
+        self.stdout.write(self.style.SUCCESS(f'Результаты записаны в {output}'))
+
+    def load(self, path):
+        try:
+            return json.loads(Path(path).read_text(encoding='utf-8'))['results']
+        except (OSError, ValueError, KeyError) as error:
+            raise CommandError(f'Не удалось прочитать {path}: {error}')
+
+    def run(self, sizes, requests):
+        # Отдельная тестовая БД, кеш в памяти процесса и временные каталоги:
+        # рабочие данные, кеш и снимки не затрагиваются.
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with tempfile.TemporaryDirectory() as directory, override_settings(
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                NKO_SNAPSHOT_DIR=f'{directory}/snapshots',
+                TILE_CACHE_DIR=f'{directory}/tiles',
+                DEBUG=False,
+            ):
+                with redirect_stdout(io.StringIO()):
+                    call_command('load_initial_data')
+                return run_benchmark(sizes, requests, progress=self.report)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def report(self, result):
+        self.stdout.write(
+            f'{result["size"]:>7} {result["endpoint"]:<17} '
+            f'холодный {result["cold_ms"]:>9.1f} мс / {result["cold_queries"]} SQL, '
+            f'p50 {result["p50_ms"]:>7.2f} мс, p99 {result["p99_ms"]:>7.2f} мс, '
+            f'{result["queries"]} SQL, {result["response_bytes"]} байт, '
+            f'пик памяти {result["peak_memory_kb"]} КБ'
+        )
+
+    def compare(self, previous, results):
+        previous = {(result['size'], result['endpoint']): result for result in previous}
+        self.stdout.write('Сравнение с предыдущим прогоном:')
+        for result in results:
+            before = previous.get((result['size'], result['endpoint']))
+            if before is None:
+                continue
+            changes = []
+            for key in COMPARED:
+                old, new = before.get(key), result[key]
+                if old == new or old is None:
+                    continue
+                delta = f' ({(new - old) / old:+.0%})' if old else ''
+                changes.append(f'{key} {old} → {new}{delta}')
+            self.stdout.write(f'{result["size"]:>7} {result["endpoint"]:<17} {", ".join(changes) or "без изменений"}')
@@ -0,0 +1,31 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from map_app.export import EXPORT_FORMATS, export_queryset, stream_nkos
+
+
+class Command(BaseCommand):
+    help = 'Export the NKO registry to CSV, GeoJSON or NDJSON (streamed, constant memory)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=EXPORT_FORMATS, help='Default: from the file extension')
+        parser.add_argument('--all', action='store_true', help='Include NKOs awaiting moderation')
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        export_format = options['format'] or path.suffix.lower().lstrip('.')
+        if export_format not in EXPORT_FORMATS:
+            raise CommandError(f'Неизвестный формат {export_format!r}, укажите --format')
+
+        queryset, fields = export_queryset(options['all'])
+        started = time.perf_counter()
+        size = 0
+        with path.open('wb') as file:
+            for chunk in stream_nkos(queryset, export_format, fields):
+                file.write(chunk)
+                size += len(chunk)
+        self.stdout.write(self.style.SUCCESS(
+            f'{path}: {size} байт за {time.perf_counter() - started:.1f} с'
+        ))
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+from map_app.geocoding import get_geocoder, resolve_pending
+
+
+class Command(BaseCommand):
+    help = 'Resolve addresses of NKOs placed at the city centre (geocoding worker)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new NKOs')
+        parser.add_argument('--interval', type=float, default=60, help='Seconds between polls with --loop')
+
+    def handle(self, *args, **options):
+        geocoder = get_geocoder()
+        while True:
+            totals = resolve_pending(geocoder, options['batch_size'], on_batch=self.report)
+            if not options['loop']:
+                break
+            # новые НКО и адреса, которые не удалось разрешить, — следующим проходом
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово: перенесено {totals["moved"]}, не найдено {totals["not_found"]}, '
+            f'ошибок {totals["failed"]}'
+        ))
+
+    def report(self, stats):
+        self.stdout.write(
+            f'Перенесено {stats["moved"]}, не найдено {stats["not_found"]}, '
+            f'ошибок {stats["failed"]}, запросов к геокодеру {stats["requests"]}'
+        )
@@ -0,0 +1,89 @@
+import json
+import time
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from map_app.importer import BATCH_SIZE, FORMATS, import_nkos, read_csv, read_json, read_xlsx
+
+MAX_REPORTED_ERRORS = 20
+
+
+class Command(BaseCommand):
+    help = 'Import (upsert by external_id) an NKO registry from CSV, JSON/JSON Lines or XLSX'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS, help='Default: from the file extension')
+        parser.add_argument('--author', help='Username for new NKOs (default: first superuser)')
+        parser.add_argument('--approve', action='store_true', help='Publish imported NKOs without moderation')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--workers', type=int, default=1, help='Processes for row validation')
+        parser.add_argument('--delimiter', default=',', help='CSV delimiter')
+        parser.add_argument('--encoding', default='utf-8-sig', help='CSV/JSON encoding')
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        if not path.is_file():
+            raise CommandError(f'Файл не найден: {path}')
+        file_format = options['format'] or path.suffix.lower().lstrip('.').replace('jsonl', 'json')
+        if file_format not in FORMATS:
+            raise CommandError(f'Неизвестный формат {file_format!r}, укажите --format')
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size и --workers должны быть положительными')
+        author = self.get_author(options['author'])
+
+        self.errors = 0
+        self.last_report = time.monotonic()
+        try:
+            if file_format == 'xlsx':
+                stats = self.run(read_xlsx(path), author, options)
+            else:
+                with path.open(encoding=options['encoding'], newline='') as file:
+                    records = read_csv(file, options['delimiter']) if file_format == 'csv' else read_json(file)
+                    stats = self.run(records, author, options)
+        except (ImportError, UnicodeDecodeError, json.JSONDecodeError) as error:
+            raise CommandError(f'Не удалось прочитать {path}: {error}')
+
+        if self.errors > MAX_REPORTED_ERRORS:
+            self.stderr.write(f'... и ещё {self.errors - MAX_REPORTED_ERRORS} ошибок')
+        self.stdout.write(self.style.SUCCESS(
+            f'Создано {stats["created"]}, обновлено {stats["updated"]}, пропущено {stats["skipped"]} '
+            f'из {stats["processed"]} записей за {stats["seconds"]:.1f} с '
+            f'({stats["processed"] / max(stats["seconds"], 1e-9):.0f} записей/с)'
+        ))
+
+    def get_author(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f'Пользователь {username} не найден')
+        author = User.objects.filter(is_superuser=True).order_by('id').first()
+        if author is None:
+            raise CommandError('Нет суперпользователя, укажите --author')
+        return author
+
+    def run(self, records, author, options):
+        return import_nkos(
+            records, author,
+            approve=options['approve'],
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            on_progress=self.progress,
+            on_error=self.error,
+        )
+
+    def progress(self, stats):
+        # не чаще раза в секунду
+        now = time.monotonic()
+        if now - self.last_report >= 1:
+            self.last_report = now
+            self.stdout.write(
+                f'{stats["processed"]} записей, {stats["processed"] / stats["seconds"]:.0f} записей/с'
+            )
+
+    def error(self, number, message):
+        self.errors += 1
+        if self.errors <= MAX_REPORTED_ERRORS:
+            self.stderr.write(f'Запись {number}: {message}')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from map_app.snapshot import SNAPSHOTS, snapshot_dir, write_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the precompressed snapshots of the public NKO dataset'
+
+    def handle(self, *args, **options):
+        directory = snapshot_dir()
+        # Снимки пересобираются с нуля: старые версии удаляем целиком.
+        for name in SNAPSHOTS.values():
+            for path in directory.glob(f'{name}*.json*'):
+                path.unlink(missing_ok=True)
+
+        for name in SNAPSHOTS.values():
+            version = write_snapshot(name)
+            for path in sorted(directory.glob(f'{name}-{version}.json*')):
+                self.stdout.write(f'{path.name}: {path.stat().st_size} байт')
+
+        self.stdout.write(self.style.SUCCESS(f'Снимки записаны в {directory}'))
@@ -0,0 +1,28 @@
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+from map_app.tasks import Worker, run_pending
+
+
+class Command(BaseCommand):
+    help = 'Run background tasks from the database queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=2, help='Tasks run at the same time')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between polls of an empty queue')
+        parser.add_argument('--once', action='store_true', help='Run the ready tasks in this process and exit')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            self.stdout.write(self.style.SUCCESS(f'Выполнено задач: {run_pending()}'))
+            return
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency должно быть положительным')
+
+        worker = Worker(options['concurrency'], options['poll_interval'])
+        # по SIGTERM/Ctrl+C потоки доделывают текущие задачи и выходят
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: worker.stop())
+        self.stdout.write(f'Воркер запущен, потоков: {options["concurrency"]}')
+        worker.run()
+        self.stdout.write(self.style.SUCCESS('Воркер остановлен'))
@@ -0,0 +1,88 @@
+"""Компактный формат маркеров карты.
+
+Вместо массива объектов, где у каждой НКО повторяются ключи и названия
+категории и города, маркеры отдаются столбцами: id, названия, координаты
+(целые, в миллионных долях градуса) и индексы в справочниках категорий
+и городов, которые передаются один раз.
+
+Двоичный вариант (все числа little-endian) читается в браузере через
+типизированные массивы без разбора JSON по строкам:
+
+    заголовок   b'NKM1', uint32 count, uint32 meta_length
+    int32[count]  ids
+    int32[count]  lat
+    int32[count]  lon
+    uint16[count] category — индекс в meta.categories
+    uint16[count] city — индекс в meta.cities
+    meta_length байт UTF-8 JSON: version, scale, categories, cities, names
+"""
+import gzip
+import struct
+
+from .cache import dump_json, get_version
+from .metrics import serialization
+from .models import NKO
+from .serializers import NKO_MARKER_FIELDS, serialize_nkos
+
+COORD_SCALE = 1_000_000
+MAGIC = b'NKM1'
+META_KEYS = ('version', 'scale', 'categories', 'cities', 'names')
+
+
+def build_markers(version=None):
+    """Маркеры одобренных НКО в столбцах."""
+    if version is None:
+        version = get_version()
+    nkos = serialize_nkos(
+        NKO.objects.filter(is_approved=True).order_by('id'),
+        NKO_MARKER_FIELDS + ('city_id',),
+    )
+
+    categories, cities = {}, {}
+    columns = {'ids': [], 'names': [], 'lat': [], 'lon': [], 'category': [], 'city': []}
+    for nko in nkos:
+        category = categories.get(nko['category_id'])
+        if category is None:
+            category = categories[nko['category_id']] = (len(categories), {
+                'id': nko['category_id'],
+                'name': nko['category'],
+                'color': nko['category_color'],
+            })
+        city = cities.get(nko['city_id'])
+        if city is None:
+            city = cities[nko['city_id']] = (len(cities), {'id': nko['city_id'], 'name': nko['city']})
+
+        columns['ids'].append(nko['id'])
+        columns['names'].append(nko['name'])
+        columns['lat'].append(round(nko['latitude'] * COORD_SCALE))
+        columns['lon'].append(round(nko['longitude'] * COORD_SCALE))
+        columns['category'].append(category[0])
+        columns['city'].append(city[0])
+
+    return {
+        'version': version,
+        'count': len(nkos),
+        'scale': COORD_SCALE,
+        'categories': [category for _, category in categories.values()],
+        'cities': [city for _, city in cities.values()],
+        **columns,
+    }
+
+
+@serialization()
+def encode_binary(markers):
+    count = markers['count']
+    meta = dump_json({key: markers[key] for key in META_KEYS})
+    return b''.join((
+        struct.pack('<4sII', MAGIC, count, len(meta)),
+        struct.pack(f'<{count}i', *markers['ids']),
+        struct.pack(f'<{count}i', *markers['lat']),
+        struct.pack(f'<{count}i', *markers['lon']),
+        struct.pack(f'<{count}H', *markers['category']),
+        struct.pack(f'<{count}H', *markers['city']),
+        meta,
+    ))
+
+
+def gzip_bytes(data):
+    return gzip.compress(data, compresslevel=6, mtime=0)
@@ -0,0 +1,181 @@
+"""Метрики запросов: число запросов к БД, время SQL и сериализации, размер ответа.
+
+RequestMetricsMiddleware собирает их для каждого запроса, отдаёт в
+заголовке Server-Timing (видно во вкладке Network браузера) и копит
+по представлениям для /metrics в текстовом формате Prometheus. Счётчики
+живут в памяти процесса: у каждого воркера свои.
+
+Запросы к БД считает обёртка execute_wrapper, которая ставится на каждое
+соединение при его создании, а текущий запрос она находит через
+contextvar — так учитываются и запросы асинхронных представлений,
+выполненные в потоках sync_to_async.
+
+Бюджет запросов к БД объявляется у представления декоратором
+``@query_budget(n)``: превышение пишется в лог, а тесты проверяют
+бюджеты всех публичных эндпоинтов на холодном кеше.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('map_app_request_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.serialize_time = 0.0
+        self.response_bytes = None
+        self.duration = 0.0
+        self._serializing = False
+
+    def server_timing(self):
+        return ', '.join((
+            f'db;desc="{self.queries} SQL";dur={self.sql_time * 1000:.1f}',
+            f'serialize;dur={self.serialize_time * 1000:.1f}',
+            f'total;dur={self.duration * 1000:.1f}',
+        ))
+
+
+def query_budget(queries):
+    """Сколько запросов к БД представление может сделать на холодном кеше."""
+    def decorator(view):
+        view.query_budget = queries
+        return view
+    return decorator
+
+
+def _record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.sql_time += time.perf_counter() - start
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    # Сигнал приходит при каждом переподключении того же объекта соединения.
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+@contextmanager
+def serialization():
+    """Учитывает блок как сериализацию; SQL внутри блока вычитается."""
+    metrics = _current.get()
+    if metrics is None or metrics._serializing:
+        yield
+        return
+    metrics._serializing = True
+    start, sql_time = time.perf_counter(), metrics.sql_time
+    try:
+        yield
+    finally:
+        metrics._serializing = False
+        metrics.serialize_time += time.perf_counter() - start - (metrics.sql_time - sql_time)
+
+
+class MetricsRegistry:
+    """Накопленные метрики по представлениям (имя маршрута URL)."""
+
+    COUNTERS = (
+        ('requests_total', 'Обработанные запросы'),
+        ('db_queries_total', 'Запросы к БД'),
+        ('db_seconds_total', 'Время SQL, секунды'),
+        ('serialize_seconds_total', 'Время сериализации ответа, секунды'),
+        ('request_seconds_total', 'Время обработки запроса, секунды'),
+        ('response_bytes_total', 'Размер ответов без потоковых, байты'),
+        ('query_budget_exceeded_total', 'Запросы сверх бюджета запросов к БД'),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = defaultdict(lambda: dict.fromkeys((name for name, _ in self.COUNTERS), 0))
+
+    def record(self, view, metrics, over_budget=False):
+        with self._lock:
+            counters = self._views[view]
+            counters['requests_total'] += 1
+            counters['db_queries_total'] += metrics.queries
+            counters['db_seconds_total'] += metrics.sql_time
+            counters['serialize_seconds_total'] += metrics.serialize_time
+            counters['request_seconds_total'] += metrics.duration
+            counters['response_bytes_total'] += metrics.response_bytes or 0
+            counters['query_budget_exceeded_total'] += over_budget
+
+    def render(self):
+        with self._lock:
+            views = {view: dict(counters) for view, counters in self._views.items()}
+        lines = []
+        for name, description in self.COUNTERS:
+            lines.append(f'# HELP map_app_{name} {description}')
+            lines.append(f'# TYPE map_app_{name} counter')
+            for view, counters in sorted(views.items()):
+                lines.append(f'map_app_{name}{{view="{view}"}} {counters[name]:g}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, metrics, start)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, metrics, start)
+
+    def _finish(self, request, response, metrics, start):
+        metrics.duration = time.perf_counter() - start
+        if not response.streaming:
+            metrics.response_bytes = len(response.content)
+        response['Server-Timing'] = metrics.server_timing()
+        response.metrics = metrics
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        budget = getattr(match.func, 'query_budget', None) if match else None
+        over_budget = budget is not None and metrics.queries > budget
+        if over_budget:
+            logger.warning('%s: %d запросов к БД при бюджете %d', view, metrics.queries, budget)
+        registry.record(view, metrics, over_budget)
+        return response
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:05
+
+from django.db import migrations, models
+
+# Копия map_app.geo.geo_cell на момент миграции: миграция не должна
+# зависеть от кода приложения, который может измениться позже.
+GEO_CELL_LEVEL = 16
+
+
+def geo_cell(lat, lon):
+    n = 1 << GEO_CELL_LEVEL
+    x = min(max(int((lon + 180.0) / 360.0 * n), 0), n - 1)
+    y = min(max(int((lat + 90.0) / 180.0 * n), 0), n - 1)
+    key = 0
+    for bit in range(GEO_CELL_LEVEL):
+        key |= ((x >> bit) & 1) << (2 * bit)
+        key |= ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+def fill_geo_cells(apps, schema_editor):
+    NKO = apps.get_model('map_app', 'NKO')
+    nkos = list(NKO.objects.only('id', 'latitude', 'longitude'))
+    for nko in nkos:
+        nko.geo_cell = geo_cell(nko.latitude, nko.longitude)
+    NKO.objects.bulk_update(nkos, ['geo_cell'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0005_userprofile_avatar_userprofile_bio_userprofile_city_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nko',
+            name='geo_cell',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(fill_geo_cells, migrations.RunPython.noop),
+    ]
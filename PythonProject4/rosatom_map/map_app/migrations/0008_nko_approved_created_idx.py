@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0007_nkotombstone_nko_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='nko',
+            index=models.Index(fields=['is_approved', 'created_at'], name='nko_approved_created_idx'),
+        ),
+    ]
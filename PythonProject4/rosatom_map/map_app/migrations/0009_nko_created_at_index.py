@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0008_nko_approved_created_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='nko',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
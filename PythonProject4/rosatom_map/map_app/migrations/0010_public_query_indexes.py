@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0009_nko_created_at_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='city',
+            name='region',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='nko',
+            index=models.Index(condition=models.Q(('is_approved', True)), fields=['id', 'category', 'city', 'latitude', 'longitude', 'name', 'is_approved'], name='nko_public_markers_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='nko',
+            index=models.Index(condition=models.Q(('is_approved', True)), fields=['city', 'id'], name='nko_public_city_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='nko',
+            index=models.Index(condition=models.Q(('is_approved', True)), fields=['category', 'id'], name='nko_public_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='nko',
+            index=models.Index(condition=models.Q(('is_approved', True)), fields=['geo_cell'], name='nko_public_geo_cell_idx'),
+        ),
+    ]
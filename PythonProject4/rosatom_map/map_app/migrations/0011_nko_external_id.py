@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0010_public_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nko',
+            name='external_id',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
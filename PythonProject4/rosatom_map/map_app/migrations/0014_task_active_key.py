@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0013_task_queue'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='task',
+            name='task_pending_key_uniq',
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='next_kwargs',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='task',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['pending', 'running'])), fields=('key',), name='task_active_key_uniq'),
+        ),
+    ]
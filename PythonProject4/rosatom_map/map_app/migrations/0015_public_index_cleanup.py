@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0014_task_active_key'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='nko',
+            name='nko_public_markers_idx',
+        ),
+        migrations.AlterField(
+            model_name='nko',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AddIndex(
+            model_name='nko',
+            index=models.Index(condition=models.Q(('is_approved', True)), fields=['id', 'category', 'city', 'latitude', 'longitude', 'name'], name='nko_public_markers_idx'),
+        ),
+    ]
@@ -1,11 +1,14 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
+from .geo import geo_cell
+
 class City(models.Model):
     name = models.CharField(max_length=100)
-    region = models.CharField(max_length=100)
+    region = models.CharField(max_length=100, db_index=True)
     latitude = models.FloatField(default=55.7558)
     longitude = models.FloatField(default=37.6173)
 
@@ -33,10 +36,115 @@ class NKO(models.Model):
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     is_approved = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    geo_cell = models.BigIntegerField(default=0, db_index=True, editable=False)
+    # идентификатор во внешнем реестре (ОГРН и т.п.) — ключ повторной загрузки import_nko
+    external_id = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    # точка стоит в центре города, пока geocode_nko не найдёт адрес
+    geocode_pending = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # очередь модерации и списки одобренных: is_approved = ... ORDER BY created_at
+            models.Index(fields=['is_approved', 'created_at'], name='nko_approved_created_idx'),
+            # Частичные индексы публичных запросов (WHERE is_approved) содержат только
+            # одобренные НКО. Первый обслуживает маркеры, индексы кластеров и ближайших
+            # НКО в порядке id. is_approved в столбцах не повторяется — его задаёт
+            # условие индекса (старые SQLite ради него читают строку таблицы).
+            models.Index(
+                fields=['id', 'category', 'city', 'latitude', 'longitude', 'name'],
+                condition=models.Q(is_approved=True),
+                name='nko_public_markers_idx',
+            ),
+            models.Index(fields=['city', 'id'], condition=models.Q(is_approved=True), name='nko_public_city_idx'),
+            models.Index(
+                fields=['category', 'id'], condition=models.Q(is_approved=True), name='nko_public_category_idx',
+            ),
+            models.Index(fields=['geo_cell'], condition=models.Q(is_approved=True), name='nko_public_geo_cell_idx'),
+            # очередь геокодирования: в индексе только ждущие НКО
+            models.Index(fields=['id'], condition=models.Q(geocode_pending=True), name='nko_geocode_pending_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Нужно, чтобы заметить снятие одобрения и перенос точки при следующем save().
+        instance._loaded_approved = instance.__dict__.get('is_approved', False)
+        instance._loaded_point = (instance.__dict__.get('latitude'), instance.__dict__.get('longitude'))
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.geo_cell = geo_cell(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'geo_cell'}
+        super().save(*args, **kwargs)
+
+class NKOTombstone(models.Model):
+    """Отметка об НКО, которая пропала с карты: удалена или снята с публикации."""
+    nko_id = models.BigIntegerField(unique=True)
+    removed_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"НКО #{self.nko_id} удалена {self.removed_at:%d.%m.%Y %H:%M}"
+
+    @classmethod
+    def record(cls, nko_ids):
+        now = timezone.now()
+        cls.objects.bulk_create(
+            [cls(nko_id=nko_id, removed_at=now) for nko_id in nko_ids],
+            update_conflicts=True,
+            unique_fields=['nko_id'],
+            update_fields=['removed_at'],
+        )
+
+class GeocodeCache(models.Model):
+    """Координаты нормализованного адреса (см. geocoding.py); пустые — адрес не найден."""
+    address = models.CharField(max_length=500, unique=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    resolved_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.address
+
+class Task(models.Model):
+    """Фоновая задача (см. tasks.py)."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'В очереди'), (RUNNING, 'Выполняется'), (FAILED, 'Ошибка')]
+
+    name = models.CharField(max_length=200)
+    kwargs = models.JSONField(default=dict, blank=True)
+    key = models.CharField(max_length=200, null=True, blank=True)
+    # аргументы повторного запуска, если задачу с тем же ключом поставили, пока она выполнялась
+    next_kwargs = models.JSONField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['run_after', 'id'], condition=models.Q(status='pending'), name='task_pending_idx'),
+        ]
+        constraints = [
+            # одна задача на ключ, ждущая или выполняющаяся
+            models.UniqueConstraint(
+                fields=['key'], condition=models.Q(status__in=['pending', 'running']), name='task_active_key_uniq',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.get_status_display()})"
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     phone = models.CharField(max_length=20, blank=True)
@@ -56,12 +164,3 @@ def create_user_profile(sender, instance, created, **kwargs):
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
     instance.userprofile.save()
-
-@receiver(post_save, sender=User)
-def create_user_profile(sender, instance, created, **kwargs):
-    if created:
-        UserProfile.objects.create(user=instance)
-
-@receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    instance.userprofile.save()
\ No newline at end of file
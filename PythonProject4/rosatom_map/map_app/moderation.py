@@ -0,0 +1,197 @@
+"""Пакетная модерация НКО.
+
+Одобрение и отклонение любого числа НКО — одна транзакция с одним
+UPDATE ... WHERE id IN (...) на действие, без загрузки объектов и save()
+по одному. Кеш, снимки, индексы и поток событий получают одно
+уведомление на весь пакет, письма авторам уходят фоновой задачей
+(если почта настроена, см. EMAIL_HOST в settings).
+
+Страница модерации листается по ключу (created_at, id) от новых к старым:
+стоимость страницы не зависит от её номера и размера реестра, её
+обслуживает индекс (is_approved, created_at).
+"""
+import logging
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .events import send_nko_events
+from .models import NKO, NKOTombstone
+from .signals import send_nkos_changed
+from .tasks import enqueue, task
+
+MODERATION_ACTIONS = ('approve', 'reject')
+MODERATION_MAX_ITEMS = 1000
+MODERATION_PAGE_SIZE = 50
+MAIL_ATTEMPTS = 5
+MAIL_RETRY_DELAY = 5 * 60
+# решение модератора -> (тема, текст письма автору)
+LETTERS = {
+    'approved': ('НКО опубликована на карте', 'Организация «{}» прошла модерацию и опубликована на карте.'),
+    'rejected': ('НКО снята с публикации', 'Организация «{}» не прошла модерацию и не показывается на карте.'),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def parse_items(data):
+    """``{"items": [{"id": 1, "action": "approve"}, ...]}`` -> (одобрить, отклонить)."""
+    try:
+        items = data['items']
+    except (KeyError, TypeError):
+        raise ValueError('Ожидается объект с полем items')
+    if not isinstance(items, list):
+        raise ValueError('items должен быть списком')
+    if len(items) > MODERATION_MAX_ITEMS:
+        raise ValueError(f'Не больше {MODERATION_MAX_ITEMS} НКО за запрос')
+
+    actions = {}
+    for item in items:
+        try:
+            nko_id, action = item['id'], item['action']
+        except (KeyError, TypeError):
+            raise ValueError('Каждый элемент items должен содержать id и action')
+        if not isinstance(nko_id, int) or isinstance(nko_id, bool):
+            raise ValueError(f'Некорректный id: {nko_id!r}')
+        if action not in MODERATION_ACTIONS:
+            raise ValueError(f'Неизвестное действие: {action!r}')
+        if actions.setdefault(nko_id, action) != action:
+            raise ValueError(f'Для НКО {nko_id} указаны разные действия')
+
+    approve = [nko_id for nko_id, action in actions.items() if action == 'approve']
+    reject = [nko_id for nko_id, action in actions.items() if action == 'reject']
+    return approve, reject
+
+
+def moderate(approve=(), reject=()):
+    """Одобряет и отклоняет НКО одной транзакцией.
+
+    Возвращает сводку: какие НКО одобрены и отклонены, какие уже были
+    в нужном состоянии и каких нет в базе.
+    """
+    approve, reject = set(approve), set(reject)
+    with transaction.atomic():
+        states = dict(
+            NKO.objects.filter(id__in=approve | reject).values_list('id', 'is_approved')
+        )
+        approved = sorted(nko_id for nko_id in approve if states.get(nko_id) is False)
+        rejected = sorted(nko_id for nko_id in reject if states.get(nko_id) is True)
+
+        now = timezone.now()
+        if approved:
+            NKO.objects.filter(id__in=approved).update(is_approved=True, updated_at=now)
+        if rejected:
+            NKO.objects.filter(id__in=rejected).update(is_approved=False, updated_at=now)
+            NKOTombstone.record(rejected)
+
+        send_nkos_changed(approved + rejected)
+        send_nko_events('approved', approved)
+        send_nko_events('unapproved', rejected)
+        if (approved or rejected) and mail_enabled():
+            enqueue(notify_moderated, approved=approved, rejected=rejected)
+
+    requested = approve | reject
+    return {
+        'approved': approved,
+        'rejected': rejected,
+        'unchanged': sorted(requested.intersection(states) - set(approved) - set(rejected)),
+        'not_found': sorted(requested.difference(states)),
+    }
+
+
+def mail_enabled():
+    # без EMAIL_HOST settings подключает dummy backend — письма некуда отправлять
+    return settings.EMAIL_BACKEND != 'django.core.mail.backends.dummy.EmailBackend'
+
+
+@task(max_attempts=1)
+def notify_moderated(approved=(), rejected=(), attempt=1):
+    """Письма авторам НКО о решении модератора.
+
+    При сбое почты повторно ставятся только неотправленные письма, а не
+    вся задача: иначе авторы получили бы одно письмо несколько раз.
+    """
+    messages = []
+    for decision, ids in (('approved', approved), ('rejected', rejected)):
+        subject, text = LETTERS[decision]
+        recipients = NKO.objects.filter(id__in=ids).exclude(created_by__email='')
+        for nko_id, name, email in recipients.values_list('id', 'name', 'created_by__email'):
+            messages.append((decision, nko_id, EmailMessage(subject, text.format(name), to=[email])))
+
+    sent = 0
+    try:
+        with get_connection() as connection:
+            for _, _, message in messages:
+                connection.send_messages([message])
+                sent += 1
+    except Exception:
+        if attempt >= MAIL_ATTEMPTS:
+            raise
+        logger.exception('Не отправлено писем: %d из %d, повтор позже', len(messages) - sent, len(messages))
+        unsent = messages[sent:]
+        enqueue(
+            notify_moderated, delay=MAIL_RETRY_DELAY * attempt, attempt=attempt + 1,
+            approved=[nko_id for decision, nko_id, _ in unsent if decision == 'approved'],
+            rejected=[nko_id for decision, nko_id, _ in unsent if decision == 'rejected'],
+        )
+
+
+def filter_nkos(queryset, filters):
+    """Фильтры страницы модерации (cleaned_data ModerationFilterForm), кроме статуса."""
+    if filters.get('city'):
+        queryset = queryset.filter(city=filters['city'])
+    if filters.get('category'):
+        queryset = queryset.filter(category=filters['category'])
+    if filters.get('author'):
+        queryset = queryset.filter(created_by__username=filters['author'])
+    # Границы дня, а не created_at__date: так сравнение идёт по индексу.
+    if filters.get('date_from'):
+        queryset = queryset.filter(created_at__gte=_day_start(filters['date_from']))
+    if filters.get('date_to'):
+        queryset = queryset.filter(created_at__lt=_day_start(filters['date_to'] + timedelta(days=1)))
+    return queryset
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def count_nkos(queryset):
+    """Число НКО на модерации и одобренных одним агрегирующим запросом."""
+    counts = queryset.aggregate(
+        pending=Count('id', filter=Q(is_approved=False)),
+        approved=Count('id', filter=Q(is_approved=True)),
+    )
+    counts['total'] = counts['pending'] + counts['approved']
+    return counts
+
+
+def encode_cursor(nko):
+    return f'{nko.created_at.isoformat()}_{nko.pk}'
+
+
+def decode_cursor(value):
+    """``(created_at, id)`` из курсора; ValueError, если курсор испорчен."""
+    created_at, _, pk = value.rpartition('_')
+    created_at = datetime.fromisoformat(created_at)
+    if timezone.is_naive(created_at):
+        raise ValueError('Курсор без часового пояса')
+    return created_at, int(pk)
+
+
+def moderation_page(queryset, approved, cursor=None, size=MODERATION_PAGE_SIZE):
+    """Страница от новых НКО к старым: (НКО, курсор следующей страницы или None)."""
+    # is_approved__in, а не is_approved=: булево условие Django пишет как
+    # WHERE "is_approved" / NOT "is_approved", и по такому SQLite не берёт индекс.
+    queryset = queryset.filter(is_approved__in=[approved])
+    if cursor is not None:
+        created_at, pk = cursor
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    nkos = list(queryset.order_by('-created_at', '-id')[:size + 1])
+    if len(nkos) > size:
+        return nkos[:size], encode_cursor(nkos[size - 1])
+    return nkos, None
@@ -0,0 +1,136 @@
+"""Поиск ближайших НКО (k-NN) по координатам.
+
+Точки хранятся как единичные векторы на сфере в KD-дереве: расстояние
+по хорде монотонно связано с расстоянием по дуге большого круга
+(формула гаверсинусов), поэтому обычный евклидов поиск в дереве даёт
+ближайших по поверхности Земли. Новые и перемещённые НКО попадают в
+небольшой буфер, удалённые помечаются, а дерево перестраивается, когда
+буфер разрастается.
+"""
+import heapq
+import math
+
+from .models import NKO
+from .sync import SyncedIndex
+
+EARTH_RADIUS_KM = 6371.0088
+MIN_BUFFER_SIZE = 64
+
+
+def to_xyz(lat, lon):
+    lat, lon = math.radians(lat), math.radians(lon)
+    cos_lat = math.cos(lat)
+    return cos_lat * math.cos(lon), cos_lat * math.sin(lon), math.sin(lat)
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def km_to_chord(km):
+    if not (math.isfinite(km) and km > 0):
+        raise ValueError('радиус должен быть положительным числом')
+    return 2 * math.sin(min(math.pi, km / EARTH_RADIUS_KM) / 2)
+
+
+def _build_tree(points, depth=0):
+    """Узел дерева: (точка, id, ось, левое поддерево, правое поддерево)."""
+    if not points:
+        return None
+    axis = depth % 3
+    points.sort(key=lambda point: point[0][axis])
+    middle = len(points) // 2
+    xyz, nko_id = points[middle]
+    return (
+        xyz, nko_id, axis,
+        _build_tree(points[:middle], depth + 1),
+        _build_tree(points[middle + 1:], depth + 1),
+    )
+
+
+def _distance2(a, b):
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+
+class NearbyIndex(SyncedIndex):
+    def __init__(self):
+        super().__init__()
+        self._points = {}
+        self._tree = None
+        self._tree_size = 0
+        self._buffer = {}
+        self._stale = set()
+
+    def _build(self):
+        self._tree = _build_tree([(xyz, nko_id) for nko_id, xyz in self._points.items()])
+        self._tree_size = len(self._points)
+        self._buffer = {}
+        self._stale = set()
+
+    def _rebuild(self):
+        rows = NKO.objects.filter(is_approved=True).values_list('id', 'latitude', 'longitude')
+        self._points = {
+            nko_id: to_xyz(lat, lon) for nko_id, lat, lon in rows.iterator(chunk_size=2000)
+        }
+        self._build()
+
+    def _refresh(self, ids):
+        for nko_id in ids:
+            self._points.pop(nko_id, None)
+            self._buffer.pop(nko_id, None)
+            self._stale.add(nko_id)
+
+        rows = NKO.objects.filter(id__in=ids, is_approved=True).values_list('id', 'latitude', 'longitude')
+        for nko_id, lat, lon in rows:
+            xyz = to_xyz(lat, lon)
+            self._points[nko_id] = xyz
+            self._buffer[nko_id] = xyz
+
+        limit = max(MIN_BUFFER_SIZE, int(math.sqrt(self._tree_size)))
+        if len(self._buffer) > limit or len(self._stale) > self._tree_size // 4:
+            self._build()
+
+    def nearest(self, lat, lon, k=10, radius_km=None):
+        """Список ``(id, расстояние в км)`` для ``k`` ближайших НКО."""
+        target = to_xyz(lat, lon)
+        max_chord = km_to_chord(radius_km) if radius_km is not None else 2.0
+        # Куча из (-квадрат расстояния, id): в вершине — худший из найденных.
+        heap = []
+        bound = [max_chord ** 2]
+
+        def consider(xyz, nko_id):
+            dist2 = _distance2(target, xyz)
+            if dist2 > bound[0]:
+                return
+            if len(heap) < k:
+                heapq.heappush(heap, (-dist2, nko_id))
+            else:
+                heapq.heappushpop(heap, (-dist2, nko_id))
+            if len(heap) == k:
+                bound[0] = min(bound[0], -heap[0][0])
+
+        def visit(node):
+            if node is None:
+                return
+            xyz, nko_id, axis, left, right = node
+            if nko_id not in self._stale:
+                consider(xyz, nko_id)
+            delta = target[axis] - xyz[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            visit(near)
+            if delta * delta <= bound[0]:
+                visit(far)
+
+        with self._lock:
+            self.sync()
+            visit(self._tree)
+            for nko_id, xyz in self._buffer.items():
+                consider(xyz, nko_id)
+
+        return [
+            (nko_id, chord_to_km(math.sqrt(-neg_dist2)))
+            for neg_dist2, nko_id in sorted(heap, reverse=True)
+        ]
+
+
+nearby_index = NearbyIndex()
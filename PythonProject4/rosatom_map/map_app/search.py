@@ -0,0 +1,201 @@
+"""Полнотекстовый поиск по НКО.
+
+Инвертированный индекс по названию, описанию, городу и категории живёт
+в памяти процесса и, как и индекс кластеров, догоняет версию набора
+данных через дельту (см. sync.py). Слова нормализуются (регистр, ё -> е)
+и обрезаются упрощённым стеммером для русского языка; каждое слово
+запроса ищется как префикс, чтобы поиск работал по мере набора.
+Ранжирование — BM25 с весами полей.
+"""
+import math
+import re
+from bisect import bisect_left
+
+from .models import NKO
+from .serializers import serialize_nkos
+from .sync import SyncedIndex
+
+TOKEN_RE = re.compile(r'\w+')
+CYRILLIC_RE = re.compile('[а-я]')
+
+FIELD_WEIGHTS = (
+    ('name', 3.0),
+    ('category', 1.5),
+    ('city', 1.5),
+    ('description', 1.0),
+)
+DOC_FIELDS = (
+    'id', 'name', 'category', 'category_id', 'category_color',
+    'city', 'city_id', 'latitude', 'longitude', 'description',
+)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+MIN_PREFIX_LENGTH = 2
+MAX_PREFIX_TERMS = 200
+
+_RUSSIAN_ENDINGS = sorted((
+    # прилагательные и причастия
+    'ыми', 'ими', 'ого', 'его', 'ому', 'ему', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие',
+    'ый', 'ий', 'ой', 'ую', 'юю', 'ых', 'их', 'ым', 'им', 'ом', 'ем',
+    'ющий', 'ющая', 'ющее', 'ющие', 'вший', 'вшая', 'вшие', 'нный', 'нная', 'нные',
+    # существительные
+    'иями', 'ями', 'ами', 'ией', 'иях', 'ях', 'ах', 'ов', 'ев', 'ей', 'ам', 'ям',
+    'ия', 'ья', 'ью', 'ию', 'ии', 'ость', 'ости', 'остью', 'ост',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+    # глаголы
+    'ться', 'тся', 'ешь', 'ет', 'ют', 'ут', 'ать', 'ять', 'ить', 'еть',
+    'ла', 'ли', 'ло', 'ете', 'ите',
+), key=len, reverse=True)
+
+
+def normalize(text):
+    return text.lower().replace('ё', 'е')
+
+
+def stem(word):
+    if len(word) <= 3 or not CYRILLIC_RE.search(word):
+        return word
+    for ending in _RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    return [stem(token) for token in TOKEN_RE.findall(normalize(text or ''))]
+
+
+class SearchIndex(SyncedIndex):
+    depends_on_reference_data = True
+
+    def _rebuild(self):
+        self._docs = {}
+        self._doc_terms = {}
+        self._lengths = {}
+        self._postings = {}
+        self._terms = []
+        self._terms_dirty = False
+        self._total_length = 0
+        self._index(NKO.objects.filter(is_approved=True))
+
+    def _index(self, queryset):
+        for doc in serialize_nkos(queryset, DOC_FIELDS):
+            weights = {}
+            for field, weight in FIELD_WEIGHTS:
+                for term in tokenize(doc[field]):
+                    weights[term] = weights.get(term, 0.0) + weight
+
+            doc_id = doc['id']
+            for term, weight in weights.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = {}
+                    self._terms_dirty = True
+                postings[doc_id] = weight
+
+            length = sum(weights.values())
+            del doc['description']
+            self._docs[doc_id] = doc
+            self._doc_terms[doc_id] = tuple(weights)
+            self._lengths[doc_id] = length
+            self._total_length += length
+
+    def _remove(self, doc_id):
+        if self._docs.pop(doc_id, None) is None:
+            return
+        for term in self._doc_terms.pop(doc_id):
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+                self._terms_dirty = True
+        self._total_length -= self._lengths.pop(doc_id)
+
+    def _refresh(self, ids):
+        for doc_id in ids:
+            self._remove(doc_id)
+        self._index(NKO.objects.filter(id__in=ids, is_approved=True))
+
+    def _expand(self, token):
+        if len(token) < MIN_PREFIX_LENGTH:
+            return [token] if token in self._postings else []
+        if self._terms_dirty:
+            self._terms = sorted(self._postings)
+            self._terms_dirty = False
+        terms = []
+        position = bisect_left(self._terms, token)
+        while position < len(self._terms) and len(terms) < MAX_PREFIX_TERMS:
+            term = self._terms[position]
+            if not term.startswith(token):
+                break
+            terms.append(term)
+            position += 1
+        return terms
+
+    def _match(self, tokens):
+        count = len(self._docs)
+        average_length = self._total_length / count if count else 0
+        scores = None
+        for token in tokens:
+            token_scores = {}
+            for term in self._expand(token):
+                postings = self._postings[term]
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    norm = 1 - BM25_B + BM25_B * self._lengths[doc_id] / average_length
+                    score = idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+                    if score > token_scores.get(doc_id, 0.0):
+                        token_scores[doc_id] = score
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {
+                    doc_id: scores[doc_id] + score
+                    for doc_id, score in token_scores.items() if doc_id in scores
+                }
+            if not scores:
+                break
+        return scores or {}
+
+    def search(self, query, category_id=None, city_id=None, page=1, page_size=20):
+        """Результаты поиска с фасетами по категориям и городам."""
+        tokens = tokenize(query)
+        with self._lock:
+            self.sync()
+            scores = self._match(tokens) if tokens else {}
+            docs = [self._docs[doc_id] for doc_id in scores]
+
+        categories, cities = {}, {}
+        for doc in docs:
+            for facets, key, name in ((categories, 'category_id', 'category'), (cities, 'city_id', 'city')):
+                facet = facets.get(doc[key])
+                if facet is None:
+                    facet = facets[doc[key]] = {'id': doc[key], 'name': doc[name], 'count': 0}
+                facet['count'] += 1
+
+        if category_id is not None:
+            docs = [doc for doc in docs if doc['category_id'] == category_id]
+        if city_id is not None:
+            docs = [doc for doc in docs if doc['city_id'] == city_id]
+        docs.sort(key=lambda doc: (-scores[doc['id']], doc['name']))
+
+        start = (page - 1) * page_size
+        results = [
+            {**doc, 'score': round(scores[doc['id']], 4)}
+            for doc in docs[start:start + page_size]
+        ]
+        return {
+            'query': query,
+            'total': len(docs),
+            'page': page,
+            'page_size': page_size,
+            'results': results,
+            'facets': {
+                'categories': sorted(categories.values(), key=lambda f: -f['count']),
+                'cities': sorted(cities.values(), key=lambda f: -f['count']),
+            },
+        }
+
+
+search_index = SearchIndex()
@@ -0,0 +1,137 @@
+"""Сериализация НКО для публичных эндпоинтов.
+
+Все ответы строятся из одной проекции ``values_list`` с JOIN на категорию
+и город: без создания объектов моделей и без дополнительного запроса
+на каждую НКО, поэтому число запросов не зависит от числа организаций.
+"""
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+
+from .metrics import serialization
+
+
+def _city_label(name, region):
+    return f"{name}, {region}"
+
+
+# поле ответа -> (столбцы проекции, функция сборки значения из них)
+NKO_COLUMNS = {
+    'id': (('id',), None),
+    'name': (('name',), None),
+    'category': (('category__name',), None),
+    'category_id': (('category_id',), None),
+    'category_color': (('category__color',), None),
+    'description': (('description',), None),
+    'address': (('address',), None),
+    'phone': (('phone',), None),
+    'website': (('website',), None),
+    'vk_link': (('vk_link',), None),
+    'city': (('city__name', 'city__region'), _city_label),
+    'city_id': (('city_id',), None),
+    'latitude': (('latitude',), None),
+    'longitude': (('longitude',), None),
+    'external_id': (('external_id',), None),
+    'is_approved': (('is_approved',), None),
+}
+
+# поля, которые публичные эндпоинты отдают по умолчанию
+NKO_FIELDS = (
+    'id', 'name', 'category', 'category_id', 'category_color', 'description',
+    'address', 'phone', 'website', 'vk_link', 'city', 'latitude', 'longitude',
+)
+
+# поля маркера на карте и строки списка; остальное карточка загружает отдельно
+NKO_MARKER_FIELDS = (
+    'id', 'name', 'category', 'category_id', 'category_color', 'city', 'latitude', 'longitude',
+)
+
+
+def _layout(fields):
+    columns = []
+    layout = []
+    for field in fields:
+        names, build = NKO_COLUMNS[field]
+        layout.append((field, len(columns), len(names), build))
+        columns.extend(names)
+    return columns, layout
+
+
+def _item(row, layout):
+    item = {}
+    for field, start, size, build in layout:
+        item[field] = build(*row[start:start + size]) if build else row[start]
+    return item
+
+
+@serialization()
+def serialize_nkos(queryset, fields=NKO_FIELDS):
+    """Список словарей с полями ``fields`` для НКО из ``queryset``."""
+    columns, layout = _layout(fields)
+    return [_item(row, layout) for row in queryset.values_list(*columns)]
+
+
+async def aserialize_nkos(queryset, fields=NKO_FIELDS):
+    columns, layout = _layout(fields)
+    with serialization():
+        return [_item(row, layout) async for row in queryset.values_list(*columns)]
+
+
+def iter_nkos(queryset, fields=NKO_FIELDS, chunk_size=2000):
+    """Как serialize_nkos, но по одной записи: память не зависит от числа НКО."""
+    columns, layout = _layout(fields)
+    for row in queryset.values_list(*columns).iterator(chunk_size=chunk_size):
+        yield _item(row, layout)
+
+
+async def aiter_nkos(queryset, fields=NKO_FIELDS, chunk_size=2000):
+    # aiterator() читает пачки через sync_to_async, но у values_list первый
+    # запрос выполняется ещё в event loop: ValuesListIterable.__iter__ не
+    # генератор, и Django 5.2 отвечает SynchronousOnlyOperation. Поэтому
+    # синхронный итератор целиком, с запросом, продвигается пачками в потоке.
+    items = iter_nkos(queryset, fields, chunk_size)
+    next_chunk = sync_to_async(lambda: list(islice(items, chunk_size)))
+    while chunk := await next_chunk():
+        for item in chunk:
+            yield item
+
+
+def parse_fields(value):
+    """Поля из параметра ``fields=id,latitude,...``; ``id`` входит всегда."""
+    if not value:
+        return NKO_FIELDS
+    fields = tuple(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in NKO_COLUMNS]
+    if unknown:
+        raise ValueError(f'Неизвестные поля: {", ".join(unknown)}')
+    if 'id' not in fields:
+        fields = ('id',) + fields
+    return fields
+
+
+def _page_queryset(queryset, cursor, limit):
+    queryset = queryset.order_by('id')
+    if cursor is not None:
+        queryset = queryset.filter(id__gt=cursor)
+    return queryset if limit is None else queryset[:limit + 1]
+
+
+def _split_page(items, limit):
+    if limit is not None and len(items) > limit:
+        return items[:limit], items[limit - 1]['id']
+    return items, None
+
+
+def serialize_page(queryset, fields=NKO_FIELDS, cursor=None, limit=None):
+    """Страница НКО по возрастанию id: (записи, курсор следующей страницы).
+
+    ``cursor`` — id последней НКО предыдущей страницы; без ``limit``
+    возвращаются все записи после курсора.
+    """
+    items = serialize_nkos(_page_queryset(queryset, cursor, limit), fields)
+    return _split_page(items, limit)
+
+
+async def aserialize_page(queryset, fields=NKO_FIELDS, cursor=None, limit=None):
+    items = await aserialize_nkos(_page_queryset(queryset, cursor, limit), fields)
+    return _split_page(items, limit)
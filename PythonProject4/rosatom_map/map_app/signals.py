@@ -0,0 +1,27 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from .models import NKO
+
+# Отправляется после фиксации транзакции; ids — список изменённых НКО
+# или None, если их слишком много, чтобы перечислять (массовая загрузка).
+# При ids=None в tiles могут прийти затронутые тайлы (см. tiles.py).
+# Массовые операции (queryset.update и т.п.) вызывают send_nkos_changed сами.
+nkos_changed = Signal()
+
+
+def send_nkos_changed(ids):
+    ids = list(ids)
+    if ids:
+        transaction.on_commit(lambda: nkos_changed.send(sender=NKO, ids=ids))
+
+
+def send_all_nkos_changed(tiles=None):
+    transaction.on_commit(lambda: nkos_changed.send(sender=NKO, ids=None, tiles=tiles))
+
+
+@receiver(post_save, sender=NKO)
+@receiver(post_delete, sender=NKO)
+def nko_written(sender, instance, **kwargs):
+    send_nkos_changed([instance.pk])
@@ -0,0 +1,160 @@
+"""Готовые снимки публичного набора данных НКО.
+
+Полный список одобренных НКО одинаков для всех посетителей, пока не
+изменится версия набора данных, поэтому для самых частых наборов полей
+(все поля и маркеры карты) он записывается в NKO_SNAPSHOT_DIR один раз
+на версию — сразу вместе со сжатыми вариантами .gz и .br (если установлен
+пакет brotli). Файлы появляются атомарно через os.replace, так что
+читатель никогда не увидит недописанный снимок.
+
+/api/nkos/ отдаёт готовые байты в подходящей клиенту кодировке без
+сериализации, сжатия и запросов к БД. Файлы с постоянными именами
+(nkos.json, markers.json и их .gz/.br) указывают на последнюю версию,
+и их может отдавать веб-сервер напрямую (gzip_static / brotli_static
+в nginx).
+"""
+import gzip
+import os
+import re
+import tempfile
+from pathlib import Path
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.dispatch import receiver
+
+from .cache import aget_version, dump_json, get_version
+from .models import NKO
+from .serializers import NKO_FIELDS, NKO_MARKER_FIELDS, serialize_nkos
+from .signals import nkos_changed
+from .tasks import enqueue, task
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# набор полей -> имя снимка
+SNAPSHOTS = {
+    NKO_FIELDS: 'nkos',
+    NKO_MARKER_FIELDS: 'markers',
+}
+KEEP_VERSIONS = 3
+
+# в порядке предпочтения
+ENCODINGS = (
+    ('br', '.br', re.compile(r'\bbr\b')),
+    ('gzip', '.gz', re.compile(r'\bgzip\b')),
+)
+SNAPSHOT_RE = re.compile(r'^(?P<name>\w+)-(?P<version>\d+)\.json$')
+
+
+def snapshot_dir():
+    return Path(settings.NKO_SNAPSHOT_DIR)
+
+
+def _compress(data):
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+    return variants
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _versions(directory, name):
+    versions = []
+    for path in directory.glob(f'{name}-*.json'):
+        match = SNAPSHOT_RE.match(path.name)
+        if match and match['name'] == name:
+            versions.append(int(match['version']))
+    return sorted(versions)
+
+
+def write_snapshot(name):
+    """Записывает снимок ``name`` для текущей версии и возвращает её."""
+    fields = next(fields for fields, snapshot in SNAPSHOTS.items() if snapshot == name)
+    version = get_version()
+    data = dump_json({
+        'version': version,
+        'nkos': serialize_nkos(NKO.objects.filter(is_approved=True).order_by('id'), fields),
+        'next_cursor': None,
+    })
+
+    directory = snapshot_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    variants = _compress(data)
+    # Несжатый файл пишется последним: по нему определяется готовность снимка.
+    for suffix, body in variants.items():
+        _write_atomic(directory / f'{name}-{version}.json{suffix}', body)
+    _write_atomic(directory / f'{name}-{version}.json', data)
+
+    versions = _versions(directory, name)
+    if version == versions[-1]:
+        for suffix, body in variants.items():
+            _write_atomic(directory / f'{name}.json{suffix}', body)
+        _write_atomic(directory / f'{name}.json', data)
+    for old in versions[:-KEEP_VERSIONS]:
+        for path in directory.glob(f'{name}-{old}.json*'):
+            path.unlink(missing_ok=True)
+    return version
+
+
+def write_snapshots():
+    return [write_snapshot(name) for name in SNAPSHOTS.values()]
+
+
+def read_snapshot(name, version, accept_encoding=''):
+    """``(байты, Content-Encoding)`` снимка ``name`` версии ``version``.
+
+    Отсутствующий снимок (ещё не записан или уже удалён как старый)
+    строится на месте.
+    """
+    path = snapshot_dir() / f'{name}-{version}.json'
+    try:
+        return _read_encoded(path, accept_encoding)
+    except FileNotFoundError:
+        path = path.with_name(f'{name}-{write_snapshot(name)}.json')
+        return _read_encoded(path, accept_encoding)
+
+
+async def aread_snapshot(fields, accept_encoding=''):
+    """Снимок текущей версии для ``fields`` (см. read_snapshot) или None.
+
+    None — если для ``fields`` снимок не ведётся. Файл читается в потоке,
+    а не в event loop: страничный кеш ОС не гарантирует, что чтение
+    не заблокирует его.
+    """
+    name = SNAPSHOTS.get(fields)
+    if name is None:
+        return None
+    return await sync_to_async(read_snapshot)(name, await aget_version(), accept_encoding)
+
+
+def _read_encoded(path, accept_encoding):
+    for encoding, suffix, accepts in ENCODINGS:
+        encoded = path.with_name(path.name + suffix)
+        if accepts.search(accept_encoding) and encoded.exists():
+            return encoded.read_bytes(), encoding
+    return path.read_bytes(), None
+
+
+@task()
+def rebuild_snapshots():
+    write_snapshots()
+
+
+@receiver(nkos_changed)
+def nkos_changed_write_snapshots(sender, **kwargs):
+    # Пересборку делает воркер run_tasks; до неё снимок новой версии
+    # строит первый запрос к /api/nkos/ (см. aread_snapshot).
+    enqueue(rebuild_snapshots, key='snapshots')
@@ -0,0 +1,71 @@
+"""Сводные данные карты: центр, границы городов и счётчики НКО.
+
+Считаются агрегатными запросами один раз на версию набора данных
+(см. cache.py) и дальше читаются из кеша — главная страница и
+/api/stats/ не пересчитывают их на каждом запросе.
+"""
+from django.db.models import Count, Q
+
+from .cache import aget_or_build, aget_version, get_or_build, get_version
+from .models import City, NKOCategory
+
+DEFAULT_CENTER = {'latitude': 55.7558, 'longitude': 37.6173}
+
+
+def _cities():
+    return (
+        City.objects
+        .annotate(nko_count=Count('nko', filter=Q(nko__is_approved=True)))
+        .values('id', 'name', 'region', 'latitude', 'longitude', 'nko_count')
+        .order_by('name')
+    )
+
+
+def _categories():
+    return (
+        NKOCategory.objects
+        .annotate(nko_count=Count('nko', filter=Q(nko__is_approved=True)))
+        .values('id', 'name', 'color', 'nko_count')
+        .order_by('id')
+    )
+
+
+def _build_stats():
+    return _summarize(get_version(), list(_cities()), list(_categories()))
+
+
+async def _abuild_stats():
+    version = await aget_version()
+    cities = [city async for city in _cities()]
+    categories = [category async for category in _categories()]
+    return _summarize(version, cities, categories)
+
+
+def _summarize(version, cities, categories):
+    if cities:
+        latitudes = [city['latitude'] for city in cities]
+        longitudes = [city['longitude'] for city in cities]
+        center = {
+            'latitude': sum(latitudes) / len(cities),
+            'longitude': sum(longitudes) / len(cities),
+        }
+        bounds = [[min(latitudes), min(longitudes)], [max(latitudes), max(longitudes)]]
+    else:
+        center, bounds = DEFAULT_CENTER, None
+
+    return {
+        'version': version,
+        'center': center,
+        'bounds': bounds,
+        'total': sum(category['nko_count'] for category in categories),
+        'cities': cities,
+        'categories': categories,
+    }
+
+
+def get_stats():
+    return get_or_build('stats', _build_stats)
+
+
+async def aget_stats():
+    return await aget_or_build('stats', _abuild_stats)
@@ -0,0 +1,119 @@
+"""Дельта-синхронизация набора данных НКО.
+
+Версия набора данных (см. cache.py) — отметка времени в миллисекундах,
+поэтому изменения «после версии V» — это НКО с ``updated_at >= V`` плюс
+надгробия ``NKOTombstone`` для удалённых и снятых с публикации НКО.
+Окно SYNC_OVERLAP_MS покрывает транзакции, которые записали ``updated_at``
+раньше, чем зафиксировались; повторно отданные записи безвредны.
+
+Той же дельтой обновляются индексы в памяти процесса (SyncedIndex).
+"""
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import get_reference_version, get_version
+from .models import NKO, NKOTombstone
+
+SYNC_OVERLAP_MS = 60 * 1000
+# Дельты кешируются по версии клиента: округление вниз до SYNC_BUCKET_MS
+# и сброс слишком старых версий ограничивают число ключей кеша.
+SYNC_BUCKET_MS = 60 * 1000
+SYNC_HORIZON_MS = 7 * 24 * 60 * 60 * 1000
+
+
+def version_to_datetime(version):
+    return datetime.fromtimestamp(max(0, version - SYNC_OVERLAP_MS) / 1000, tz=timezone.utc)
+
+
+def delta_base(since, version, reference_version):
+    """Версия, от которой строится дельта для клиента с версией ``since``.
+
+    Дельта от более ранней версии лишь повторяет часть записей; 0 — клиенту
+    нужен весь список: он отстал больше чем на SYNC_HORIZON_MS или города
+    и категории менялись после его версии. ValueError — такой версии у
+    набора данных не было.
+    """
+    if not 0 <= since <= version:
+        raise ValueError(since)
+    if since < max(reference_version, version - SYNC_HORIZON_MS):
+        return 0
+    return max(since - since % SYNC_BUCKET_MS, reference_version)
+
+
+def changed_since(version):
+    """Запрос одобренных НКО, изменённых после ``version``."""
+    return NKO.objects.filter(is_approved=True, updated_at__gte=version_to_datetime(version))
+
+
+def removed_since(version):
+    """id НКО, пропавших с карты после ``version`` и не вернувшихся на неё."""
+    return list(
+        NKOTombstone.objects
+        .filter(removed_at__gte=version_to_datetime(version))
+        .exclude(nko_id__in=NKO.objects.filter(is_approved=True).values('id'))
+        .values_list('nko_id', flat=True)
+    )
+
+
+def touched_since(version):
+    """id всех НКО, которых касались изменения после ``version``."""
+    since = version_to_datetime(version)
+    ids = set(NKO.objects.filter(updated_at__gte=since).values_list('id', flat=True))
+    ids.update(NKOTombstone.objects.filter(removed_at__gte=since).values_list('nko_id', flat=True))
+    return ids
+
+
+class SyncedIndex(ABC):
+    """Индекс одобренных НКО в памяти процесса, догоняющий версию набора данных.
+
+    Подкласс реализует ``_rebuild()`` — загрузку с нуля — и ``_refresh(ids)``,
+    который перечитывает указанные НКО (удалённые и снятые с публикации
+    из индекса убираются).
+    """
+    # Перестраивать ли индекс целиком при изменении городов или категорий.
+    depends_on_reference_data = False
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._version = None
+
+    @abstractmethod
+    def _rebuild(self):
+        ...
+
+    @abstractmethod
+    def _refresh(self, ids):
+        ...
+
+    def reset(self):
+        """Следующий sync() загрузит индекс с нуля."""
+        with self._lock:
+            self._version = None
+
+    def sync(self):
+        with self._lock:
+            version = get_version()
+            if self._version is None or (
+                self.depends_on_reference_data and get_reference_version() > self._version
+            ):
+                self._rebuild()
+            elif version != self._version:
+                self._refresh(touched_since(self._version))
+            self._version = version
+
+
+@receiver(post_save, sender=NKO)
+def record_unapproval(sender, instance, **kwargs):
+    if not instance.is_approved and getattr(instance, '_loaded_approved', False):
+        NKOTombstone.record([instance.pk])
+    instance._loaded_approved = instance.is_approved
+
+
+@receiver(post_delete, sender=NKO)
+def record_deletion(sender, instance, **kwargs):
+    if instance.is_approved:
+        NKOTombstone.record([instance.pk])
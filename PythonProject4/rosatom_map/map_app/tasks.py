@@ -0,0 +1,183 @@
+"""Фоновые задачи в БД: работа, которую не нужно делать внутри запроса.
+
+Представление ставит задачу в очередь (enqueue) — одна вставка в таблицу
+Task в той же транзакции, что и изменение данных, — и сразу отвечает.
+Выполняет задачи команда run_tasks: воркер с ``--concurrency`` потоками.
+Воркеров можно запустить несколько: задачу получает тот, чей условный
+UPDATE успел первым, блокировки строк не нужны ни в SQLite, ни в PostgreSQL.
+
+Задача — функция, зарегистрированная декоратором @task, с аргументами
+в JSON. Упавшая задача повторяется с экспоненциальной паузой до
+``max_attempts`` раз, потом остаётся в статусе failed с текстом ошибки
+(видно в админке); выполненные задачи удаляются.
+
+Задача с ключом ``key`` существует в одном экземпляре: пока она ждёт,
+повторная постановка ничего не делает (сотня модераций подряд пересоберёт
+снимки один раз), а пока выполняется — запоминается, и после завершения
+та же строка снова встаёт в очередь с новыми аргументами. Так задача
+с ключом никогда не выполняется в двух воркерах сразу.
+
+Задачу упавшего воркера через LEASE_SECONDS снова получает другой воркер;
+такой запуск тоже считается попыткой. Задачи должны укладываться в
+аренду: длинную работу задача делит на части и ставит продолжение
+в очередь сама (см. geocoding.py).
+"""
+import logging
+import threading
+import traceback
+from datetime import timedelta
+
+from django.db import close_old_connections, connection
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 10 * 60
+# пауза перед повтором: RETRY_DELAY, потом вдвое больше и т.д.
+RETRY_DELAY = 30
+
+_registry = {}
+
+
+def task(max_attempts=5):
+    """Регистрирует функцию как фоновую задачу."""
+    def decorator(func):
+        func.task_name = f'{func.__module__}.{func.__qualname__}'
+        func.max_attempts = max_attempts
+        _registry[func.task_name] = func
+        return func
+    return decorator
+
+
+def enqueue(func, *, key=None, delay=0, **kwargs):
+    """Ставит ``func(**kwargs)`` в очередь; с ``key`` — если такая задача ещё не ждёт."""
+    run_after = timezone.now() + timedelta(seconds=delay)
+    if key is not None and Task.objects.filter(key=key, status=Task.RUNNING).update(
+        next_kwargs=kwargs, run_after=run_after,
+    ):
+        # выполняющаяся задача перезапустится после завершения (_restart)
+        return
+    # ignore_conflicts: повтор ключа упирается в уникальный индекс задач
+    Task.objects.bulk_create([Task(
+        name=func.task_name,
+        kwargs=kwargs,
+        key=key,
+        max_attempts=func.max_attempts,
+        run_after=run_after,
+    )], ignore_conflicts=True)
+
+
+def claim():
+    """Забирает следующую готовую задачу или возвращает None."""
+    while True:
+        now = timezone.now()
+        task_id = (
+            Task.objects.filter(status=Task.PENDING, run_after__lte=now)
+            .order_by('run_after', 'id').values_list('id', flat=True).first()
+        )
+        if task_id is None:
+            return None
+        claimed = Task.objects.filter(id=task_id, status=Task.PENDING).update(
+            status=Task.RUNNING,
+            attempts=F('attempts') + 1,
+            locked_until=now + timedelta(seconds=LEASE_SECONDS),
+        )
+        if claimed:
+            return Task.objects.get(id=task_id)
+        # задачу забрал другой воркер — берём следующую
+
+
+def run_task(task):
+    func = _registry.get(task.name)
+    try:
+        if func is None:
+            raise LookupError(f'Неизвестная задача {task.name}')
+        func(**task.kwargs)
+    except Exception:
+        logger.exception('Задача %s #%d упала (попытка %d из %d)', task.name, task.id, task.attempts, task.max_attempts)
+        _fail(task, traceback.format_exc(), retry=func is not None and task.attempts < task.max_attempts)
+    else:
+        if not Task.objects.filter(id=task.id, next_kwargs__isnull=True).delete()[0]:
+            _restart(task)
+
+
+def _restart(task, error=''):
+    """Запуск, запрошенный enqueue во время выполнения, — заново с нуля."""
+    return Task.objects.filter(id=task.id, next_kwargs__isnull=False).update(
+        status=Task.PENDING, kwargs=F('next_kwargs'), next_kwargs=None,
+        attempts=0, last_error=error, locked_until=None,
+    )
+
+
+def _fail(task, error, retry):
+    tasks = Task.objects.filter(id=task.id)
+    if retry:
+        delay = RETRY_DELAY * 2 ** (task.attempts - 1)
+        tasks.update(
+            status=Task.PENDING, last_error=error, locked_until=None,
+            run_after=timezone.now() + timedelta(seconds=delay),
+        )
+    elif not _restart(task, error):
+        tasks.update(status=Task.FAILED, last_error=error, locked_until=None)
+
+
+def requeue_stale():
+    """Возвращает в очередь задачи, воркер которых не уложился в LEASE_SECONDS.
+
+    Такой запуск — тоже попытка: задача, которая роняет воркер, после
+    ``max_attempts`` запусков остаётся в статусе failed.
+    """
+    error = 'Воркер не завершил задачу'
+    stale = Task.objects.filter(status=Task.RUNNING, locked_until__lt=timezone.now())
+    for task in stale.filter(attempts__gte=F('max_attempts')).only('id'):
+        if not _restart(task, error):
+            Task.objects.filter(id=task.id).update(status=Task.FAILED, last_error=error, locked_until=None)
+    stale.update(status=Task.PENDING, last_error=error, locked_until=None)
+
+
+def run_pending():
+    """Выполняет готовые задачи в текущем потоке, пока очередь не опустеет."""
+    count = 0
+    while (task := claim()) is not None:
+        run_task(task)
+        count += 1
+    return count
+
+
+class Worker:
+    """``concurrency`` потоков, каждый забирает и выполняет задачи по одной."""
+
+    def __init__(self, concurrency=1, poll_interval=1.0):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        threads = [
+            threading.Thread(target=self._loop, name=f'tasks-{number}')
+            for number in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        """Потоки доделывают текущие задачи и завершаются."""
+        self.stopping.set()
+
+    def _loop(self):
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                task = claim()
+                if task is None:
+                    requeue_stale()
+                    self.stopping.wait(self.poll_interval)
+                    continue
+                run_task(task)
+        finally:
+            connection.close()
@@ -1,3 +1,1408 @@
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.mail.backends import locmem
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from map_app.admin import EstimatedCountPaginator
+from map_app.benchmark import ENDPOINTS, run_benchmark
+from map_app.cache import REFERENCE_VERSION_KEY, VERSION_KEY, bump_version, get_version, local_cache
+from map_app.clustering import _cell_key, cluster_index, project
+from map_app.geo import cell_ranges, geo_cell
+from map_app.geocoding import Geocoder, RateLimiter
+from map_app.importer import import_nkos, read_csv, read_json
+from map_app.markers import encode_binary
+from map_app.models import City, GeocodeCache, NKOCategory, NKO, Task, UserProfile
+from map_app.moderation import MODERATION_MAX_ITEMS, MODERATION_PAGE_SIZE, moderate, parse_items
+from map_app.nearby import chord_to_km, nearby_index, to_xyz
+from map_app.search import search_index
+from map_app.snapshot import KEEP_VERSIONS, snapshot_dir, write_snapshot
+from map_app.sync import SyncedIndex
+from map_app.tiles import get_tile, tile_of, tile_path
+from map_app.tasks import claim, enqueue, requeue_stale, run_pending, run_task, task
+
+
+def create_dataset(nko_count, seed=1):
+    """Города, категории и ``nko_count`` НКО (каждая четвёртая — на модерации)."""
+    rnd = random.Random(seed)
+    user = User.objects.create_user('author', 'author@example.com', 'password')
+    categories = [
+        NKOCategory.objects.create(name=f'Категория {i}', color=f'#00{i}0a5') for i in range(5)
+    ]
+    cities = [
+        City.objects.create(name=f'Город {i}', region='Регион', latitude=50 + i, longitude=30 + 4 * i)
+        for i in range(8)
+    ]
+    nkos = []
+    for i in range(nko_count):
+        city = rnd.choice(cities)
+        latitude = city.latitude + rnd.uniform(-0.3, 0.3)
+        longitude = city.longitude + rnd.uniform(-0.3, 0.3)
+        nkos.append(NKO(
+            name=f'НКО {i}', description=f'Помощь жителям, проект {i}',
+            category=rnd.choice(categories), city=city, created_by=user,
+            latitude=latitude, longitude=longitude, geo_cell=geo_cell(latitude, longitude),
+            is_approved=i % 4 != 0,
+        ))
+    # bulk_create без save(): сигналы и пересборка снимков на каждую строку не нужны
+    NKO.objects.bulk_create(nkos)
+    return categories, cities
+
+
+# Публичные эндпоинты карты; {city_id}, {category_id} и {nko_id} — из тестовых данных.
+PUBLIC_URLS = [
+    '/',
+    '/api/nkos/',
+    '/api/nkos/?fields=id,name,latitude,longitude',
+    '/api/nkos/?limit=10&cursor={nko_id}',
+    '/api/nkos/?since=1',
+    '/city/{city_id}/nkos/',
+    '/category/{category_id}/nkos/',
+    '/api/nkos/{nko_id}/',
+    '/api/nkos/markers/?format=bin',
+    '/api/nkos/markers/?format=json',
+    '/api/nkos/bbox/?bbox=49,29,52,36&zoom=10',
+    '/api/nkos/nearby/?lat=50&lon=30',
+    '/api/nkos/clusters/?bbox=49,29,52,36&zoom=5',
+    '/tiles/5/18/10.mvt',
+    '/api/stats/',
+    '/api/search/?q=помощь',
+]
+
+
+class MapTestCase(TestCase):
+    """Свежие кеш, снимки, тайлы и индексы в памяти для каждого теста."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        overridden = self.settings(
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            NKO_SNAPSHOT_DIR=f'{directory.name}/snapshots',
+            TILE_CACHE_DIR=f'{directory.name}/tiles',
+        )
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        self.reset_caches()
+
+    def reset_caches(self):
+        cache.clear()
+        local_cache.clear()
+        for index in (cluster_index, nearby_index, search_index):
+            index.reset()
+
+    def load_dataset(self, nko_count):
+        """Создаёт тестовые данные и возвращает PUBLIC_URLS с их id."""
+        categories, cities = create_dataset(nko_count)
+        ids = {
+            'city_id': cities[0].id,
+            'category_id': categories[0].id,
+            'nko_id': NKO.objects.filter(is_approved=True).values_list('id', flat=True).first(),
+        }
+        return [url.format(**ids) for url in PUBLIC_URLS]
+
+    def assertWithinQueryBudget(self, response):
+        """Ответ уложился в бюджет запросов к БД, объявленный у представления."""
+        match = response.resolver_match
+        budget = getattr(match.func, 'query_budget', None)
+        self.assertIsNotNone(budget, f'{match.view_name}: бюджет не объявлен, нужен @query_budget')
+        self.assertLessEqual(
+            response.metrics.queries, budget,
+            f'{match.view_name}: {response.metrics.queries} запросов к БД при бюджете {budget}',
+        )
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN — синтаксис SQLite')
+class PublicQueryPlanTests(MapTestCase):
+    """Публичные запросы к НКО идут по индексам, а не полным проходом таблицы."""
+
+    def setUp(self):
+        super().setUp()
+        self.urls = self.load_dataset(300)
+
+    def query_plans(self, url):
+        """Планы всех запросов к таблице НКО, выполненных при запросе ``url``."""
+        # Запрос должен дойти до БД, а не до кеша или индексов в памяти.
+        self.reset_caches()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+
+        plans = []
+        with connection.cursor() as cursor:
+            for query in queries.captured_queries:
+                if query['sql'].startswith('SELECT') and '"map_app_nko"' in query['sql']:
+                    cursor.execute(f'EXPLAIN QUERY PLAN {query["sql"]}')
+                    plans.append((query['sql'], [row[3] for row in cursor.fetchall()]))
+        return plans
+
+    def test_public_endpoints_use_indexes(self):
+        for url in self.urls:
+            with self.subTest(url=url):
+                plans = self.query_plans(url)
+                self.assertTrue(plans, f'{url} не обращается к таблице НКО')
+                for sql, plan in plans:
+                    # «SCAN map_app_nko USING INDEX ...» — проход по индексу, без USING — по таблице.
+                    self.assertNotIn('SCAN map_app_nko', plan, f'{url}: {sql}')
+
+    def test_public_list_uses_partial_index(self):
+        plans = self.query_plans('/api/nkos/markers/?format=bin')
+        self.assertRegex(plans[0][1][0], r'^SCAN map_app_nko USING (COVERING )?INDEX nko_public_markers_idx$')
+
+    def test_moderation_page_uses_approved_created_index(self):
+        self.client.force_login(User.objects.create_user('moderator', 'moderator@example.com', 'password', is_staff=True))
+        first = self.client.get('/moderation/?status=approved').context['next_cursor']
+        for url in ('/moderation/', '/moderation/?' + urlencode({'status': 'approved', 'cursor': first})):
+            with self.subTest(url=url):
+                page_plans = [plan for sql, plan in self.query_plans(url) if 'ORDER BY' in sql]
+                self.assertEqual(len(page_plans), 1)
+                self.assertTrue(
+                    any('USING INDEX nko_approved_created_idx' in step for step in page_plans[0]), page_plans,
+                )
+                self.assertFalse(any('TEMP B-TREE' in step for step in page_plans[0]), page_plans)
+
+
+class QueryBudgetTests(MapTestCase):
+    """Представления укладываются в бюджеты запросов к БД (@query_budget в views.py)."""
+
+    def setUp(self):
+        super().setUp()
+        self.urls = self.load_dataset(100)
+        self.staff = User.objects.create_user('moderator', 'moderator@example.com', 'password', is_staff=True)
+
+    def test_public_views_on_cold_cache(self):
+        for url in self.urls:
+            with self.subTest(url=url):
+                self.reset_caches()
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertWithinQueryBudget(response)
+
+    def test_public_views_after_dataset_change(self):
+        for url in self.urls:
+            self.client.get(url)
+        pending = NKO.objects.filter(is_approved=False).values_list('id', flat=True)
+        # Индексы в памяти догоняют изменения дельтой, а не перестраиваются.
+        with self.captureOnCommitCallbacks(execute=True):
+            moderate(approve=pending[:3])
+
+        for url in self.urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertWithinQueryBudget(response)
+
+    def test_staff_views(self):
+        self.client.force_login(self.staff)
+        pending = list(NKO.objects.filter(is_approved=False).values_list('id', flat=True)[:20])
+        approved = list(NKO.objects.filter(is_approved=True).values_list('id', flat=True)[:20])
+        items = [{'id': nko_id, 'action': 'approve'} for nko_id in pending]
+        items += [{'id': nko_id, 'action': 'reject'} for nko_id in approved]
+
+        responses = [
+            self.client.get('/'),
+            self.client.get('/moderation/'),
+            self.client.get('/moderation/?status=approved'),
+            self.client.post('/moderation/bulk/', {'items': items}, content_type='application/json'),
+        ]
+        for response in responses:
+            with self.subTest(view=response.resolver_match.view_name):
+                self.assertEqual(response.status_code, 200)
+                self.assertWithinQueryBudget(response)
+
+    def test_server_timing_header(self):
+        response = self.client.get(self.urls[1])
+        self.assertRegex(response['Server-Timing'], r'^db;desc="\d+ SQL";dur=[\d.]+, serialize;dur=[\d.]+, total;dur=[\d.]+$')
+        self.assertEqual(response.metrics.response_bytes, len(response.content))
+
+    def test_metrics_endpoint(self):
+        self.client.get('/api/stats/')
+        # за nginx анонимный запрос приходит с 127.0.0.1
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+        with self.settings(METRICS_ALLOWED_IPS=['10.0.0.5']):
+            response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.5')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('map_app_requests_total{view="api_stats"}', response.content.decode())
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.1').status_code, 403)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.1').status_code, 200)
+
+
+class DatasetVersionTests(MapTestCase):
+    def test_concurrent_bumps_get_distinct_versions(self):
+        started = time.time_ns() // 1_000_000
+        cache.set(VERSION_KEY, started - 60_000, None)
+        versions = []
+        get = LocMemCache.get
+
+        def slow_get(backend, *args, **kwargs):
+            # окно между чтением и записью, как у процессов с общим Redis
+            value = get(backend, *args, **kwargs)
+            time.sleep(0.001)
+            return value
+
+        def bump():
+            for _ in range(50):
+                versions.append(bump_version())
+
+        threads = [threading.Thread(target=bump) for _ in range(8)]
+        with mock.patch.object(LocMemCache, 'get', slow_get):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(set(versions)), 400)
+        # версия догнала часы, но не убежала вперёд
+        self.assertGreaterEqual(get_version(), started)
+        self.assertLessEqual(get_version(), time.time_ns() // 1_000_000 + 400)
+
+    def test_racing_processes_get_distinct_versions_without_atomic_incr(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        file_cache = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory.name}}
+        with self.settings(CACHES=file_cache):
+            stale = bump_version()
+            versions = []
+            # оба воркера прочитали одну и ту же версию до записи другого
+            with mock.patch('map_app.cache.cache.get', return_value=stale):
+                for pid in (1001, 1002):
+                    with mock.patch('map_app.cache.os.getpid', return_value=pid):
+                        versions.append(bump_version())
+            self.assertNotEqual(versions[0], versions[1])
+            self.assertTrue(all(version > stale for version in versions))
+            self.assertEqual(get_version(), versions[1])
+
+
+class ConditionalRequestTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        create_dataset(20)
+
+    def test_compressed_variants_share_a_weak_etag(self):
+        for url in ('/api/nkos/', '/api/nkos/markers/?format=bin'):
+            with self.subTest(url=url):
+                plain = self.client.get(url)
+                packed = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+                self.assertEqual(packed['Content-Encoding'], 'gzip')
+                self.assertIn('Accept-Encoding', packed['Vary'])
+                self.assertTrue(packed['ETag'].startswith('W/"'))
+                self.assertEqual(plain['ETag'], packed['ETag'])
+                revalidated = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=packed['ETag'])
+                self.assertEqual(revalidated.status_code, 304)
+
+
+class FakeBrotli:
+    """Вместо необязательного пакета brotli: проверяется выбор файла, а не сжатие."""
+
+    @staticmethod
+    def compress(data, quality):
+        return b'br:' + data
+
+
+class SnapshotTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        create_dataset(20)
+
+    def test_encoding_follows_accept_encoding(self):
+        with mock.patch('map_app.snapshot.brotli', FakeBrotli):
+            plain = self.client.get('/api/nkos/')
+            packed = self.client.get('/api/nkos/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+            brotli = self.client.get('/api/nkos/', HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertEqual(
+            [nko['id'] for nko in plain.json()['nkos']],
+            list(NKO.objects.filter(is_approved=True).order_by('id').values_list('id', flat=True)),
+        )
+        self.assertEqual(packed['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(packed.content), plain.content)
+        self.assertEqual(brotli['Content-Encoding'], 'br')
+        self.assertEqual(brotli.content, b'br:' + plain.content)
+        for response in (plain, packed, brotli):
+            self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_old_versions_are_pruned(self):
+        versions = []
+        for _ in range(KEEP_VERSIONS + 2):
+            bump_version()
+            versions.append(write_snapshot('nkos'))
+        names = {path.name for path in snapshot_dir().iterdir()}
+        for version in versions[:-KEEP_VERSIONS]:
+            self.assertNotIn(f'nkos-{version}.json', names)
+            self.assertNotIn(f'nkos-{version}.json.gz', names)
+        for version in versions[-KEEP_VERSIONS:]:
+            self.assertIn(f'nkos-{version}.json', names)
+            self.assertIn(f'nkos-{version}.json.gz', names)
+        latest = snapshot_dir() / f'nkos-{versions[-1]}.json'
+        self.assertEqual((snapshot_dir() / 'nkos.json').read_bytes(), latest.read_bytes())
+
+    def test_pruned_snapshot_is_rebuilt(self):
+        version = get_version()
+        self.client.get('/api/nkos/')
+        (snapshot_dir() / f'nkos-{version}.json').unlink()
+        response = self.client.get('/api/nkos/')
+        self.assertEqual(response.json()['version'], version)
+
+    def test_rebuild_snapshot_command(self):
+        directory = snapshot_dir()
+        directory.mkdir(parents=True)
+        for stale in ('nkos-1.json', 'nkos-1.json.gz', 'markers-1.json', 'markers.json'):
+            (directory / stale).write_bytes(b'{}')
+        out = io.StringIO()
+        call_command('rebuild_snapshot', stdout=out)
+
+        version = get_version()
+        self.assertEqual(sorted(path.name for path in directory.iterdir()), sorted(
+            f'{name}{suffix}' for name in ('nkos', f'nkos-{version}', 'markers', f'markers-{version}')
+            for suffix in ('.json', '.json.gz')
+        ))
+        self.assertIn(f'nkos-{version}.json', out.getvalue())
+        snapshot = json.loads((directory / 'markers.json').read_bytes())
+        self.assertEqual(snapshot['version'], version)
+        self.assertEqual(len(snapshot['nkos']), NKO.objects.filter(is_approved=True).count())
+
+
+class NKOListTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        self.categories, self.cities = create_dataset(60)
+
+    def walk(self, url, limit, **params):
+        ids, cursor, pages = [], None, 0
+        while True:
+            response = self.client.get(url, {'limit': limit, **params, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertLessEqual(len(data['nkos']), limit)
+            ids += [nko['id'] for nko in data['nkos']]
+            pages += 1
+            cursor = data['next_cursor']
+            if cursor is None:
+                return ids, pages
+
+    def test_cursor_walks_to_the_end_without_duplicates_or_gaps(self):
+        approved = NKO.objects.filter(is_approved=True)
+        for url, queryset in (
+            ('/api/nkos/', approved),
+            (f'/city/{self.cities[0].id}/nkos/', approved.filter(city=self.cities[0])),
+            (f'/category/{self.categories[0].id}/nkos/', approved.filter(category=self.categories[0])),
+        ):
+            expected = list(queryset.order_by('id').values_list('id', flat=True))
+            for limit in (1, 7, len(expected), len(expected) + 1):
+                with self.subTest(url=url, limit=limit):
+                    ids, pages = self.walk(url, limit)
+                    self.assertEqual(ids, expected)
+                    self.assertEqual(pages, max(1, math.ceil(len(expected) / limit)))
+
+    def test_fields_narrow_the_payload_and_keep_id(self):
+        city_url = f'/city/{self.cities[0].id}/nkos/'
+        for url, params in (
+            ('/api/nkos/', {}), ('/api/nkos/', {'limit': 5}), (city_url, {}), (city_url, {'limit': 5}),
+        ):
+            for fields, expected in (
+                ('name,latitude', {'id', 'name', 'latitude'}),
+                ('longitude, id ,longitude', {'id', 'longitude'}),
+                ('id', {'id'}),
+            ):
+                with self.subTest(url=url, params=params, fields=fields):
+                    response = self.client.get(url, {**params, 'fields': fields})
+                    self.assertEqual(response.status_code, 200)
+                    nkos = response.json()['nkos']
+                    self.assertTrue(nkos)
+                    for nko in nkos:
+                        self.assertEqual(set(nko), expected)
+            with self.subTest(url=url, params=params, fields='password'):
+                self.assertEqual(self.client.get(url, {**params, 'fields': 'name,password'}).status_code, 400)
+
+
+class StatsTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        self.categories, self.cities = create_dataset(60)
+
+    def expected_counts(self, field, objects):
+        approved = NKO.objects.filter(is_approved=True)
+        return {obj.id: approved.filter(**{field: obj}).count() for obj in objects}
+
+    def assertStatsMatchDatabase(self, stats):
+        self.assertEqual(
+            {city['id']: city['nko_count'] for city in stats['cities']}, self.expected_counts('city', self.cities),
+        )
+        self.assertEqual(
+            {category['id']: category['nko_count'] for category in stats['categories']},
+            self.expected_counts('category', self.categories),
+        )
+        self.assertEqual(stats['total'], NKO.objects.filter(is_approved=True).count())
+        self.assertEqual(stats['version'], get_version())
+
+    def test_center_bounds_and_counts(self):
+        stats = self.client.get('/api/stats/').json()
+        # create_dataset: города на широтах 50..57 и долготах 30, 34, ..., 58
+        self.assertEqual(stats['center'], {'latitude': 53.5, 'longitude': 44.0})
+        self.assertEqual(stats['bounds'], [[50, 30], [57, 58]])
+        self.assertEqual([city['name'] for city in stats['cities']], [f'Город {i}' for i in range(8)])
+        self.assertStatsMatchDatabase(stats)
+
+    def test_recomputed_after_moderation_and_city_changes(self):
+        before = self.client.get('/api/stats/').json()
+        pending = NKO.objects.filter(is_approved=False).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            moderate(approve=[pending.id])
+
+        stats = self.client.get('/api/stats/').json()
+        self.assertEqual(stats['total'], before['total'] + 1)
+        counts = {city['id']: city['nko_count'] for city in stats['cities']}
+        counts_before = {city['id']: city['nko_count'] for city in before['cities']}
+        self.assertEqual(counts[pending.city_id], counts_before[pending.city_id] + 1)
+        self.assertGreater(stats['version'], before['version'])
+        self.assertStatsMatchDatabase(stats)
+
+        city = self.cities[7]
+        city.latitude, city.longitude = 65, 70
+        with self.captureOnCommitCallbacks(execute=True):
+            city.save()
+        stats = self.client.get('/api/stats/').json()
+        self.assertEqual(stats['bounds'], [[50, 30], [65, 70]])
+        self.assertEqual(stats['center'], {
+            'latitude': (sum(50 + i for i in range(7)) + 65) / 8,
+            'longitude': (sum(30 + 4 * i for i in range(7)) + 70) / 8,
+        })
+
+
+class BBoxTests(MapTestCase):
+    def test_cell_ranges_cover_bbox(self):
+        rnd = random.Random(3)
+        for south, west, north, east, zoom in ((50.2, 30.1, 51.7, 33.9, None), (-10, -50, 60, 100, 3), (55.75, 37.6, 55.76, 37.62, 14)):
+            ranges = cell_ranges(south, west, north, east, zoom)
+            for _ in range(500):
+                cell = geo_cell(rnd.uniform(south, north), rnd.uniform(west, east))
+                with self.subTest(bbox=(south, west, north, east), cell=cell):
+                    self.assertTrue(any(start <= cell < end for start, end in ranges))
+
+    def test_bbox_matches_brute_force(self):
+        create_dataset(300)
+        approved = NKO.objects.filter(is_approved=True).values_list('id', 'latitude', 'longitude')
+        for south, west, north, east in ((50.5, 30.5, 53.5, 45.0), (49.0, 29.0, 50.2, 31.0)):
+            expected = {
+                nko_id for nko_id, lat, lon in approved
+                if south <= lat <= north and west <= lon <= east
+            }
+            with self.subTest(bbox=(south, west, north, east)):
+                nkos = self.client.get(f'/api/nkos/bbox/?bbox={south},{west},{north},{east}&zoom=8').json()['nkos']
+                self.assertEqual({nko['id'] for nko in nkos}, expected)
+                self.assertTrue(expected)
+
+    def test_non_finite_bbox_is_rejected(self):
+        for bbox in ('nan,0,1,1', '0,0,inf,1', '0,-inf,1,1'):
+            for url in (f'/api/nkos/bbox/?bbox={bbox}&zoom=10', f'/api/nkos/clusters/?bbox={bbox}&zoom=5'):
+                with self.subTest(url=url):
+                    self.assertEqual(self.client.get(url).status_code, 400)
+
+
+class NearbyTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        create_dataset(300)
+
+    def test_matches_brute_force(self):
+        points = NKO.objects.filter(is_approved=True).values_list('id', 'latitude', 'longitude')
+        for lat, lon in ((50.1, 30.2), (53.7, 58.9), (40.0, 10.0)):
+            target = to_xyz(lat, lon)
+            expected = sorted(
+                (chord_to_km(math.dist(target, to_xyz(nko_lat, nko_lon))), nko_id)
+                for nko_id, nko_lat, nko_lon in points
+            )
+            with self.subTest(lat=lat, lon=lon):
+                nkos = self.client.get(f'/api/nkos/nearby/?lat={lat}&lon={lon}&k=7').json()['nkos']
+                self.assertEqual([nko['id'] for nko in nkos], [nko_id for _, nko_id in expected[:7]])
+                radius = expected[3][0] + 0.001
+                nkos = self.client.get(f'/api/nkos/nearby/?lat={lat}&lon={lon}&k=50&radius_km={radius}').json()['nkos']
+                self.assertEqual(len(nkos), 4)
+
+    def test_invalid_radius(self):
+        for radius in ('-1', '0', 'nan', 'inf'):
+            with self.subTest(radius=radius):
+                response = self.client.get(f'/api/nkos/nearby/?lat=50&lon=30&radius_km={radius}')
+                self.assertEqual(response.status_code, 400)
+
+    def test_stale_index_never_serves_unapproved(self):
+        nearest = self.client.get('/api/nkos/nearby/?lat=50&lon=30&k=1').json()['nkos'][0]
+        # update() без сигналов: индекс ещё не знает о снятии с публикации
+        NKO.objects.filter(id=nearest['id']).update(is_approved=False)
+        nkos = self.client.get('/api/nkos/nearby/?lat=50&lon=30&k=1').json()['nkos']
+        self.assertNotIn(nearest['id'], [nko['id'] for nko in nkos])
+        self.assertEqual(len(nkos), 1)
+
+    def test_stale_index_still_returns_k_nearest(self):
+        url = '/api/nkos/nearby/?lat=50&lon=30&k=5'
+        before = [nko['id'] for nko in self.client.get(url).json()['nkos']]
+        hidden = before[:2] + before[3:4]
+        NKO.objects.filter(id__in=hidden).update(is_approved=False)
+        nkos = self.client.get(url).json()['nkos']
+        ids = [nko['id'] for nko in nkos]
+        self.assertEqual(ids[:2], [before[2], before[4]])
+        self.assertEqual(len(ids), 5)
+        self.assertFalse(set(ids) & set(hidden))
+        distances = [nko['distance_km'] for nko in nkos]
+        self.assertEqual(distances, sorted(distances))
+
+
+def _varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, offset
+
+
+def _packed(data):
+    values, offset = [], 0
+    while offset < len(data):
+        value, offset = _varint(data, offset)
+        values.append(value)
+    return values
+
+
+def _protobuf_fields(data):
+    """Поля сообщения protobuf: [(номер, значение)], только varint и bytes."""
+    fields, offset = [], 0
+    while offset < len(data):
+        key, offset = _varint(data, offset)
+        if key & 7 == 0:
+            value, offset = _varint(data, offset)
+        else:
+            length, offset = _varint(data, offset)
+            value, offset = data[offset:offset + length], offset + length
+        fields.append((key >> 3, value))
+    return fields
+
+
+def decode_mvt(data):
+    """Точки слоя тайла: [(id или None, x, y, {свойство: значение})]."""
+    if not data:
+        return []
+    (_, layer), = _protobuf_fields(data)
+    layer = _protobuf_fields(layer)
+    keys = [value.decode() for number, value in layer if number == 3]
+    values = [_protobuf_fields(value)[0][1] for number, value in layer if number == 4]
+    points = []
+    for feature in (value for number, value in layer if number == 2):
+        feature = dict(_protobuf_fields(feature))
+        _, x, y = _packed(feature[4])
+        tags = _packed(feature[2])
+        properties = {keys[tags[i]]: values[tags[i + 1]] for i in range(0, len(tags), 2)}
+        points.append((feature.get(1), (x >> 1) ^ -(x & 1), (y >> 1) ^ -(y & 1), properties))
+    return points
+
+
+def decode_markers(data):
+    """Разбор NKM1 так же, как decodeMarkers в map.html: (meta, [(id, lat, lon, категория, город)])."""
+    magic, count, meta_length = struct.unpack_from('<4sII', data)
+    assert magic == b'NKM1'
+    offset = 12
+    columns = []
+    for code, size in ('i', 4), ('i', 4), ('i', 4), ('H', 2), ('H', 2):
+        columns.append(struct.unpack_from(f'<{count}{code}', data, offset))
+        offset += count * size
+    meta = json.loads(data[offset:offset + meta_length])
+    assert offset + meta_length == len(data)
+    return meta, list(zip(*columns))
+
+
+class MarkerTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        create_dataset(50)
+
+    def test_binary_markers_decode_to_approved_nkos(self):
+        meta, markers = decode_markers(self.client.get('/api/nkos/markers/?format=bin').content)
+        packed = self.client.get('/api/nkos/markers/?format=bin', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(decode_markers(gzip.decompress(packed.content)), (meta, markers))
+
+        approved = list(NKO.objects.filter(is_approved=True).select_related('category', 'city').order_by('id'))
+        self.assertEqual(meta['version'], get_version())
+        self.assertEqual(meta['names'], [nko.name for nko in approved])
+        self.assertEqual(len(markers), len(approved))
+        for nko, (nko_id, lat, lon, category, city) in zip(approved, markers):
+            self.assertEqual(nko_id, nko.id)
+            self.assertAlmostEqual(lat / meta['scale'], nko.latitude, places=6)
+            self.assertAlmostEqual(lon / meta['scale'], nko.longitude, places=6)
+            self.assertEqual(meta['categories'][category]['id'], nko.category_id)
+            self.assertEqual(meta['categories'][category]['name'], nko.category.name)
+            self.assertEqual(meta['cities'][city], {'id': nko.city_id, 'name': str(nko.city)})
+
+    def test_gzip_follows_the_version_of_its_payload(self):
+        pending = NKO.objects.filter(is_approved=False).first()
+
+        def encode_then_change(markers):
+            # одобрение зафиксировано между сборкой маркеров и их сжатием
+            NKO.objects.filter(id=pending.id).update(is_approved=True)
+            bump_version()
+            return encode_binary(markers)
+
+        with mock.patch('map_app.views.encode_binary', encode_then_change):
+            self.client.get('/api/nkos/markers/?format=bin', HTTP_ACCEPT_ENCODING='gzip')
+        packed = self.client.get('/api/nkos/markers/?format=bin', HTTP_ACCEPT_ENCODING='gzip')
+        meta, markers = decode_markers(gzip.decompress(packed.content))
+        self.assertEqual(meta['version'], get_version())
+        self.assertIn(pending.id, [marker[0] for marker in markers])
+
+    def test_json_and_binary_markers_agree(self):
+        columns = self.client.get('/api/nkos/markers/?format=json').json()
+        meta, markers = decode_markers(self.client.get('/api/nkos/markers/?format=bin').content)
+        self.assertEqual(columns['count'], len(markers))
+        self.assertEqual(list(zip(columns['ids'], columns['lat'], columns['lon'], columns['category'], columns['city'])), markers)
+        self.assertEqual({key: columns[key] for key in meta}, meta)
+
+
+class TileTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        create_dataset(200)
+
+    def test_tile_decodes_to_clusters(self):
+        approved = NKO.objects.filter(is_approved=True)
+        points = decode_mvt(self.client.get('/tiles/0/0/0.mvt').content)
+        self.assertEqual(sum(properties['count'] for *_, properties in points), approved.count())
+        for _, x, y, properties in points:
+            self.assertTrue(0 <= x < 4096 and 0 <= y < 4096)
+            self.assertIn(properties['category_id'], set(approved.values_list('category_id', flat=True)))
+
+        nko = approved.first()
+        single = [point for point in decode_mvt(get_tile(*tile_of(nko.latitude, nko.longitude, 16))) if point[0] == nko.id]
+        self.assertEqual(single[0][3], {'count': 1, 'category_id': nko.category_id})
+
+    def test_tile_built_during_a_change_is_not_kept(self):
+        nko = NKO.objects.filter(is_approved=True).first()
+        tile = tile_of(nko.latitude, nko.longitude, 10)
+        replace = os.replace
+
+        def replace_then_change(source, target):
+            # изменение и инвалидация прошли между проверкой версии и записью
+            replace(source, target)
+            bump_version()
+
+        with mock.patch('map_app.tiles.os.replace', replace_then_change):
+            get_tile(*tile)
+        self.assertFalse(tile_path(*tile).exists())
+        get_tile(*tile)
+        self.assertTrue(tile_path(*tile).exists())
+
+    def test_import_invalidates_only_touched_tiles(self):
+        cities = list(City.objects.order_by('id'))
+        near, far = (tile_of(city.latitude, city.longitude, 10) for city in cities[:2])
+        for tile in (near, far, (0, 0, 0)):
+            get_tile(*tile)
+        registry = f'external_id,name,category,city\nB1,Новая,Категория 0,{cities[0].name}\n'
+        with self.captureOnCommitCallbacks(execute=True):
+            import_nkos(read_csv(io.StringIO(registry)), User.objects.get(username='author'), approve=True)
+        self.assertFalse(tile_path(*near).exists())
+        self.assertFalse(tile_path(0, 0, 0).exists())
+        self.assertTrue(tile_path(*far).exists())
+
+
+class ClusterTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        create_dataset(300)
+
+    def expected_clusters(self, zoom, category_id=None):
+        """Ячейка -> (количество, средняя широта, средняя долгота) полным перебором."""
+        cells = {}
+        nkos = NKO.objects.filter(is_approved=True)
+        if category_id is not None:
+            nkos = nkos.filter(category_id=category_id)
+        for lat, lon in nkos.values_list('latitude', 'longitude'):
+            cell = cells.setdefault(_cell_key(*project(lat, lon), zoom), [0, 0.0, 0.0])
+            cell[0] += 1
+            cell[1] += lat
+            cell[2] += lon
+        return {key: (count, lat / count, lon / count) for key, (count, lat, lon) in cells.items()}
+
+    def actual_clusters(self, zoom, category=''):
+        url = f'/api/nkos/clusters/?bbox=-85,-180,85,180&zoom={zoom}&category={category}'
+        clusters = self.client.get(url).json()['clusters']
+        # центр кластера лежит в его ячейке
+        return {
+            _cell_key(*project(cluster['latitude'], cluster['longitude']), zoom): (
+                cluster['count'], cluster['latitude'], cluster['longitude'],
+            )
+            for cluster in clusters
+        }
+
+    def assertClustersEqual(self, actual, expected):
+        self.assertEqual(actual.keys(), expected.keys())
+        for key, (count, lat, lon) in expected.items():
+            self.assertEqual(actual[key][0], count)
+            self.assertAlmostEqual(actual[key][1], lat)
+            self.assertAlmostEqual(actual[key][2], lon)
+
+    def test_counts_and_centroids(self):
+        for zoom in (0, 4, 7, 12):
+            with self.subTest(zoom=zoom):
+                self.assertClustersEqual(self.actual_clusters(zoom), self.expected_clusters(zoom))
+        category_id = NKOCategory.objects.order_by('id').values_list('id', flat=True)[1]
+        self.assertClustersEqual(self.actual_clusters(7, category_id), self.expected_clusters(7, category_id))
+
+    def test_index_follows_moderation(self):
+        self.actual_clusters(4)
+        pending = NKO.objects.filter(is_approved=False).values_list('id', flat=True)
+        approved = NKO.objects.filter(is_approved=True).values_list('id', flat=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            moderate(approve=pending[:10], reject=approved[:5])
+        self.assertClustersEqual(self.actual_clusters(4), self.expected_clusters(4))
+
+
+class SearchTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        self.categories, self.cities = create_dataset(0)
+        author = User.objects.get(username='author')
+        texts = [
+            ('Помощь бездомным животным', 'Кормим и лечим', 0, 0),
+            ('Приют для собак', 'Помогаем бездомным животным найти дом', 1, 0),
+            ('Экологический клуб', 'Субботники в парках, заботимся о животных', 0, 1),
+            ('Скрытая НКО о животных', 'На модерации', 0, 0),
+        ]
+        for number, (name, description, category, city) in enumerate(texts):
+            city = self.cities[city]
+            NKO.objects.create(
+                name=name, description=description, category=self.categories[category], city=city,
+                created_by=author, latitude=city.latitude, longitude=city.longitude, is_approved=number < 3,
+            )
+
+    def search(self, query, **params):
+        return self.client.get('/api/search/', {'q': query, **params}).json()
+
+    def names(self, result):
+        return [item['name'] for item in result['results']]
+
+    def test_ranking_prefers_name_matches(self):
+        # слово в названии весит больше, чем в описании; НКО на модерации не ищутся
+        names = self.names(self.search('животные'))
+        self.assertEqual(names[0], 'Помощь бездомным животным')
+        self.assertCountEqual(names[1:], ['Приют для собак', 'Экологический клуб'])
+        # все слова запроса обязательны, последнее ищется как префикс
+        self.assertEqual(self.names(self.search('бездомные жив')), ['Помощь бездомным животным', 'Приют для собак'])
+        self.assertEqual(self.names(self.search('собаки')), ['Приют для собак'])
+        self.assertEqual(self.search('пингвины')['total'], 0)
+
+    def test_facets_ignore_own_filter(self):
+        result = self.search('животные', category=self.categories[0].id)
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(
+            [(facet['id'], facet['count']) for facet in result['facets']['categories']],
+            [(self.categories[0].id, 2), (self.categories[1].id, 1)],
+        )
+        self.assertEqual(
+            [(facet['id'], facet['count']) for facet in result['facets']['cities']],
+            [(self.cities[0].id, 2), (self.cities[1].id, 1)],
+        )
+        first, second = self.search('животные', page_size=2), self.search('животные', page=2, page_size=2)
+        self.assertEqual((second['total'], len(second['results'])), (3, 1))
+        self.assertEqual(self.names(first) + self.names(second), self.names(self.search('животные')))
+
+
+class DeltaSyncTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        create_dataset(20)
+
+    def test_delta_reports_added_changed_and_removed(self):
+        now = time.time_ns() // 1_000_000
+        NKO.objects.update(created_at=timezone.now() - timedelta(hours=1), updated_at=timezone.now() - timedelta(hours=1))
+        cache.set(REFERENCE_VERSION_KEY, now - 30 * 60_000, None)
+        since = now - 20 * 60_000
+
+        approved = list(NKO.objects.filter(is_approved=True).order_by('id'))
+        pending = NKO.objects.filter(is_approved=False).order_by('id').first()
+        edited, rejected, deleted = approved[:3]
+        edited.name = 'Новое название'
+        edited.save()
+        moderate(approve=[pending.id], reject=[rejected.id])
+        deleted_id = deleted.id
+        deleted.delete()
+        added = NKO.objects.create(
+            name='Новая НКО', description='', category=edited.category, city=edited.city,
+            created_by=edited.created_by, latitude=50, longitude=30, is_approved=True,
+        )
+        cache.set(VERSION_KEY, time.time_ns() // 1_000_000, None)
+
+        delta = self.client.get(f'/api/nkos/?since={since}').json()
+        self.assertNotIn('reset', delta)
+        self.assertEqual([nko['id'] for nko in delta['added']], [added.id])
+        self.assertEqual(sorted(nko['id'] for nko in delta['changed']), sorted([edited.id, pending.id]))
+        self.assertEqual(sorted(delta['removed']), sorted([rejected.id, deleted_id]))
+
+        # вернувшаяся на карту НКО уходит из removed, несмотря на надгробие
+        moderate(approve=[rejected.id])
+        cache.set(VERSION_KEY, time.time_ns() // 1_000_000 + 1, None)
+        delta = self.client.get(f'/api/nkos/?since={since}').json()
+        self.assertEqual(delta['removed'], [deleted_id])
+        self.assertIn(rejected.id, [nko['id'] for nko in delta['changed']])
+
+    def test_invalid_since_and_cursor(self):
+        version = self.client.get('/api/nkos/?limit=1').json()['version']
+        for query in ('since=99999999999999999', 'since=-1', f'since={version + 1}', 'since=abc', 'cursor=abc'):
+            with self.subTest(query=query):
+                response = self.client.get(f'/api/nkos/?{query}')
+                self.assertEqual(response.status_code, 400)
+                self.assertNotIn('abc', response.json()['error'])
+
+    def test_since_is_bucketed(self):
+        minute = 60 * 1000
+        cache.set(REFERENCE_VERSION_KEY, 20_000_000 * minute - minute, None)
+        cache.set(VERSION_KEY, 20_000_000 * minute + 50_000, None)
+        first = self.client.get(f'/api/nkos/?since={20_000_000 * minute + 40_000}').json()
+        second = self.client.get(f'/api/nkos/?since={20_000_000 * minute + 10_000}').json()
+        # одна запись кеша на минуту версий
+        self.assertEqual(first['since'], 20_000_000 * minute)
+        self.assertEqual(second['since'], 20_000_000 * minute)
+        # клиент старше последней правки городов получает весь список
+        self.assertTrue(self.client.get(f'/api/nkos/?since={20_000_000 * minute - 2 * minute}').json()['reset'])
+
+    def test_index_without_refresh_cannot_be_created(self):
+        class RebuildOnlyIndex(SyncedIndex):
+            def _rebuild(self):
+                pass
+
+        with self.assertRaises(TypeError):
+            RebuildOnlyIndex()
+
+
+class BenchmarkTests(MapTestCase):
+    def test_run_benchmark(self):
+        with redirect_stdout(io.StringIO()):
+            call_command('load_initial_data')
+        results = run_benchmark([40, 80], requests=3)
+
+        self.assertEqual(NKO.objects.count(), 80)
+        self.assertEqual([(r['size'], r['endpoint']) for r in results], [
+            (size, name) for size in (40, 80) for name, _ in ENDPOINTS
+        ])
+        for result in results:
+            with self.subTest(size=result['size'], endpoint=result['endpoint']):
+                self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+                self.assertGreater(result['cold_queries'], 0)
+                self.assertGreater(result['response_bytes'], 0)
+                self.assertGreater(result['peak_memory_kb'], 0)
+
+
+class ImportTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        create_dataset(0)
+        self.author = User.objects.get(username='author')
+
+    def test_import_csv_upserts_by_external_id(self):
+        registry = (
+            'external_id,name,category,city,latitude,longitude,website\n'
+            'A1,Первая,категория 0,Город 1,51.5,34.5,\n'
+            'A2,Вторая,Категория 1,  город 2 ,,,https://example.com\n'
+            'A3,Без города,Категория 1,Атлантида,,,\n'
+            'A4,Плохие координаты,Категория 1,Город 1,north,34,\n'
+        )
+        errors = []
+        stats = import_nkos(read_csv(io.StringIO(registry)), self.author, batch_size=2,
+                            on_error=lambda number, message: errors.append(number))
+        self.assertEqual((stats['created'], stats['updated'], stats['skipped']), (2, 0, 2))
+        self.assertEqual(errors, [3, 4])
+        first, second = NKO.objects.order_by('external_id')
+        self.assertEqual(first.geo_cell, geo_cell(51.5, 34.5))
+        self.assertFalse(first.is_approved)
+        # без координат — центр города
+        self.assertEqual((second.latitude, second.longitude), (second.city.latitude, second.city.longitude))
+
+        stats = import_nkos(read_csv(io.StringIO(registry.replace('Первая', 'Первая НКО'))), self.author, approve=True)
+        self.assertEqual((stats['created'], stats['updated']), (0, 2))
+        first = NKO.objects.get(external_id='A1')
+        self.assertEqual((first.name, first.is_approved), ('Первая НКО', True))
+
+    def test_read_json_streams_array_and_lines(self):
+        records = [{'external_id': str(i), 'name': 'НКО, «запятые» и [скобки]'} for i in range(5)]
+        array = json.dumps(records, ensure_ascii=False, indent=2)
+        lines = '\n'.join(json.dumps(record, ensure_ascii=False) for record in records)
+        for text in (array, lines, '[]', ''):
+            with self.subTest(text=text[:10]):
+                expected = records if text.strip('[]') else []
+                self.assertEqual(list(read_json(io.StringIO(text), chunk_size=7)), expected)
+        with self.assertRaises(json.JSONDecodeError):
+            list(read_json(io.StringIO(array[:-5])))
+
+
+class ExportTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        create_dataset(40)
+        self.approved = NKO.objects.filter(is_approved=True).count()
+
+    def test_csv_and_geojson(self):
+        response = self.client.get('/api/nkos/export.csv')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="nkos.csv"')
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8-sig'))))
+        self.assertEqual(rows[0][:3], ['id', 'name', 'category'])
+        self.assertEqual(len(rows), self.approved + 1)
+
+        response = self.client.get('/api/nkos/export.geojson')
+        features = json.loads(b''.join(response.streaming_content))['features']
+        self.assertEqual(len(features), self.approved)
+        nko = NKO.objects.get(id=features[0]['id'])
+        self.assertEqual(features[0]['geometry']['coordinates'], [nko.longitude, nko.latitude])
+        self.assertEqual(features[0]['properties']['name'], nko.name)
+
+    def test_csv_cells_are_not_formulas(self):
+        NKO.objects.filter(is_approved=True).update(name='=HYPERLINK("http://evil.example")', address='-1+2')
+        rows = list(csv.reader(io.StringIO(
+            b''.join(self.client.get('/api/nkos/export.csv').streaming_content).decode('utf-8-sig'),
+        )))
+        header = rows[0]
+        self.assertEqual(rows[1][header.index('name')], '\'=HYPERLINK("http://evil.example")')
+        self.assertEqual(rows[1][header.index('address')], "'-1+2")
+        # числа и координаты не меняются
+        self.assertFalse(rows[1][header.index('latitude')].startswith("'"))
+
+    def test_full_export_for_staff_only(self):
+        self.assertEqual(self.client.get('/api/nkos/export.ndjson?all=1').status_code, 403)
+        self.assertEqual(self.client.get('/api/nkos/export.xml').status_code, 404)
+        staff = User.objects.create_user('moderator', 'moderator@example.com', 'password', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get('/api/nkos/export.ndjson?all=1')
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 40)
+        self.assertEqual(sum(not json.loads(line)['is_approved'] for line in lines), 40 - self.approved)
+
+    async def test_async_stream(self):
+        response = await self.async_client.get('/api/nkos/export.ndjson')
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual(len(b''.join(chunks).splitlines()), self.approved)
+
+
+class ModerationTests(MapTestCase):
+    def test_parse_items(self):
+        items = [{'id': 1, 'action': 'approve'}, {'id': 2, 'action': 'reject'}, {'id': 1, 'action': 'approve'}]
+        self.assertEqual(parse_items({'items': items}), ([1], [2]))
+        self.assertEqual(parse_items({'items': []}), ([], []))
+
+    def test_parse_items_rejects_invalid_input(self):
+        too_many = [{'id': i, 'action': 'approve'} for i in range(MODERATION_MAX_ITEMS + 1)]
+        for data in (
+            None, [], {}, {'items': None}, {'items': {'id': 1}}, {'items': too_many},
+            {'items': [1]}, {'items': [{'id': 1}]}, {'items': [{'action': 'approve'}]},
+            {'items': [{'id': '1', 'action': 'approve'}]}, {'items': [{'id': True, 'action': 'approve'}]},
+            {'items': [{'id': 1, 'action': 'delete'}]},
+            {'items': [{'id': 1, 'action': 'approve'}, {'id': 1, 'action': 'reject'}]},
+        ):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                parse_items(data)
+
+    def test_bulk_view_rejects_invalid_items(self):
+        create_dataset(8)
+        self.client.force_login(User.objects.create_user('moderator', 'moderator@example.com', 'password', is_staff=True))
+        pending = NKO.objects.filter(is_approved=False).first()
+        for body in ('{', json.dumps({'items': [{'id': pending.id, 'action': 'delete'}]})):
+            with self.subTest(body=body):
+                response = self.client.post('/moderation/bulk/', body, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+        pending.refresh_from_db()
+        self.assertFalse(pending.is_approved)
+
+
+class ModerationDashboardTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        _, self.cities = create_dataset(240)
+        self.client.force_login(User.objects.create_user('moderator', 'moderator@example.com', 'password', is_staff=True))
+
+    def walk(self, query):
+        ids, cursor = [], None
+        while True:
+            response = self.client.get('/moderation/', {**query, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            page = [nko.id for nko in response.context['nkos']]
+            self.assertLessEqual(len(page), MODERATION_PAGE_SIZE)
+            ids += page
+            cursor = response.context['next_cursor']
+            if cursor is None:
+                return ids
+
+    def test_cursor_walks_every_nko_once_newest_first(self):
+        for approved, status in ((False, 'pending'), (True, 'approved')):
+            with self.subTest(status=status):
+                expected = list(
+                    NKO.objects.filter(is_approved=approved).order_by('-created_at', '-id').values_list('id', flat=True)
+                )
+                self.assertGreater(len(expected), MODERATION_PAGE_SIZE)
+                self.assertEqual(self.walk({'status': status}), expected)
+
+    def test_filters(self):
+        city = self.cities[0]
+        old = list(NKO.objects.filter(city=city).values_list('id', flat=True)[:5])
+        NKO.objects.filter(id__in=old).update(created_at=timezone.now() - timedelta(days=10))
+        day = (timezone.localtime() - timedelta(days=10)).date()
+
+        self.assertEqual(
+            sorted(self.walk({'status': 'approved', 'city': city.id})),
+            sorted(NKO.objects.filter(city=city, is_approved=True).values_list('id', flat=True)),
+        )
+        self.assertEqual(
+            sorted(self.walk({'status': 'approved', 'date_from': day, 'date_to': day})
+                   + self.walk({'status': 'pending', 'date_from': day, 'date_to': day})),
+            sorted(old),
+        )
+        recent = self.walk({'status': 'approved', 'date_from': day + timedelta(days=1)})
+        self.assertFalse(set(recent) & set(old))
+        response = self.client.get('/moderation/', {'city': city.id})
+        self.assertEqual(response.context['counts']['total'], NKO.objects.filter(city=city).count())
+
+    def test_invalid_parameters_are_rejected(self):
+        for query in (
+            {'cursor': 'garbage'}, {'cursor': '2024-01-01T00:00:00_1'}, {'cursor': '2024-01-01T00:00:00+00:00_x'},
+            {'date_from': '31.02.2024'}, {'date_to': 'вчера'}, {'city': 'x'}, {'status': 'deleted'},
+        ):
+            with self.subTest(query=query):
+                response = self.client.get('/moderation/', query)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(list(response.context['nkos']), [])
+                self.assertContains(response, 'Некорректный фильтр', status_code=400)
+
+
+class AdminModerationTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        create_dataset(40)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.pending = NKO.objects.filter(is_approved=False).first()
+        self.approved = NKO.objects.filter(is_approved=True).first()
+
+    def moderate_url(self, nko, action):
+        return f'/admin/map_app/nko/{nko.id}/moderate/{action}/'
+
+    def test_buttons_moderate_by_post_only(self):
+        response = self.client.get(self.moderate_url(self.pending, 'approve'))
+        self.assertEqual(response.status_code, 405)
+        self.pending.refresh_from_db()
+        self.assertFalse(self.pending.is_approved)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.moderate_url(self.pending, 'approve'))
+            self.client.post(self.moderate_url(self.approved, 'reject'))
+        self.assertRedirects(response, '/admin/map_app/nko/')
+        self.pending.refresh_from_db()
+        self.approved.refresh_from_db()
+        self.assertTrue(self.pending.is_approved)
+        self.assertFalse(self.approved.is_approved)
+        self.assertEqual(self.client.post(self.moderate_url(self.pending, 'delete')).status_code, 404)
+
+    def test_old_get_links_do_not_write(self):
+        for action, nko in (('approve', self.pending), ('reject', self.approved)):
+            with self.subTest(action=action):
+                self.client.get('/admin/map_app/nko/', {'action': action, 'id': nko.id})
+                is_approved = nko.is_approved
+                nko.refresh_from_db()
+                self.assertEqual(nko.is_approved, is_approved)
+
+    def test_estimated_count_skips_empty_trailing_pages(self):
+        with mock.patch.object(EstimatedCountPaginator, 'exact_count_limit', 10):
+            paginator = EstimatedCountPaginator(NKO.objects.order_by('-id'), 20)
+            self.assertEqual(paginator.num_pages, 2)
+            # MAX(rowid) не уменьшается от удаления первых строк
+            NKO.objects.filter(id__in=NKO.objects.order_by('id').values('id')[:25]).delete()
+            paginator = EstimatedCountPaginator(NKO.objects.order_by('-id'), 20)
+            self.assertEqual((paginator.count, paginator.num_pages), (15, 1))
+
+            changelist = self.client.get('/admin/map_app/nko/').context['cl']
+            self.assertEqual(changelist.paginator.num_pages, 1)
+
+
+class EventStreamTests(MapTestCase):
+    def test_wsgi_has_no_stream(self):
+        # под WSGI карта опрашивает ?since= вместо потока
+        self.assertEqual(self.client.get('/api/nkos/events/').status_code, 204)
+
+    async def test_asgi_stream(self):
+        response = await self.async_client.get('/api/nkos/events/')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = aiter(response.streaming_content)
+        self.assertRegex(await anext(chunks), rb'^id: \d+\nretry: \d+\n\n$')
+        await chunks.aclose()
+
+
+class StubNominatim(BaseHTTPRequestHandler):
+    """Локальная замена Nominatim: адреса из ``places``, запрос на «сбой» — HTTP 500."""
+
+    places = {'ул. Ленина, 1': (51.25, 34.5)}
+    queries = []
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)['q'][0]
+        self.queries.append(query)
+        if query.startswith('сбой'):
+            self.send_error(500)
+            return
+        results = [
+            {'lat': str(lat), 'lon': str(lon)}
+            for address, (lat, lon) in self.places.items() if query.startswith(address)
+        ]
+        body = json.dumps(results).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class GeocodingTests(MapTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubNominatim)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        cls.addClassCleanup(server.server_close)
+        cls.addClassCleanup(server.shutdown)
+        cls.geocoder_url = f'http://127.0.0.1:{server.server_port}/search'
+
+    def setUp(self):
+        super().setUp()
+        StubNominatim.queries.clear()
+        overridden = self.settings(GEOCODER={
+            'BACKEND': 'map_app.geocoding.NominatimGeocoder', 'URL': self.geocoder_url, 'RATE': 0,
+        })
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        self.categories, self.cities = create_dataset(0)
+
+    def add_nko(self, username, address):
+        self.client.force_login(User.objects.create_user(username, f'{username}@example.com', 'password'))
+        self.client.post('/add-nko/', {
+            'name': f'НКО {username}', 'category': self.categories[0].id, 'city': self.cities[1].id,
+            'description': 'Помощь', 'address': address,
+        })
+        return NKO.objects.get(created_by__username=username)
+
+    def geocode(self):
+        call_command('geocode_nko', stdout=io.StringIO())
+
+    def test_form_uses_cache_and_worker_resolves(self):
+        city = self.cities[1]
+        nko = self.add_nko('first', 'ул. Ленина, 1')
+        # форма не обращается к геокодеру: центр города до прохода geocode_nko
+        self.assertEqual((nko.latitude, nko.longitude, nko.geocode_pending), (city.latitude, city.longitude, True))
+        self.assertEqual(StubNominatim.queries, [])
+
+        self.geocode()
+        nko.refresh_from_db()
+        self.assertEqual((nko.latitude, nko.longitude, nko.geocode_pending), (51.25, 34.5, False))
+        self.assertEqual(nko.geo_cell, geo_cell(51.25, 34.5))
+        self.assertEqual(StubNominatim.queries, ['ул. Ленина, 1, Город 1, Регион'])
+
+        # тот же адрес в другой записи берётся из кеша сразу
+        other = self.add_nko('second', 'г. Город 1, улица  Ленина, д. 1')
+        self.assertEqual((other.latitude, other.longitude, other.geocode_pending), (51.25, 34.5, False))
+        self.assertEqual(len(StubNominatim.queries), 1)
+
+    def test_failed_addresses_stay_pending(self):
+        failing = self.add_nko('first', 'сбой')
+        unknown = self.add_nko('second', 'Нигде, 5')
+        with self.assertLogs('map_app.geocoding', 'WARNING'):
+            self.geocode()
+        failing.refresh_from_db()
+        unknown.refresh_from_db()
+        self.assertTrue(failing.geocode_pending)
+        self.assertFalse(unknown.geocode_pending)
+        self.assertEqual((unknown.latitude, unknown.longitude), (self.cities[1].latitude, self.cities[1].longitude))
+        self.assertIsNone(GeocodeCache.objects.get().latitude)
+
+        # «не найдено» закешировано, повторно запрашивается только сбойный адрес
+        StubNominatim.queries.clear()
+        with self.assertLogs('map_app.geocoding', 'WARNING'):
+            self.geocode()
+        self.assertEqual(len(StubNominatim.queries), 1)
+        self.assertTrue(StubNominatim.queries[0].startswith('сбой'))
+
+    def test_background_task_goes_batch_by_batch(self):
+        nkos = [self.add_nko(f'user{i}', address) for i, address in enumerate(['ул. Ленина, 1', 'Нигде, 5', 'Нигде, 6'])]
+        self.assertEqual(Task.objects.filter(key='geocode').count(), 1)
+        with mock.patch('map_app.geocoding.GEOCODE_BATCH_SIZE', 1):
+            # по пачке на запуск: три НКО и проверка пустой очереди
+            self.assertEqual(run_pending(), 4)
+        self.assertFalse(NKO.objects.filter(id__in=[nko.id for nko in nkos], geocode_pending=True).exists())
+        self.assertEqual(len(StubNominatim.queries), 3)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=50)
+        start = time.monotonic()
+        for _ in range(4):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 3 / 50)
+
+    def test_backend_without_geocode_cannot_be_created(self):
+        class IncompleteGeocoder(Geocoder):
+            pass
+
+        with self.assertRaises(TypeError):
+            IncompleteGeocoder(rate=0)
+
+
+@task(max_attempts=2)
+def failing_task(message):
+    raise ValueError(message)
+
+
+@task()
+def recording_task(value):
+    recording_task.calls.append(value)
+
+
+recording_task.calls = []
+
+
+class TaskQueueTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        self.categories, self.cities = create_dataset(20)
+
+    def test_moderation_work_runs_in_background(self):
+        pending = list(NKO.objects.filter(is_approved=False).values_list('id', flat=True))
+        with self.captureOnCommitCallbacks(execute=True):
+            moderate(approve=pending[:2])
+        with self.captureOnCommitCallbacks(execute=True):
+            moderate(reject=pending[:1])
+        # сотня модераций подряд — одна пересборка снимков
+        self.assertEqual(Task.objects.filter(key='snapshots').count(), 1)
+        self.assertEqual(mail.outbox, [])
+
+        self.assertEqual(run_pending(), 3)
+        self.assertFalse(Task.objects.exists())
+        self.assertEqual(
+            sorted(message.subject for message in mail.outbox),
+            ['НКО опубликована на карте', 'НКО опубликована на карте', 'НКО снята с публикации'],
+        )
+        self.assertEqual(mail.outbox[0].to, ['author@example.com'])
+
+    def test_mail_failure_requeues_only_unsent_letters(self):
+        rejected = list(NKO.objects.filter(is_approved=True).values_list('id', flat=True)[:3])
+        send = locmem.EmailBackend.send_messages
+        calls = []
+
+        def flaky_send(backend, messages):
+            calls.append(messages)
+            if len(calls) == 2:
+                raise OSError('SMTP недоступен')
+            return send(backend, messages)
+
+        moderate(reject=rejected)
+        with mock.patch.object(locmem.EmailBackend, 'send_messages', flaky_send):
+            with self.assertLogs('map_app.moderation', 'ERROR'):
+                run_pending()
+        self.assertEqual(len(mail.outbox), 1)
+        retry = Task.objects.get()
+        self.assertEqual(retry.kwargs, {'approved': [], 'rejected': rejected[1:], 'attempt': 2})
+
+        Task.objects.update(run_after=timezone.now())
+        run_pending()
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_no_letters_without_mail_settings(self):
+        pending = list(NKO.objects.filter(is_approved=False).values_list('id', flat=True))
+        with self.settings(EMAIL_BACKEND='django.core.mail.backends.dummy.EmailBackend'):
+            moderate(approve=pending[:1])
+        self.assertFalse(Task.objects.filter(name__endswith='notify_moderated').exists())
+
+    def test_failed_task_is_retried_then_kept(self):
+        enqueue(failing_task, message='сбой')
+        with self.assertLogs('map_app.tasks', 'ERROR'):
+            run_pending()
+        queued = Task.objects.get()
+        self.assertEqual((queued.status, queued.attempts), (Task.PENDING, 1))
+        self.assertGreater(queued.run_after, timezone.now())
+
+        Task.objects.update(run_after=timezone.now())
+        with self.assertLogs('map_app.tasks', 'ERROR'):
+            run_pending()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Task.FAILED, 2))
+        self.assertIn('ValueError: сбой', queued.last_error)
+
+    def test_keyed_task_runs_once_at_a_time(self):
+        recording_task.calls.clear()
+        enqueue(recording_task, key='record', value=1)
+        running = claim()
+        # пока задача выполняется, повтор не создаёт второй строки, а запоминается
+        enqueue(recording_task, key='record', value=2)
+        enqueue(recording_task, key='record', value=3)
+        self.assertEqual(Task.objects.count(), 1)
+        self.assertIsNone(claim())
+
+        run_task(running)
+        queued = Task.objects.get()
+        self.assertEqual((queued.status, queued.kwargs, queued.attempts), (Task.PENDING, {'value': 3}, 0))
+        run_pending()
+        self.assertEqual(recording_task.calls, [1, 3])
+        self.assertFalse(Task.objects.exists())
+
+    def test_stale_runs_count_as_attempts(self):
+        enqueue(failing_task, message='воркер упал')
+        for _ in range(2):
+            self.assertIsNotNone(claim())
+            Task.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+            requeue_stale()
+        queued = Task.objects.get()
+        self.assertEqual((queued.status, queued.attempts), (Task.FAILED, 2))
+
+    def test_avatar_is_shrunk_in_background(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        overridden = self.settings(MEDIA_ROOT=directory.name)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+        buffer = io.BytesIO()
+        Image.new('RGB', (1024, 512), 'red').save(buffer, format='PNG')
+        user = User.objects.get(username='author')
+        self.client.force_login(user)
+        self.client.post('/profile/', {
+            'phone': '', 'bio': '', 'avatar': SimpleUploadedFile('avatar.png', buffer.getvalue(), 'image/png'),
+        })
+        profile = UserProfile.objects.get(user=user)
+        with Image.open(profile.avatar.path) as image:
+            self.assertEqual(image.size, (1024, 512))
 
-# Create your tests here.
+        original = profile.avatar.path
+        run_pending()
+        profile.refresh_from_db()
+        with Image.open(profile.avatar.path) as image:
+            self.assertEqual(image.size, (256, 128))
+        # уменьшенная копия сохраняется рядом, исходник удаляется последним
+        self.assertFalse(os.path.exists(original))
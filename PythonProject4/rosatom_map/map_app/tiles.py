@@ -0,0 +1,233 @@
+"""Векторные тайлы (Mapbox Vector Tile) с точками НКО.
+
+Тайл ``z/x/y`` — слой ``nkos`` с кластерами из индекса кластеров
+(см. clustering.py): его сетка на зуме ``z`` делит каждый тайл на
+4 x 4 ячейки, поэтому кластер всегда попадает ровно в один тайл.
+У кластера есть свойства ``count`` и ``category_id`` (преобладающая
+категория), у одиночной точки ещё и id объекта — по нему карточка
+загружается из /api/nkos/<id>/.
+
+Готовые тайлы хранятся в TILE_CACHE_DIR как ``z/x/y.mvt``. При изменении
+НКО удаляются только тайлы, в которые попадает её старая и новая точка,
+остальные остаются на диске. Массовая загрузка передаёт набор затронутых
+тайлов самого крупного зума (TileSet), из него выводятся тайлы остальных
+зумов; кеш сбрасывается целиком, только если затронуто больше
+MAX_TRACKED_TILES тайлов.
+
+Кодировщик protobuf здесь минимальный — ровно то подмножество
+спецификации MVT 2.1, которое нужно для точек.
+"""
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import get_version
+from .clustering import MAX_ZOOM, MIN_ZOOM, cluster_index, project
+from .metrics import serialization
+from .models import NKO
+from .signals import nkos_changed
+
+LAYER_NAME = 'nkos'
+EXTENT = 4096
+# больше затронутых тайлов — дешевле сбросить кеш целиком
+MAX_TRACKED_TILES = 100_000
+
+# типы полей protobuf
+VARINT = 0
+LENGTH_DELIMITED = 2
+# команда MoveTo с одной точкой
+MOVE_TO_ONE = (1 & 0x7) | (1 << 3)
+POINT = 1
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 31)
+
+
+def _key(number, wire_type):
+    return _varint((number << 3) | wire_type)
+
+
+def _bytes_field(number, payload):
+    return _key(number, LENGTH_DELIMITED) + _varint(len(payload)) + payload
+
+
+def _uint_field(number, value):
+    return _key(number, VARINT) + _varint(value)
+
+
+def _packed_field(number, values):
+    return _bytes_field(number, b''.join(_varint(value) for value in values))
+
+
+@serialization()
+def encode_tile(features):
+    """Тайл из точек ``(id или None, x, y, {свойство: целое >= 0})``.
+
+    Координаты ``x``, ``y`` — в системе тайла, от 0 до EXTENT.
+    """
+    if not features:
+        return b''
+
+    keys, values = {}, {}
+    encoded = []
+    for feature_id, x, y, properties in features:
+        tags = []
+        for name, value in properties.items():
+            tags.append(keys.setdefault(name, len(keys)))
+            tags.append(values.setdefault(value, len(values)))
+        feature = b''
+        if feature_id is not None:
+            feature += _uint_field(1, feature_id)
+        feature += _packed_field(2, tags)
+        feature += _uint_field(3, POINT)
+        feature += _packed_field(4, (MOVE_TO_ONE, _zigzag(x), _zigzag(y)))
+        encoded.append(_bytes_field(2, feature))
+
+    layer = _uint_field(15, 2) + _bytes_field(1, LAYER_NAME.encode())
+    layer += b''.join(encoded)
+    layer += b''.join(_bytes_field(3, name.encode()) for name in keys)
+    # Value.uint_value = 5
+    layer += b''.join(_bytes_field(4, _uint_field(5, value)) for value in values)
+    layer += _uint_field(5, EXTENT)
+    return _bytes_field(3, layer)
+
+
+def is_valid_tile(zoom, x, y):
+    return MIN_ZOOM <= zoom <= MAX_ZOOM and 0 <= x < (1 << zoom) and 0 <= y < (1 << zoom)
+
+
+def tile_of(lat, lon, zoom):
+    x, y = project(lat, lon)
+    n = 1 << zoom
+    return zoom, min(int(x * n), n - 1), min(int(y * n), n - 1)
+
+
+def build_tile(zoom, x, y):
+    n = 1 << zoom
+    features = []
+    for cluster in cluster_index.tile_clusters(zoom, x, y):
+        px, py = project(cluster['latitude'], cluster['longitude'])
+        tile_x = min(int((px * n - x) * EXTENT), EXTENT - 1)
+        tile_y = min(int((py * n - y) * EXTENT), EXTENT - 1)
+        if cluster['count'] == 1:
+            category_id = cluster['category_id']
+        else:
+            categories = cluster['categories']
+            category_id = max(categories, key=categories.get)
+        features.append((
+            cluster.get('id'), tile_x, tile_y,
+            {'count': cluster['count'], 'category_id': category_id},
+        ))
+    return encode_tile(features)
+
+
+def tile_cache_dir():
+    return Path(settings.TILE_CACHE_DIR)
+
+
+def tile_path(zoom, x, y):
+    return tile_cache_dir() / str(zoom) / str(x) / f'{y}.mvt'
+
+
+def get_tile(zoom, x, y):
+    """Байты тайла; отсутствующий тайл строится и сохраняется на диск."""
+    path = tile_path(zoom, x, y)
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        pass
+
+    version = get_version()
+    data = build_tile(zoom, x, y)
+    # Если данные изменились, пока тайл строился, инвалидация могла пройти
+    # раньше записи — такой тайл на диск не кладём. Версия растёт до
+    # инвалидации, поэтому повторная проверка после переименования ловит
+    # изменение, случившееся между первой проверкой и записью.
+    if get_version() == version:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+        if get_version() != version:
+            path.unlink(missing_ok=True)
+    return data
+
+
+class TileSet:
+    """Затронутые тайлы: ``(x, y)`` на MAX_ZOOM, тайлы мельче выводятся сдвигом.
+
+    ``overflowed`` — тайлов больше MAX_TRACKED_TILES, проще сбросить весь кеш.
+    """
+
+    def __init__(self):
+        self.tiles = set()
+        self.overflowed = False
+
+    def add_points(self, points):
+        if self.overflowed:
+            return
+        for lat, lon in points:
+            if lat is not None and lon is not None:
+                self.tiles.add(tile_of(lat, lon, MAX_ZOOM)[1:])
+        if len(self.tiles) > MAX_TRACKED_TILES:
+            self.overflowed, self.tiles = True, set()
+
+    def invalidate(self):
+        if self.overflowed:
+            shutil.rmtree(tile_cache_dir(), ignore_errors=True)
+            return
+        for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+            shift = MAX_ZOOM - zoom
+            for x, y in {(x >> shift, y >> shift) for x, y in self.tiles}:
+                tile_path(zoom, x, y).unlink(missing_ok=True)
+
+
+def invalidate_points(points):
+    """Удаляет тайлы всех зумов, в которые попадают точки ``(широта, долгота)``."""
+    tiles = TileSet()
+    tiles.add_points(points)
+    tiles.invalidate()
+
+
+@receiver(nkos_changed)
+def nkos_changed_invalidate_tiles(sender, ids, tiles=None, **kwargs):
+    if ids is None:
+        # массовая загрузка без списка тайлов — сбрасываем кеш целиком
+        if tiles is None:
+            shutil.rmtree(tile_cache_dir(), ignore_errors=True)
+        else:
+            tiles.invalidate()
+        return
+    invalidate_points(NKO.objects.filter(id__in=ids).values_list('latitude', 'longitude'))
+
+
+@receiver(post_save, sender=NKO)
+def invalidate_moved_from(sender, instance, **kwargs):
+    loaded = getattr(instance, '_loaded_point', None)
+    point = (instance.latitude, instance.longitude)
+    if loaded is not None and loaded != point:
+        transaction.on_commit(lambda: invalidate_points([loaded]))
+    instance._loaded_point = point
+
+
+@receiver(post_delete, sender=NKO)
+def invalidate_deleted(sender, instance, **kwargs):
+    point = (instance.latitude, instance.longitude)
+    transaction.on_commit(lambda: invalidate_points([point]))
@@ -37,5 +37,17 @@ urlpatterns = [
     path('city/<int:city_id>/nkos/', views.get_nko_by_city, name='nko_by_city'),
     path('category/<int:category_id>/nkos/', views.get_nko_by_category, name='nko_by_category'),
     path('moderation/', views.moderation_view, name='moderation'),
+    path('moderation/bulk/', views.moderation_bulk_view, name='moderation_bulk'),
     path('api/nkos/', views.get_all_nko_data, name='api_nkos'),
+    path('api/nkos/events/', views.nko_events, name='api_nko_events'),
+    path('api/nkos/export.<str:export_format>', views.export_nkos, name='api_nkos_export'),
+    path('api/nkos/<int:nko_id>/', views.get_nko_detail, name='api_nko_detail'),
+    path('api/nkos/markers/', views.get_nko_markers, name='api_nkos_markers'),
+    path('api/nkos/bbox/', views.get_nko_in_bbox, name='api_nkos_bbox'),
+    path('api/nkos/nearby/', views.get_nearby_nko, name='api_nkos_nearby'),
+    path('api/nkos/clusters/', views.get_nko_clusters, name='api_nkos_clusters'),
+    path('tiles/<int:zoom>/<int:x>/<int:y>.mvt', views.get_nko_tile, name='nko_tile'),
+    path('api/stats/', views.get_map_stats, name='api_stats'),
+    path('api/search/', views.search_nko, name='api_search'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
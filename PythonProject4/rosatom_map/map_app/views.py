@@ -1,15 +1,59 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.db.models import Q
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.core.handlers.asgi import ASGIRequest
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from .models import City, NKOCategory, NKO
-from .forms import CustomUserCreationForm, UserProfileForm
+from .cache import (
+    acached_json, aget_or_build, aget_reference_version, aget_version, cached_json, dataset_conditional,
+    dump_json, get_or_build, get_reference_version, get_version,
+)
+from .forms import CustomUserCreationForm, ModerationFilterForm, UserProfileForm
+from .clustering import cluster_index
+from .events import broker
+from .export import EXPORT_FORMATS, astream_nkos, export_queryset, stream_nkos
+from .geo import BBoxError, cell_ranges, parse_bbox
+from .avatars import shrink_avatar
+from .geocoding import initial_point, schedule_geocoding
+from .markers import build_markers, encode_binary, gzip_bytes
+from .metrics import query_budget, registry
+from .moderation import count_nkos, filter_nkos, moderate, moderation_page, parse_items
+from .nearby import nearby_index
+from .search import search_index
+from .serializers import NKO_MARKER_FIELDS, aserialize_page, parse_fields, serialize_nkos
+from .snapshot import aread_snapshot
+from .stats import aget_stats, get_stats
+from .tiles import get_tile, is_valid_tile
+from .sync import changed_since, delta_base, removed_since, version_to_datetime
+from .tasks import enqueue
 from django.contrib.auth.forms import UserCreationForm
 from django import forms
 from django.contrib.auth.models import User
 from django.contrib.admin.views.decorators import staff_member_required
+from django.views.decorators.http import require_POST
+from asgiref.sync import sync_to_async
+import hashlib
 import json
+import math
+import re
+
+
+NKO_PAGE_SIZE = 500
+NKO_MAX_PAGE_SIZE = 5000
+SEARCH_MAX_PAGE_SIZE = 200
+MARKER_FORMATS = ('json', 'bin')
+ACCEPTS_GZIP_RE = re.compile(r'\bgzip\b')
+TILE_MAX_AGE = 5 * 60
+NEARBY_MAX_K = 100
+NEARBY_FIELDS = (
+    'id', 'name', 'category', 'category_id', 'category_color',
+    'address', 'phone', 'city', 'latitude', 'longitude',
+)
 
 
 class CustomUserCreationForm(UserCreationForm):
@@ -27,54 +71,27 @@ class CustomUserCreationForm(UserCreationForm):
         return user
 
 
-def map_view(request):
-    cities = City.objects.all()
-    categories = NKOCategory.objects.all()
-    approved_nkos = NKO.objects.filter(is_approved=True)
-
-    cities_data = []
-    for city in cities:
-        cities_data.append({
-            'id': city.id,
-            'name': city.name,
-            'region': city.region,
-            'latitude': city.latitude,
-            'longitude': city.longitude,
-        })
-
-    if cities:
-        avg_lat = sum(city.latitude for city in cities) / len(cities)
-        avg_lon = sum(city.longitude for city in cities) / len(cities)
-    else:
-        avg_lat, avg_lon = 55.7558, 37.6173
-
-    nko_data = []
-    for nko in approved_nkos:
-        nko_data.append({
-            'id': nko.id,
-            'name': nko.name,
-            'category': nko.category.name,
-            'category_id': nko.category.id,
-            'category_color': nko.category.color,
-            'description': nko.description,
-            'address': nko.address,
-            'phone': nko.phone,
-            'website': nko.website,
-            'vk_link': nko.vk_link,
-            'city': str(nko.city),
-            'latitude': nko.latitude,
-            'longitude': nko.longitude,
-        })
+@query_budget(6)
+async def map_view(request):
+    context = await aget_or_build('map_context', _build_map_context)
+    # Шаблон обращается к пользователю и сессии — это синхронные запросы к БД.
+    return await sync_to_async(render)(request, 'map_app/map.html', context)
+
+
+async def _build_map_context():
+    # Сами НКО страница загружает через API: маркеры — из /api/nkos/
+    # с полями NKO_MARKER_FIELDS, карточку — из /api/nkos/<id>/.
+    stats = await aget_stats()
 
     context = {
-        'cities': cities,
-        'categories': categories,
-        'nko_data_json': json.dumps(nko_data, ensure_ascii=False),
-        'cities_json': json.dumps(cities_data, ensure_ascii=False),
-        'map_center_lat': avg_lat,
-        'map_center_lon': avg_lon,
+        'cities': stats['cities'],
+        'categories': stats['categories'],
+        'marker_fields': ','.join(NKO_MARKER_FIELDS),
+        'cities_json': json.dumps(stats['cities'], ensure_ascii=False),
+        'map_center_lat': stats['center']['latitude'],
+        'map_center_lon': stats['center']['longitude'],
     }
-    return render(request, 'map_app/map.html', context)
+    return context
 
 
 def register_view(request):
@@ -138,11 +155,13 @@ def add_nko_view(request):
                 nko.latitude = float(latitude)
                 nko.longitude = float(longitude)
             else:
+                # без координат: из кеша адресов или центр города до geocode_nko
                 city = City.objects.get(id=request.POST.get('city'))
-                nko.latitude = city.latitude
-                nko.longitude = city.longitude
+                nko.latitude, nko.longitude, nko.geocode_pending = initial_point(city, nko.address)
 
             nko.save()
+            if nko.geocode_pending:
+                schedule_geocoding()
             messages.success(request, 'НКО успешно добавлена и отправлена на модерацию!')
             return redirect('map')
 
@@ -160,6 +179,7 @@ def edit_nko_view(request, nko_id):
     nko = get_object_or_404(NKO, id=nko_id, created_by=request.user)
 
     if request.method == 'POST':
+        old_place = (nko.address, str(nko.city_id), nko.latitude, nko.longitude)
         nko.name = request.POST.get('name')
         nko.category_id = request.POST.get('category')
         nko.description = request.POST.get('description')
@@ -172,11 +192,18 @@ def edit_nko_view(request, nko_id):
 
         latitude = request.POST.get('latitude')
         longitude = request.POST.get('longitude')
-        if latitude and longitude:
-            nko.latitude = float(latitude)
-            nko.longitude = float(longitude)
+        point = (float(latitude), float(longitude)) if latitude and longitude else None
+        if point is not None and point != old_place[2:]:
+            nko.latitude, nko.longitude = point
+            nko.geocode_pending = False
+        elif (nko.address, str(nko.city_id)) != old_place[:2]:
+            # адрес сменился, а координаты не трогали — ищем точку заново
+            city = City.objects.get(id=nko.city_id)
+            nko.latitude, nko.longitude, nko.geocode_pending = initial_point(city, nko.address)
 
         nko.save()
+        if nko.geocode_pending:
+            schedule_geocoding()
         messages.success(request, 'Информация о НКО успешно обновлена и отправлена на модерацию!')
         return redirect('map')
 
@@ -196,7 +223,9 @@ def profile_view(request):
     if request.method == 'POST':
         profile_form = UserProfileForm(request.POST, request.FILES, instance=request.user.userprofile)
         if profile_form.is_valid():
-            profile_form.save()
+            profile = profile_form.save()
+            if 'avatar' in request.FILES:
+                enqueue(shrink_avatar, profile_id=profile.id)
             messages.success(request, 'Профиль успешно обновлен!')
             return redirect('profile')
     else:
@@ -209,55 +238,25 @@ def profile_view(request):
     return render(request, 'map_app/profile.html', context)
 
 
-def get_nko_by_city(request, city_id):
+@query_budget(1)
+@dataset_conditional
+async def get_nko_by_city(request, city_id):
     nkos = NKO.objects.filter(city_id=city_id, is_approved=True)
-    nko_data = []
-    for nko in nkos:
-        nko_data.append({
-            'id': nko.id,
-            'name': nko.name,
-            'category': nko.category.name,
-            'category_color': nko.category.color,
-            'description': nko.description,
-            'address': nko.address,
-            'phone': nko.phone,
-            'website': nko.website,
-            'vk_link': nko.vk_link,
-            'latitude': nko.latitude,
-            'longitude': nko.longitude,
-        })
-    return JsonResponse({'nkos': nko_data})
-
-
-def get_nko_by_category(request, category_id):
-    nkos = NKO.objects.filter(category_id=category_id, is_approved=True)
-    nko_data = []
-    for nko in nkos:
-        nko_data.append({
-            'id': nko.id,
-            'name': nko.name,
-            'category': nko.category.name,
-            'category_color': nko.category.color,
-            'description': nko.description,
-            'address': nko.address,
-            'phone': nko.phone,
-            'website': nko.website,
-            'vk_link': nko.vk_link,
-            'city': str(nko.city),
-            'latitude': nko.latitude,
-            'longitude': nko.longitude,
-        })
-    return JsonResponse({'nkos': nko_data})
+    return await _nko_page_response(request, f'city:{city_id}', nkos)
+
 
+@query_budget(1)
+@dataset_conditional
+async def get_nko_by_category(request, category_id):
+    nkos = NKO.objects.filter(category_id=category_id, is_approved=True)
+    return await _nko_page_response(request, f'category:{category_id}', nkos)
 
 
 
 
+@query_budget(9)
 @staff_member_required
 def moderation_view(request):
-    pending_nkos = NKO.objects.filter(is_approved=False).select_related('category', 'city', 'created_by')
-    approved_nkos = NKO.objects.filter(is_approved=True).select_related('category', 'city', 'created_by')
-
     if request.method == 'POST':
         nko_id = request.POST.get('nko_id')
         action = request.POST.get('action')
@@ -265,43 +264,416 @@ def moderation_view(request):
         if nko_id and action:
             nko = get_object_or_404(NKO, id=nko_id)
             if action == 'approve':
-                nko.is_approved = True
-                nko.save()
+                moderate(approve=[nko.id])
                 messages.success(request, f'НКО "{nko.name}" одобрена')
             elif action == 'reject':
-                nko.is_approved = False
-                nko.save()
+                moderate(reject=[nko.id])
                 messages.success(request, f'НКО "{nko.name}" отклонена')
 
-            return redirect('moderation')
+            return redirect(request.get_full_path())
+
+    form = ModerationFilterForm(request.GET)
+    if not form.is_valid():
+        # Испорченный фильтр или курсор не сбрасываем молча к полному списку:
+        # страница с ошибкой и без данных.
+        context = {
+            'form': form,
+            'status': 'approved' if request.GET.get('status') == 'approved' else 'pending',
+            'counts': {'pending': 0, 'approved': 0, 'total': 0},
+            'nkos': [],
+            'is_first_page': True,
+        }
+        return render(request, 'map_app/moderation.html', context, status=400)
+    filters = form.cleaned_data
+    status = filters['status'] or 'pending'
+    cursor = filters['cursor']
+
+    nkos = filter_nkos(NKO.objects.all(), filters)
+    page, next_cursor = moderation_page(
+        nkos.select_related('category', 'city', 'created_by'), status == 'approved', cursor,
+    )
+    filter_query = request.GET.copy()
+    for key in ('status', 'cursor'):
+        filter_query.pop(key, None)
 
     context = {
-        'pending_nkos': pending_nkos,
-        'approved_nkos': approved_nkos,
+        'form': form,
+        'status': status,
+        'counts': count_nkos(nkos),
+        'nkos': page,
+        'next_cursor': next_cursor,
+        'is_first_page': cursor is None,
+        'filter_query': filter_query.urlencode(),
     }
     return render(request, 'map_app/moderation.html', context)
 
 
-def get_all_nko_data(request):
-    """API endpoint для получения всех данных НКО"""
-    approved_nkos = NKO.objects.filter(is_approved=True).select_related('category', 'city')
-
-    nko_data = []
-    for nko in approved_nkos:
-        nko_data.append({
-            'id': nko.id,
-            'name': nko.name,
-            'category': nko.category.name,
-            'category_id': nko.category.id,
-            'category_color': nko.category.color,
-            'description': nko.description,
-            'address': nko.address,
-            'phone': nko.phone,
-            'website': nko.website,
-            'vk_link': nko.vk_link,
-            'city': str(nko.city),
-            'latitude': nko.latitude,
-            'longitude': nko.longitude,
-        })
-
-    return JsonResponse({'nkos': nko_data})
\ No newline at end of file
+@query_budget(11)
+@staff_member_required
+@require_POST
+def moderation_bulk_view(request):
+    """API endpoint: пакетная модерация (см. moderation.py).
+
+    Тело запроса — JSON ``{"items": [{"id": 1, "action": "approve"}, ...]}``,
+    действие ``approve`` или ``reject``. В ответе — сводка по id.
+    """
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Некорректный JSON'}, status=400)
+    try:
+        approve, reject = parse_items(data)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(moderate(approve, reject))
+
+
+@query_budget(3)
+@dataset_conditional
+async def get_all_nko_data(request):
+    """API endpoint для получения всех данных НКО.
+
+    С параметром ``since=<версия>`` возвращает только изменения после
+    этой версии: добавленные, изменённые и удалённые НКО. Полный список
+    без постраничного вывода отдаётся из готового снимка (см. snapshot.py).
+    """
+    since = request.GET.get('since')
+    if not since:
+        if 'limit' not in request.GET and 'cursor' not in request.GET:
+            response = await _snapshot_response(request)
+            if response is not None:
+                return response
+        return await _nko_page_response(request, 'nkos', NKO.objects.filter(is_approved=True), with_version=True)
+
+    try:
+        fields = parse_fields(request.GET.get('fields'))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    try:
+        since = delta_base(int(since), await aget_version(), await aget_reference_version())
+    except ValueError:
+        return JsonResponse({'error': 'since должен быть версией набора данных из ответа API'}, status=400)
+    # Дельта собирается из нескольких запросов — строим её одним вызовом в потоке.
+    build = sync_to_async(lambda: _build_nko_delta(since, fields))
+    payload = await acached_json(f"delta:{since}:{','.join(fields)}", build)
+    return HttpResponse(payload, content_type='application/json')
+
+
+async def _snapshot_response(request):
+    try:
+        fields = parse_fields(request.GET.get('fields'))
+    except ValueError:
+        return None
+    snapshot = await aread_snapshot(fields, request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    if snapshot is None:
+        return None
+
+    payload, encoding = snapshot
+    response = HttpResponse(payload, content_type='application/json')
+    if encoding:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def _build_nko_delta(since, fields):
+    version = get_version()
+    if since < get_reference_version():
+        # Переименованы города или категории — дельты по НКО недостаточно.
+        nkos = serialize_nkos(NKO.objects.filter(is_approved=True), fields)
+        return {'version': version, 'nkos': nkos, 'reset': True}
+
+    added_after = version_to_datetime(since)
+    nkos = changed_since(since)
+
+    return {
+        'version': version,
+        'since': since,
+        'added': serialize_nkos(nkos.filter(created_at__gte=added_after), fields),
+        'changed': serialize_nkos(nkos.filter(created_at__lt=added_after), fields),
+        'removed': removed_since(since),
+    }
+
+
+def _int_param(request, name):
+    """Целый параметр запроса или None; текст ошибки не зависит от значения."""
+    value = request.GET.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'{name} должен быть целым числом') from None
+
+
+async def _nko_page_response(request, name, queryset, with_version=False):
+    """Список НКО с параметрами ``fields``, ``limit`` и ``cursor``.
+
+    Страницы идут по возрастанию id; ``next_cursor`` в ответе передаётся
+    как ``cursor`` следующего запроса и равен null на последней странице.
+    """
+    try:
+        fields = parse_fields(request.GET.get('fields'))
+        cursor = _int_param(request, 'cursor')
+        limit = _int_param(request, 'limit')
+        if limit is None and cursor is not None:
+            limit = NKO_PAGE_SIZE
+        if limit is not None and not 1 <= limit <= NKO_MAX_PAGE_SIZE:
+            raise ValueError(f'limit должен быть от 1 до {NKO_MAX_PAGE_SIZE}')
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    async def build():
+        data = {'version': await aget_version()} if with_version else {}
+        data['nkos'], data['next_cursor'] = await aserialize_page(queryset, fields, cursor, limit)
+        return data
+
+    payload = await acached_json(f"{name}:{','.join(fields)}:{cursor}:{limit}", build)
+    return HttpResponse(payload, content_type='application/json')
+
+
+@query_budget(2)
+async def export_nkos(request, export_format):
+    """Выгрузка одобренных НКО потоком в CSV, GeoJSON или NDJSON (см. export.py).
+
+    Персонал с параметром ``all=1`` получает и НКО на модерации.
+    """
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': f'Неизвестный формат: {export_format}'}, status=404)
+    include_unapproved = request.GET.get('all') == '1'
+    if include_unapproved and not (await request.auser()).is_staff:
+        return JsonResponse({'error': 'Полная выгрузка доступна только модераторам'}, status=403)
+
+    queryset, fields = export_queryset(include_unapproved)
+    stream = astream_nkos if isinstance(request, ASGIRequest) else stream_nkos
+    encoder, extension = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(stream(queryset, export_format, fields), content_type=encoder.content_type)
+    response['Content-Disposition'] = f'attachment; filename="nkos.{extension}"'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@query_budget(0)
+async def nko_events(request):
+    """API endpoint: поток Server-Sent Events об изменениях на карте (см. events.py).
+
+    Поток держится только под ASGI: WSGI-сервер дочитал бы бесконечный
+    асинхронный генератор до конца, не отправив клиенту ни байта, и занял
+    бы поток воркера. Там отвечаем 204 — EventSource не переподключается,
+    и карта переходит на опрос ``/api/nkos/?since=``.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    stream = broker.stream(reconnected='HTTP_LAST_EVENT_ID' in request.META)
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx не должен буферизовать поток
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@query_budget(1)
+@dataset_conditional
+def get_nko_detail(request, nko_id):
+    """Все поля одной одобренной НКО — для карточки на карте."""
+    try:
+        payload = cached_json(f'nko:{nko_id}', lambda: _build_nko_detail(nko_id))
+    except NKO.DoesNotExist:
+        return JsonResponse({'error': 'НКО не найдена'}, status=404)
+    return HttpResponse(payload, content_type='application/json')
+
+
+def _build_nko_detail(nko_id):
+    nkos = serialize_nkos(NKO.objects.filter(id=nko_id, is_approved=True))
+    if not nkos:
+        raise NKO.DoesNotExist
+    return nkos[0]
+
+
+@query_budget(1)
+@dataset_conditional
+def get_nko_markers(request):
+    """API endpoint: маркеры карты в столбцовом формате (см. markers.py).
+
+    ``format=json`` — столбцы в JSON, ``format=bin`` — двоичный вариант
+    для типизированных массивов в браузере.
+    """
+    marker_format = request.GET.get('format', 'json')
+    if marker_format not in MARKER_FORMATS:
+        return JsonResponse({'error': f'format должен быть одним из: {", ".join(MARKER_FORMATS)}'}, status=400)
+    if marker_format == 'json':
+        return HttpResponse(cached_json('markers_json', build_markers), content_type='application/json')
+
+    version = get_version()
+    payload = get_or_build('markers_bin', lambda: encode_binary(build_markers(version)), version)
+    use_gzip = ACCEPTS_GZIP_RE.search(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    if use_gzip:
+        payload = get_or_build('markers_bin_gz', lambda: gzip_bytes(payload), version)
+
+    response = HttpResponse(payload, content_type='application/octet-stream')
+    if use_gzip:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+@query_budget(1)
+@dataset_conditional
+def get_nko_in_bbox(request):
+    """API endpoint: одобренные НКО в видимой области карты.
+
+    Параметры: ``bbox=south,west,north,east`` и необязательный ``zoom``.
+    Поиск идёт по индексированному столбцу ``geo_cell``, точная
+    проверка координат выполняется уже внутри найденных ячеек.
+    """
+    try:
+        boxes = parse_bbox(request.GET.get('bbox'))
+        zoom = request.GET.get('zoom')
+        zoom = int(zoom) if zoom else None
+    except (BBoxError, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    area = Q()
+    for south, west, north, east in boxes:
+        cells = Q()
+        for start, end in cell_ranges(south, west, north, east, zoom):
+            cells |= Q(geo_cell__gte=start, geo_cell__lt=end)
+        area |= cells & Q(
+            latitude__range=(south, north),
+            longitude__range=(west, east),
+        )
+
+    nko_data = serialize_nkos(NKO.objects.filter(area, is_approved=True))
+
+    return HttpResponse(dump_json({'nkos': nko_data, 'zoom': zoom}), content_type='application/json')
+
+
+@query_budget(3)
+def get_nko_tile(request, zoom, x, y):
+    """Векторный тайл MVT с кластерами НКО (см. tiles.py).
+
+    Тайлы меняются редко, поэтому браузер кеширует их на TILE_MAX_AGE
+    и потом перепроверяет по ETag.
+    """
+    if not is_valid_tile(zoom, x, y):
+        raise Http404('Нет такого тайла')
+
+    data = get_tile(zoom, x, y)
+    etag = '"%s"' % hashlib.md5(data, usedforsecurity=False).hexdigest()[:16]
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(data, content_type='application/vnd.mapbox-vector-tile')
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=TILE_MAX_AGE)
+    return response
+
+
+@query_budget(3)
+@dataset_conditional
+def get_nko_clusters(request):
+    """API endpoint: кластеры НКО для видимой области и зума.
+
+    Параметры: ``bbox=south,west,north,east``, ``zoom`` и необязательный
+    ``category``. Одиночные НКО возвращаются с ``id`` и ``count == 1``.
+    """
+    try:
+        boxes = parse_bbox(request.GET.get('bbox'))
+        zoom = int(request.GET.get('zoom', ''))
+        category_id = request.GET.get('category')
+        category_id = int(category_id) if category_id else None
+    except (BBoxError, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    clusters = cluster_index.clusters(boxes, zoom, category_id)
+    return HttpResponse(dump_json({'clusters': clusters, 'zoom': zoom}), content_type='application/json')
+
+
+@query_budget(2)
+@dataset_conditional
+def get_map_stats(request):
+    """API endpoint: центр карты, границы городов и число НКО по городам и категориям"""
+    payload = cached_json('stats_json', get_stats)
+    return HttpResponse(payload, content_type='application/json')
+
+
+@query_budget(3)
+@dataset_conditional
+def search_nko(request):
+    """API endpoint: полнотекстовый поиск по НКО.
+
+    Параметры: ``q``, необязательные ``category`` и ``city``, ``page`` и
+    ``page_size``. Результаты ранжированы, в ``facets`` — число найденных
+    НКО по категориям и городам.
+    """
+    try:
+        category_id = request.GET.get('category')
+        category_id = int(category_id) if category_id else None
+        city_id = request.GET.get('city')
+        city_id = int(city_id) if city_id else None
+        page = max(1, int(request.GET.get('page', 1)))
+        page_size = min(SEARCH_MAX_PAGE_SIZE, max(1, int(request.GET.get('page_size', 20))))
+    except ValueError:
+        return JsonResponse({'error': 'Некорректные параметры поиска'}, status=400)
+
+    query = request.GET.get('q', '').strip()
+    key = hashlib.md5(request.get_full_path().encode(), usedforsecurity=False).hexdigest()
+    payload = cached_json(
+        f'search:{key}',
+        lambda: search_index.search(query, category_id, city_id, page, page_size),
+    )
+    return HttpResponse(payload, content_type='application/json')
+
+
+@query_budget(4)
+@dataset_conditional
+def get_nearby_nko(request):
+    """API endpoint: ближайшие к точке НКО.
+
+    Параметры: ``lat``, ``lon``, необязательные ``k`` (по умолчанию 10)
+    и ``radius_km``. Результаты отсортированы по расстоянию.
+    """
+    try:
+        lat = float(request.GET['lat'])
+        lon = float(request.GET['lon'])
+        k = min(NEARBY_MAX_K, max(1, int(request.GET.get('k', 10))))
+        radius_km = request.GET.get('radius_km')
+        radius_km = float(radius_km) if radius_km else None
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Нужны числовые параметры lat и lon'}, status=400)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return JsonResponse({'error': 'Координаты вне допустимого диапазона'}, status=400)
+    if radius_km is not None and not (math.isfinite(radius_km) and radius_km > 0):
+        return JsonResponse({'error': 'radius_km должен быть положительным числом'}, status=400)
+
+    # Индекс догоняет модерацию с задержкой: снятые с публикации НКО не
+    # отдаём, а добираем вместо них следующих по расстоянию.
+    nkos, dropped = {}, set()
+    while True:
+        nearest = [
+            (nko_id, distance)
+            for nko_id, distance in nearby_index.nearest(lat, lon, k + len(dropped), radius_km)
+            if nko_id not in dropped
+        ]
+        missing = [nko_id for nko_id, _ in nearest if nko_id not in nkos]
+        nkos.update(
+            (nko['id'], nko)
+            for nko in serialize_nkos(NKO.objects.filter(id__in=missing, is_approved=True), NEARBY_FIELDS)
+        )
+        stale = set(missing) - nkos.keys()
+        if not stale:
+            break
+        dropped |= stale
+    nko_data = [{**nkos[nko_id], 'distance_km': round(distance, 3)} for nko_id, distance in nearest]
+    return HttpResponse(dump_json({'nkos': nko_data}), content_type='application/json')
+
+
+@query_budget(2)
+def metrics_view(request):
+    """Метрики запросов по представлениям в текстовом формате Prometheus (см. metrics.py).
+
+    Доступны персоналу и адресам из METRICS_ALLOWED_IPS (по умолчанию
+    никаким: за nginx все запросы приходят с адреса прокси).
+    """
+    if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise PermissionDenied
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -18,6 +18,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'map_app.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -52,6 +53,55 @@ DATABASES = {
     }
 }
 
+# Общий кеш для версионированного набора данных НКО (map_app/cache.py).
+# При заданном REDIS_URL используется Redis, иначе — файловый кеш,
+# общий для всех процессов на одной машине.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('DJANGO_CACHE_DIR', BASE_DIR / 'cache'),
+        }
+    }
+
+# Готовые снимки публичного набора данных НКО (map_app/snapshot.py).
+NKO_SNAPSHOT_DIR = os.environ.get('NKO_SNAPSHOT_DIR', BASE_DIR / 'snapshots')
+
+# Дисковый кеш векторных тайлов (map_app/tiles.py).
+TILE_CACHE_DIR = os.environ.get('TILE_CACHE_DIR', BASE_DIR / 'tiles')
+
+# Геокодер адресов НКО для команды geocode_nko (map_app/geocoding.py).
+GEOCODER = {
+    'BACKEND': os.environ.get('GEOCODER_BACKEND', 'map_app.geocoding.NominatimGeocoder'),
+    'URL': os.environ.get('GEOCODER_URL', 'https://nominatim.openstreetmap.org/search'),
+    'USER_AGENT': os.environ.get('GEOCODER_USER_AGENT', 'rosatom-map'),
+    # запросов в секунду; публичный Nominatim разрешает не больше одного
+    'RATE': float(os.environ.get('GEOCODER_RATE', '1')),
+}
+
+# Почта для писем авторам НКО о решении модератора (map_app/moderation.py).
+# Без EMAIL_HOST письма не отправляются.
+EMAIL_HOST = os.environ.get('EMAIL_HOST', '')
+if EMAIL_HOST:
+    EMAIL_PORT = int(os.environ.get('EMAIL_PORT', '587'))
+    EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
+    EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
+    EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'True') == 'True'
+    DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', EMAIL_HOST_USER)
+else:
+    EMAIL_BACKEND = 'django.core.mail.backends.dummy.EmailBackend'
+
+# Адреса, с которых /metrics доступен без входа (map_app/metrics.py). По умолчанию
+# пусто: за обратным прокси REMOTE_ADDR у всех запросов — адрес самого прокси.
+METRICS_ALLOWED_IPS = [ip for ip in os.environ.get('METRICS_ALLOWED_IPS', '').split(',') if ip]
+
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']
 